@@ -0,0 +1,123 @@
+"""Benchmark backendów rozpoznawania mowy: opóźnienie i trafność na katalogu nagranych komend
+
+Każdy plik WAV w katalogu to jedna komenda. Oczekiwany tekst bierzemy z pliku .txt o tej samej
+nazwie, a gdy go nie ma - z nazwy pliku (podkreślenia jako spacje), np. "glosniej_o_10.wav".
+
+Uruchomienie:
+    python bench_asr.py nagrania/ --backends google,vosk,whisper
+"""
+import argparse
+import os
+import statistics
+import time
+
+import speech_recognition as sr
+
+import main
+
+
+def load_samples(directory):
+    """Lista (nazwa, AudioData, oczekiwany tekst) dla plików WAV z katalogu"""
+    samples = []
+    for name in sorted(os.listdir(directory)):
+        if not name.lower().endswith(".wav"):
+            continue
+        path = os.path.join(directory, name)
+        stem = os.path.splitext(path)[0]
+        if os.path.exists(stem + ".txt"):
+            with open(stem + ".txt", encoding="utf-8") as f:
+                expected = f.read().strip()
+        else:
+            expected = os.path.basename(stem).replace("_", " ")
+        with sr.AudioFile(path) as source:
+            audio = sr.Recognizer().record(source)
+        samples.append((name, audio, expected))
+    return samples
+
+
+def word_errors(expected, actual):
+    """Odległość edycyjna na słowach (po normalizacji) i liczba słów oczekiwanych"""
+    ref = main.normalize_utterance(expected).split()
+    hyp = main.normalize_utterance(actual or "").split()
+    previous = list(range(len(hyp) + 1))
+    for i, ref_word in enumerate(ref, 1):
+        current = [i]
+        for j, hyp_word in enumerate(hyp, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ref_word != hyp_word)))
+        previous = current
+    return previous[-1], len(ref)
+
+
+def run(backend, samples, verbose=False):
+    """Zwraca (czasy w ms, WER, trafność intencji) dla jednego backendu"""
+    latencies = []
+    errors = words = 0
+    intent_hits = intent_total = 0
+    for name, audio, expected in samples:
+        start = time.perf_counter()
+        try:
+            text = backend.transcribe(audio)
+        except Exception as e:
+            print(f"  {name}: błąd {e}")
+            text = None
+        latencies.append((time.perf_counter() - start) * 1000)
+        text = main.bias_transcript(text)
+
+        file_errors, file_words = word_errors(expected, text)
+        errors += file_errors
+        words += file_words
+
+        expected_intent = main.match_local_intent(expected)
+        if expected_intent:
+            intent_total += 1
+            intent_hits += main.match_local_intent(text or "") == expected_intent
+        if verbose:
+            print(f"  {name}: '{text}' (oczekiwano '{expected}')")
+
+    wer = errors / words if words else 0.0
+    intent_accuracy = intent_hits / intent_total if intent_total else None
+    return latencies, wer, intent_accuracy
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", help="katalog z plikami WAV")
+    parser.add_argument("--backends", default=",".join(main.ASR_BACKENDS),
+                        help="backendy do porównania, oddzielone przecinkami")
+    parser.add_argument("--verbose", action="store_true", help="wypisz transkrypcję każdego pliku")
+    args = parser.parse_args()
+
+    samples = load_samples(args.directory)
+    if not samples:
+        print(f"Brak plików WAV w {args.directory}")
+        return
+    main.print = lambda *a, **k: None
+
+    rows = []
+    for name in args.backends.split(","):
+        name = name.strip()
+        start = time.perf_counter()
+        try:
+            backend = main.ASR_BACKENDS[name]()
+        except Exception as e:
+            print(f"{name}: pomijam ({e})")
+            continue
+        load_ms = (time.perf_counter() - start) * 1000
+        print(f"{name}: {len(samples)} plików...")
+        latencies, wer, intent_accuracy = run(backend, samples, args.verbose)
+        rows.append((name, load_ms, latencies, wer, intent_accuracy))
+
+    print(f"\n{'backend':<10}{'ładowanie':>12}{'p50':>10}{'p95':>10}{'WER':>8}{'intencje':>10}")
+    for name, load_ms, latencies, wer, intent_accuracy in rows:
+        intents = f"{intent_accuracy:.0%}" if intent_accuracy is not None else "-"
+        print(f"{name:<10}{load_ms:>10.0f}ms{statistics.median(latencies):>8.0f}ms"
+              f"{percentile(latencies, 0.95):>8.0f}ms{wer:>8.1%}{intents:>10}")
+
+
+if __name__ == "__main__":
+    main_bench()
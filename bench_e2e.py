@@ -0,0 +1,209 @@
+"""Benchmark end-to-end: korpus komend przez async_parse_command i async_execute_command na lokalnych mockach
+
+Każda komenda przechodzi te same dwa kroki co w CommandPipeline (parsowanie, potem wykonanie), ale
+po kolei i bez kolejek potoku: benchmark mierzy parser i zapytania Spotify, nie zastępowanie komend.
+
+Wszystko działa offline i bez systemowego silnika mowy - mock Spotify (opóźnienia, 429, opóźniona
+propagacja stanu odtwarzacza) i mock OpenAI (parser komend przez chat/completions, opcjonalnie TTS).
+Wynik: przepustowość i percentyle czasu komend według akcji.
+
+Uruchomienie:
+    python bench_e2e.py --repeat 5 --latency 0.03 --llm-latency 0.4 --throttle 0.02
+    python bench_e2e.py --tts --trace traces.jsonl
+    python bench_e2e.py --corpus komendy.jsonl --max-p95 1500
+
+Korpus JSONL: {"text": "mam dziś doła", "action": "recommendation", "llm": {"action": "recommendation", ...}},
+gdzie "llm" to odpowiedź modelu dla komend, których nie rozpoznaje lokalny parser. Komenda sparsowana
+na inną akcję niż "action" albo zakończona niepowodzeniem jest błędem - wtedy kod wyjścia 1.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+# Caches w pamięci jeszcze przed importem main: benchmark nie czyta ani nie nadpisuje plików aplikacji
+for name in ("SEARCH_CACHE_FILE", "LIBRARY_INDEX_FILE", "PARSE_CACHE_FILE"):
+    os.environ[name] = ""
+
+import main
+from mock_servers import MockOpenAIServer, MockSpotifyServer
+
+
+# Polskie i angielskie komendy: część rozpoznawana lokalnie, część przez (mock) LLM
+CORPUS = [
+    {"text": "następna", "action": "next_song"},
+    {"text": "skip", "action": "next_song"},
+    {"text": "dawaj następny kawałek", "action": "next_song", "llm": {"action": "next_song"}},
+    {"text": "pauza", "action": "pause_playback"},
+    {"text": "pause", "action": "pause_playback"},
+    {"text": "wznów", "action": "resume_playback"},
+    {"text": "resume", "action": "resume_playback"},
+    {"text": "głośniej o 10", "action": "volume_up"},
+    {"text": "turn it down", "action": "volume_down"},
+    {"text": "możesz to trochę ściszyć", "action": "volume_down", "llm": {"action": "volume_down", "volume": "10"}},
+    {"text": "ustaw głośność na 30", "action": "set_volume"},
+    {"text": "przełącz na telewizor", "action": "switch_device"},
+    {"text": "play it on my laptop", "action": "switch_device",
+     "llm": {"action": "switch_device", "device": "Computer"}},
+    {"text": "lubię to", "action": "like"},
+    {"text": "polub ostatnie trzy piosenki", "action": "like"},
+    {"text": "zagraj Blinding Lights od The Weeknd", "action": "play_song",
+     "llm": {"action": "play_song", "song": "Blinding Lights", "artist": "The Weeknd"}},
+    {"text": "play Starboy by The Weeknd", "action": "play_song",
+     "llm": {"action": "play_song", "song": "Starboy", "artist": "The Weeknd"}},
+    {"text": "puść Nie ma fal Podsiadły", "action": "play_song",
+     "llm": {"action": "play_song", "song": "Nie ma fal", "artist": "Dawid Podsiadło"}},
+    {"text": "mam dziś doła", "action": "recommendation", "llm": {"action": "recommendation", "mood": "sad"}},
+    {"text": "I need something energetic for the gym", "action": "recommendation",
+     "llm": {"action": "recommendation", "mood": "energetic"}},
+    {"text": "włącz coś spokojnego do pracy", "action": "recommendation",
+     "llm": {"action": "recommendation", "mood": "focus"}},
+]
+
+
+class NullOutputStream:
+    """Wyjście audio bez dźwięku - mierzymy syntezę, nie długość wypowiedzi"""
+
+    def write(self, data):
+        pass
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SilentVoiceRecognizer(main.VoiceRecognizer):
+    def _init_engine(self):
+        return None  # mowa tylko przez (mock) OpenAI TTS - bez pyttsx3 i eSpeak
+
+    def _open_output_stream(self):
+        return NullOutputStream()
+
+
+def load_corpus(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def run_command(text, aspotify, voice):
+    """Parsowanie i wykonanie jak w CommandPipeline, zwraca też sparsowaną akcję: (akcja, sukces)"""
+    def say(response, ack=False):
+        if voice:
+            voice.speak(response, ack=ack)
+
+    with main.tracer.for_command(main.tracer.new_command_id()):
+        parsed, prefetched, speculative_track = await main.async_parse_command(text, aspotify)
+        success = await main.async_execute_command(text, parsed, aspotify, say, prefetched, speculative_track)
+    return parsed.get("action"), success
+
+
+async def run_corpus(corpus, spotify, voice, repeat):
+    """Zwraca (czasy w ms według oczekiwanej akcji, lista błędów)"""
+    aspotify = main.AsyncSpotifyClient(spotify)
+    timings = defaultdict(list)
+    failures = []
+    try:
+        for _ in range(repeat):
+            for entry in corpus:
+                start = time.perf_counter()
+                try:
+                    action, success = await run_command(entry["text"], aspotify, voice)
+                except Exception as e:
+                    action, success = f"wyjątek: {e}", False
+                timings[entry["action"]].append((time.perf_counter() - start) * 1000)
+                if action != entry["action"]:
+                    failures.append(f"{entry['text']!r}: oczekiwano {entry['action']}, sparsowano {action}")
+                elif not success:
+                    failures.append(f"{entry['text']!r}: {action} nie powiodło się")
+    finally:
+        await aspotify.aclose()
+    return timings, failures
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", help="plik JSONL z komendami (domyślnie wbudowany korpus)")
+    parser.add_argument("--repeat", type=int, default=3, help="ile razy przejść cały korpus")
+    parser.add_argument("--latency", type=float, default=0.03, help="opóźnienie odpowiedzi mocka Spotify (s)")
+    parser.add_argument("--connect-delay", type=float, default=0.05, help="koszt nowego połączenia (s)")
+    parser.add_argument("--throttle", type=float, default=0.0, help="część zapytań Spotify kończonych 429")
+    parser.add_argument("--retry-after", type=float, default=0.5, help="Retry-After odpowiedzi 429 (s)")
+    parser.add_argument("--propagation-delay", type=float, default=0.2,
+                        help="po ilu sekundach zmiana odtwarzacza jest widoczna w GET /me/player")
+    parser.add_argument("--llm-latency", type=float, default=0.4, help="czas odpowiedzi mocka parsera LLM (s)")
+    parser.add_argument("--tts", action="store_true", help="odpowiedzi głosowe przez mock TTS (bez dźwięku)")
+    parser.add_argument("--tts-latency", type=float, default=0.2, help="czas do pierwszego bajtu mocka TTS (s)")
+    parser.add_argument("--library", action="store_true", help="zsynchronizuj indeks biblioteki przed pomiarem")
+    parser.add_argument("--trace", help="zapisz ślady etapów do pliku JSONL i wypisz ich podsumowanie")
+    parser.add_argument("--max-p95", type=float, help="kod wyjścia 1, gdy p95 którejś akcji przekracza tyle ms")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus) if args.corpus else CORPUS
+    responses = {entry["text"]: entry["llm"] for entry in corpus if entry.get("llm")}
+
+    main.print = lambda *a, **k: None
+    if args.trace:
+        main.tracer = main.Tracer(args.trace)
+
+    spotify_server = MockSpotifyServer(latency=args.latency, connect_delay=args.connect_delay,
+                                       throttle=args.throttle, retry_after=args.retry_after,
+                                       propagation_delay=args.propagation_delay).start()
+    openai_server = MockOpenAIServer(latency=args.llm_latency, tts_latency=args.tts_latency,
+                                     responses=responses).start()
+    main.openai.base_url = openai_server.base_url + "/"
+    main.openai.api_key = "mock-key"
+
+    spotify = main.SpotifyClient("mock-token", base_url=spotify_server.base_url)
+    voice = SilentVoiceRecognizer(stream_tts=True) if args.tts else None
+    try:
+        if args.library:
+            main.library.sync(spotify)
+        spotify_server.requests = 0
+
+        start = time.perf_counter()
+        timings, failures = asyncio.run(run_corpus(corpus, spotify, voice, args.repeat))
+        elapsed = time.perf_counter() - start
+        if voice:
+            voice.wait_until_done()
+    finally:
+        if voice:
+            voice.shutdown()
+        spotify.close()
+        spotify_server.stop()
+        openai_server.stop()
+
+    commands = sum(len(values) for values in timings.values())
+    print(f"{'akcja':<20}{'n':>6}{'p50':>10}{'p95':>10}{'p99':>10}")
+    over_budget = []
+    for action, values in sorted(timings.items()):
+        p95 = main.percentile(values, 0.95)
+        print(f"{action:<20}{len(values):>6}{main.percentile(values, 0.5):>8.0f}ms"
+              f"{p95:>8.0f}ms{main.percentile(values, 0.99):>8.0f}ms")
+        if args.max_p95 is not None and p95 > args.max_p95:
+            over_budget.append(action)
+
+    print(f"\nKomendy: {commands} w {elapsed:.1f} s ({commands / elapsed:.2f}/s)")
+    print(f"Zapytania Spotify: {spotify_server.requests} ({spotify_server.requests / commands:.1f} na komendę), "
+          f"429: {spotify_server.throttled}")
+    print(f"Zapytania LLM: {openai_server.chat_requests}, TTS: {openai_server.tts_requests}")
+
+    if args.trace:
+        main.print = print
+        main.trace_summary(args.trace)
+    if failures:
+        print(f"\nBłędne komendy ({len(failures)}):")
+        for failure in failures:
+            print(f"  {failure}")
+    if over_budget:
+        print(f"\np95 powyżej {args.max_p95:.0f} ms: {', '.join(over_budget)}")
+    if failures or over_budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,121 @@
+"""Benchmark opóźnień komend Spotify: osobne połączenie na każde wywołanie vs. wspólna pula AsyncSpotifyClient
+
+Uruchomienie:
+    python bench_spotify.py --runs 20 --latency 0.02 --connect-delay 0.05
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+import main
+from mock_servers import MockSpotifyServer
+
+
+class UnpooledAsyncSpotifyClient(main.AsyncSpotifyClient):
+    """Zachowanie sprzed wspólnego klienta: bez keep-alive, nowe połączenie dla każdego żądania"""
+
+    def __init__(self, spotify, pool_size=10):
+        super().__init__(spotify, pool_size)
+        self.client = httpx.AsyncClient(
+            timeout=self.client.timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=0),
+        )
+
+
+def succeeded(result):
+    return bool(result["success"])
+
+
+# Komenda: (wywołanie z argumentami nazwanymi, sprawdzenie wyniku). Zmiana sygnatury w main kończy się
+# błędem, a komenda, która nic nie zrobiła, przerywa pomiar - zamiast po cichu mierzyć porażkę.
+COMMANDS = {
+    "next_song": (lambda aspotify: main.async_next_song(aspotify=aspotify), succeeded),
+    "pause_playback": (lambda aspotify: main.async_pause_playback(aspotify=aspotify), succeeded),
+    "resume_playback": (lambda aspotify: main.async_resume_playback(aspotify=aspotify), succeeded),
+    "like": (lambda aspotify: main.async_change_saved(aspotify=aspotify, saved=True), succeeded),
+    "set_volume": (lambda aspotify: main.async_set_volume(aspotify=aspotify, adjust_by=5), succeeded),
+    "switch_device": (lambda aspotify: main.async_switch_device(aspotify=aspotify, device_type_target="TV"),
+                      lambda result: result.startswith(("Przełączono", "Już grasz"))),
+    "search_and_play_playlist": (lambda aspotify: main.async_search_and_play_playlist(mood_input="chill",
+                                                                                      aspotify=aspotify),
+                                 lambda result: result.startswith("Dodaję playlistę")),
+    "play_song": (lambda aspotify: main.async_play_song(song="Starboy", artist="The Weeknd", aspotify=aspotify),
+                  bool),
+}
+
+
+class CommandFailed(Exception):
+    pass
+
+
+# Stan odtwarzacza przed komendą (poza pomiarem), żeby każde powtórzenie wysyłało swój zapis:
+# pauza po pauzie albo przełączenie na już aktywne urządzenie nie robią żadnego zapytania
+SETUP = {
+    "pause_playback": lambda aspotify: aspotify.put("/me/player/play"),
+    "resume_playback": lambda aspotify: aspotify.put("/me/player/pause"),
+    "switch_device": lambda aspotify: aspotify.put("/me/player", json={"device_ids": ["d1"], "play": True}),
+}
+
+
+async def run(client_cls, server, runs, rate_limit):
+    """Zwraca czasy (ms) każdej komendy dla danej klasy klienta"""
+    scheduler = main.RequestScheduler(rate=rate_limit, burst=max(1, int(rate_limit)))
+    spotify = main.SpotifyClient("mock-token", base_url=server.base_url, scheduler=scheduler)
+    aspotify = client_cls(spotify)
+    results = {}
+    try:
+        for name, (command, check) in COMMANDS.items():
+            samples = []
+            for _ in range(runs):
+                if name in SETUP:
+                    await SETUP[name](aspotify)
+                # Każde powtórzenie zaczyna od pustego snapshotu - jak pierwsza komenda po przerwie
+                aspotify.playback.invalidate()
+                start = time.perf_counter()
+                result = await command(aspotify)
+                samples.append((time.perf_counter() - start) * 1000)
+                if not check(result):
+                    raise CommandFailed(f"{name} ({client_cls.__name__}) nie powiodło się: {result!r}")
+            results[name] = samples
+    finally:
+        await aspotify.aclose()
+        spotify.close()
+    return results
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="liczba powtórzeń każdej komendy")
+    parser.add_argument("--latency", type=float, default=0.01, help="opóźnienie odpowiedzi mocka (s)")
+    parser.add_argument("--connect-delay", type=float, default=0.03,
+                        help="koszt nowego połączenia w mocku (s), emuluje TLS handshake")
+    parser.add_argument("--rate-limit", type=float, default=1e6,
+                        help="limit zapytań na sekundę (domyślnie praktycznie bez limitu - mierzymy połączenia)")
+    args = parser.parse_args()
+
+    main.print = lambda *a, **k: None
+
+    server = MockSpotifyServer(latency=args.latency, connect_delay=args.connect_delay).start()
+    try:
+        timings = {}
+        connections = {}
+        for label, client_cls in (("before", UnpooledAsyncSpotifyClient), ("after", main.AsyncSpotifyClient)):
+            server.connections = 0
+            timings[label] = asyncio.run(run(client_cls, server, args.runs, args.rate_limit))
+            connections[label] = server.connections
+    finally:
+        server.stop()
+
+    print(f"{'komenda':<26}{'przed p50':>12}{'po p50':>12}{'przyspieszenie':>16}")
+    for name in COMMANDS:
+        before = statistics.median(timings["before"][name])
+        after = statistics.median(timings["after"][name])
+        print(f"{name:<26}{before:>10.1f}ms{after:>10.1f}ms{before / after:>15.2f}x")
+    print(f"\nNowe połączenia: przed={connections['before']}, po={connections['after']}")
+
+
+if __name__ == "__main__":
+    main_bench()
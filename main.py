@@ -1,24 +1,37 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import hashlib
 import json
 import os
 import queue
+import re
+import sqlite3
 import sys
 import threading
 import time
+import unicodedata
 import urllib.parse
 import webbrowser
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from difflib import SequenceMatcher, get_close_matches
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from dotenv import load_dotenv
 from pydub import AudioSegment
 from pydub.playback import play
 import io
+import numpy as np
 import sounddevice as sd
 import soundfile as sf
 import tempfile
+import httpx
 import openai
 import pyttsx3
 import requests
 import speech_recognition as sr
-from openai import OpenAI
+from requests.adapters import HTTPAdapter
 
 # Load environment variables
 load_dotenv()
@@ -30,20 +43,594 @@ client_secret = os.getenv("SPOTIFY_CLIENT_SECRET")
 redirect_uri = os.getenv("SPOTIFY_REDIRECT_URI", "http://127.0.0.1:8888/callback")
 auth_code = None
 TOKEN_FILE = "spotify_tokens.json"
+TOKEN_REFRESH_MARGIN = float(os.getenv("TOKEN_REFRESH_MARGIN", "300"))  # odśwież tyle sekund przed wygaśnięciem
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL", "https://api.spotify.com/v1")
+SPOTIFY_CONNECT_TIMEOUT = float(os.getenv("SPOTIFY_CONNECT_TIMEOUT", "3.05"))
+SPOTIFY_READ_TIMEOUT = float(os.getenv("SPOTIFY_READ_TIMEOUT", "10"))
+SPOTIFY_RATE_LIMIT = float(os.getenv("SPOTIFY_RATE_LIMIT", "10"))  # średnio zapytań na sekundę
+SPOTIFY_BURST = int(os.getenv("SPOTIFY_BURST", "20"))  # pojemność "wiadra" tokenów
+SPOTIFY_MAX_RETRIES = 3  # ponowienia po 429
+SPOTIFY_MAX_RETRY_AFTER = float(os.getenv("SPOTIFY_MAX_RETRY_AFTER", "10"))  # dłuższy Retry-After = błąd komendy
+SPOTIFY_SAVED_BATCH = 50  # maks. liczba ID w jednym zapytaniu /me/tracks
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "tts_cache")
+TTS_CACHE_MAX_MB = float(os.getenv("TTS_CACHE_MAX_MB", "50"))
+PLAYER_POLL_TIMEOUT = float(os.getenv("PLAYER_POLL_TIMEOUT", "3"))
+PLAYER_STATE_TTL = float(os.getenv("PLAYER_STATE_TTL", "2"))
+DEVICE_CACHE_TTL = float(os.getenv("DEVICE_CACHE_TTL", "60"))
+RADIO_SIZE = 10
+MIC_SAMPLE_RATE = 16000
+ASR_BACKEND = os.getenv("ASR_BACKEND", "google")  # google | vosk | whisper
+VOSK_MODEL_PATH = os.getenv("VOSK_MODEL_PATH")  # katalog modelu; bez niego vosk pobiera mały model polski
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "base")
+CONTINUOUS_LISTENING = os.getenv("CONTINUOUS_LISTENING", "0") == "1"
+PARTIAL_INTERVAL = float(os.getenv("PARTIAL_INTERVAL", "0.5"))  # co ile sekund mowy częściowa transkrypcja
+ASR_PARTIALS = os.getenv("ASR_PARTIALS")  # "1"/"0" wymusza częściowe transkrypcje niezależnie od backendu
+SEARCH_CACHE_FILE = os.getenv("SEARCH_CACHE_FILE", "search_cache.db")
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "2000"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", str(7 * 24 * 3600)))  # po tym czasie odświeżane w tle
+MOOD_CACHE_SIZE = int(os.getenv("MOOD_CACHE_SIZE", "200"))
+MOOD_CACHE_TTL = float(os.getenv("MOOD_CACHE_TTL", str(24 * 3600)))  # playlisty zmieniają się częściej niż utwory
+LIBRARY_INDEX_FILE = os.getenv("LIBRARY_INDEX_FILE", "library.db")
+LIBRARY_SYNC = os.getenv("LIBRARY_SYNC", "1") == "1"  # synchronizacja indeksu biblioteki przy starcie
+SPECULATIVE_SEARCH = os.getenv("SPECULATIVE_SEARCH", "1") == "1"
+SPECULATIVE_SEARCH_DELAY = 0.05  # parsowanie dłuższe niż tyle sekund = zapytanie do LLM, startujemy wyszukiwanie
+PARSER_MODE = os.getenv("PARSER_MODE", "structured")  # structured | legacy
+PARSER_MODEL = os.getenv("PARSER_MODEL", "gpt-4o-mini")
+PARSE_CACHE_FILE = os.getenv("PARSE_CACHE_FILE", "parse_cache.json")
+PARSE_CACHE_SIZE = int(os.getenv("PARSE_CACHE_SIZE", "256"))
+PARSE_CACHE_TTL = float(os.getenv("PARSE_CACHE_TTL", str(7 * 24 * 3600)))
+PARSE_CACHE_SIMILARITY = float(os.getenv("PARSE_CACHE_SIMILARITY", "0.85"))
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", "4"))  # ile komend może być parsowanych naraz
+TRACE_FILE = os.getenv("TRACE_FILE")  # plik JSONL ze śladami komend; bez niego śledzenie wyłączone
 
 # Global command queue for communication between threads
 command_queue = queue.Queue()
 response_queue = queue.Queue()
 
+# Pula wątków do równoległych zapytań (np. wyszukiwanie utworu i artysty jednocześnie)
+executor = ThreadPoolExecutor(max_workers=4)
+
+
+# Śledzenie czasu etapów komendy (ASR, parsowanie, zapytania Spotify, TTS)
+class Span:
+    """Jeden etap: nazwa, czas trwania, atrybuty i etapy zagnieżdżone"""
+    __slots__ = ("tracer", "name", "attrs", "children", "started_at", "start", "duration", "parent", "token")
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.children = []
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.parent = self.tracer.current.get()
+        self.token = self.tracer.current.set(self)
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        self.tracer.current.reset(self.token)
+        if exc_type:
+            self.attrs["error"] = exc_type.__name__
+        if self.parent is not None:
+            self.parent.children.append(self)
+        else:
+            command_id = self.tracer.command.get()
+            if command_id:
+                self.attrs.setdefault("command", command_id)
+            self.tracer.write(self)
+        return False
+
+    def to_dict(self):
+        data = {"name": self.name, "ms": round(self.duration * 1000, 2)}
+        if self.attrs:
+            data["attrs"] = self.attrs
+        if self.children:
+            data["children"] = [child.to_dict() for child in self.children]
+        return data
+
+
+class NoSpan:
+    """Etap przy wyłączonym śledzeniu - nic nie mierzy"""
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+class Tracer:
+    """
+    Zagnieżdżone etapy komend zapisywane do pliku JSONL (jedna linia na etap najwyższego poziomu).
+
+    Bieżący etap jest w zmiennej kontekstowej, więc zagnieżdżanie działa w wątkach i zadaniach asyncio.
+    Etapy jednej komendy z różnych wątków (ASR, parsowanie, wykonanie, TTS) łączy atrybut "command"
+    etapów najwyższego poziomu - ID nadawane w for_command().
+    Bez pliku (path=None) span() zwraca pusty obiekt, a traced() od razu wywołuje funkcję.
+    """
+    NO_SPAN = NoSpan()
+
+    def __init__(self, path=TRACE_FILE):
+        self.path = path
+        self.enabled = bool(path)
+        self.current = contextvars.ContextVar("span", default=None)
+        self.command = contextvars.ContextVar("command", default=None)
+        self.lock = threading.Lock()
+        self.written = 0
+
+    def span(self, name, **attrs):
+        if not self.enabled:
+            return self.NO_SPAN
+        return Span(self, name, attrs)
+
+    @staticmethod
+    def new_command_id():
+        return os.urandom(6).hex()
+
+    @contextlib.contextmanager
+    def for_command(self, command_id):
+        """Etapy najwyższego poziomu w tym bloku dostają atrybut command=command_id"""
+        token = self.command.set(command_id)
+        try:
+            yield command_id
+        finally:
+            self.command.reset(token)
+
+    def annotate(self, **attrs):
+        """Dodaje atrybuty do bieżącego etapu (np. akcję po sparsowaniu komendy)"""
+        span = self.current.get() if self.enabled else None
+        if span is not None:
+            span.set(**attrs)
+
+    def write(self, span):
+        line = json.dumps(dict(span.to_dict(), time=round(span.started_at, 3)), ensure_ascii=False)
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            self.written += 1
+
+
+tracer = Tracer()
+
+
+def traced(func):
+    """Dekorator: wywołanie funkcji (zwykłej lub async) jako etap o nazwie funkcji"""
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return await func(*args, **kwargs)
+            with tracer.span(func.__name__):
+                return await func(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not tracer.enabled:
+            return func(*args, **kwargs)
+        with tracer.span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def trace_summary(path=TRACE_FILE):
+    """Wypisuje p50/p95/p99 czasu każdego etapu i całych komend według akcji z pliku śladów"""
+    stages = defaultdict(list)
+    actions = defaultdict(list)
+    commands = defaultdict(lambda: [float("inf"), 0.0, None])  # ID komendy -> [początek, koniec, akcja]
+    skipped = 0
+
+    def collect(span, found):
+        found.append((span["name"], float(span["ms"])))
+        for child in span.get("children", []):
+            collect(child, found)
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    span = json.loads(line)
+                    found = []
+                    collect(span, found)
+                    attrs = span.get("attrs", {})
+                    started = float(span.get("time", 0))
+                except (ValueError, TypeError, KeyError, AttributeError):
+                    skipped += 1  # urwana lub obca linia - nie przerywa podsumowania
+                    continue
+                for name, ms in found:
+                    stages[name].append(ms)
+                if attrs.get("action"):
+                    actions[attrs["action"]].append(found[0][1])
+                if attrs.get("command"):
+                    command = commands[attrs["command"]]
+                    command[0] = min(command[0], started)
+                    command[1] = max(command[1], started + found[0][1] / 1000)
+                    command[2] = attrs.get("action") or command[2]
+    except (OSError, TypeError) as e:
+        print(f"Nie można odczytać śladów ({path}): {e}")
+        return
+    if skipped:
+        print(f"Pominięto {skipped} uszkodzonych linii w {path}")
+
+    # Cała komenda od pierwszego do ostatniego etapu (ASR ... TTS), według akcji
+    end_to_end = defaultdict(list)
+    for start, end, action in commands.values():
+        end_to_end[action or "?"].append((end - start) * 1000)
+
+    for title, groups in (("etap", stages), ("akcja", actions), ("komenda od ASR do TTS", end_to_end)):
+        print(f"\n{title:<40}{'n':>6}{'p50':>10}{'p95':>10}{'p99':>10}")
+        for name, values in sorted(groups.items(), key=lambda item: -sum(item[1])):
+            print(f"{name:<40}{len(values):>6}{percentile(values, 0.5):>8.0f}ms"
+                  f"{percentile(values, 0.95):>8.0f}ms{percentile(values, 0.99):>8.0f}ms")
+
+# Stałe komunikaty agenta - syntezowane raz przy starcie i odtwarzane z cache
+STATIC_PHRASES = [
+    "Agent Spotify gotowy. Wpisz komendę lub naciśnij 'Q' aby użyć komendy głosowej.",
+    "Tryb głosowy aktywny. Proszę wydać komendę.",
+    "Nie rozpoznano komendy głosowej. Wracam do trybu tekstowego.",
+    "Przechodzę do następnego utworu",
+    "Zatrzymuję odtwarzanie",
+    "Wznawiam odtwarzanie",
+    "Zwiększam głośność",
+    "Zmniejszam głośność",
+    "Szukam odpowiedniej playlisty do Twojego nastroju.",
+    "Nie udało się przejść do następnego utworu. Sprawdź czy aplikacja Spotify jest aktywna.",
+    "Nie udało się zatrzymać odtwarzania. Sprawdź czy aplikacja Spotify jest aktywna.",
+    "Nie udało się wznowić odtwarzania. Sprawdź czy aplikacja Spotify jest aktywna.",
+    "Nie mogę odtworzyć - sprawdź czy aplikacja Spotify jest otwarta.",
+    "Nie udało się polubić aktualnego utworu.",
+    "Nie mogę znaleźć aktualnie odtwarzanego utworu.",
+    "Nie mogę pobrać informacji o odtwarzaczu.",
+    "Nie udało się zmienić głośności",
+    "Nie udało się pobrać listy urządzeń.",
+    "Nie udało się przełączyć urządzenia.",
+    "Nie udało się wyszukać playlisty.",
+    "Nie znalazłem żadnej playlisty pasującej do Twojego nastroju.",
+    "Nie udało się odtworzyć playlisty.",
+    "Przepraszam, wystąpił błąd podczas wykonywania komendy.",
+]
+
+
+# Cache zsyntezowanej mowy na dysku
+class TTSCache:
+    """Zdekodowane PCM adresowane treścią (tekst, głos, model, tempo, instrukcje), z limitem rozmiaru i LRU"""
+
+    def __init__(self, directory=TTS_CACHE_DIR, max_bytes=int(TTS_CACHE_MAX_MB * 1024 * 1024)):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(text, voice, model, speed, instructions):
+        payload = json.dumps([text, voice, model, speed, instructions], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.pcm")
+
+    def get(self, key):
+        """Zwraca PCM lub None; trafienie odświeża czas użycia pliku (LRU)"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                pcm = f.read()
+            os.utime(path)
+            return pcm
+        except OSError:
+            return None
+
+    def put(self, key, pcm):
+        # Zapis atomowy: najpierw plik tymczasowy, potem podmiana
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pcm)
+        os.replace(tmp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """Usuwa najdawniej używane pliki, aż cache zmieści się w limicie"""
+        with self.lock:
+            files = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(".pcm"):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+
+
+class UtteranceSegmenter:
+    """
+    Dzieli ciągły strumień PCM (16 bit, mono) na wypowiedzi na podstawie energii ramek.
+
+    Próg mowy to wielokrotność poziomu szumu tła, uaktualnianego przyrostowo (średnia wykładnicza)
+    na ramkach bez mowy i znacznie wolniej na ramkach z mową - stały hałas (okap, odkurzacz)
+    w końcu przestaje przekraczać próg. Wypowiedź ucięta na max_utterance bez spadku energii
+    ustawia poziom szumu na bieżącą energię. Bufor pierścieniowy trzyma kilkaset ms przed startem mowy,
+    żeby nie ucinać początku słowa.
+    """
+
+    def __init__(self, sample_rate=MIC_SAMPLE_RATE, frame_ms=30, pre_roll=0.3, start_speech=0.09,
+                 end_silence=0.7, min_speech=0.25, max_utterance=10.0, threshold_ratio=3.0, min_energy=300,
+                 noise_adapt=0.05, voiced_noise_adapt=0.001):
+        self.sample_rate = sample_rate
+        self.frame_bytes = int(sample_rate * frame_ms / 1000) * 2
+        frames = lambda seconds: max(1, round(seconds * 1000 / frame_ms))
+        self.start_frames = frames(start_speech)
+        self.end_frames = frames(end_silence)
+        self.min_frames = frames(min_speech)
+        self.max_frames = frames(max_utterance)
+        self.threshold_ratio = threshold_ratio
+        self.min_energy = min_energy
+        self.noise_adapt = noise_adapt
+        self.voiced_noise_adapt = voiced_noise_adapt
+        self.noise_level = None
+        self.ring = deque(maxlen=frames(pre_roll) + self.start_frames)
+        self.pending = b""
+        self.reset()
+
+    def reset(self):
+        """Porzuca bieżącą wypowiedź (np. gdy agent zaczyna mówić); poziom szumu zostaje"""
+        self.ring.clear()
+        self.pending = b""
+        self.frames = None
+        self.partials_sent = 0
+        self.voiced_run = 0
+        self.voiced_frames = 0
+        self.silent_run = 0
+
+    @property
+    def threshold(self):
+        return max(self.min_energy, (self.noise_level or 0) * self.threshold_ratio)
+
+    def feed(self, pcm):
+        """Dokłada próbki (dowolnej długości) i zwraca listę zakończonych wypowiedzi (bytes)"""
+        data = self.pending + pcm
+        usable = len(data) - len(data) % self.frame_bytes
+        self.pending = data[usable:]
+        utterances = []
+        for offset in range(0, usable, self.frame_bytes):
+            utterance = self._frame(data[offset:offset + self.frame_bytes])
+            if utterance:
+                utterances.append(utterance)
+        return utterances
+
+    def current(self):
+        """Dotychczasowe PCM trwającej wypowiedzi lub None"""
+        return b"".join(self.frames) if self.frames is not None else None
+
+    def flush(self):
+        """Zamyka trwającą wypowiedź (koniec nagrania); zwraca ją lub None"""
+        utterance = None
+        if self.frames is not None and self.voiced_frames >= self.min_frames:
+            utterance = b"".join(self.frames)
+        self.reset()
+        return utterance
+
+    def _frame(self, frame):
+        samples = np.frombuffer(frame, dtype=np.int16).astype(np.float32)
+        energy = float(np.sqrt(np.mean(samples * samples)))
+        voiced = energy > self.threshold
+        if voiced and self.noise_level is not None:
+            self.noise_level += (energy - self.noise_level) * self.voiced_noise_adapt
+
+        if self.frames is None:
+            self.ring.append(frame)
+            if voiced:
+                self.voiced_run += 1
+                if self.voiced_run >= self.start_frames:
+                    # Start mowy - razem z buforem sprzed progu
+                    self.frames = list(self.ring)
+                    self.voiced_frames = self.voiced_run
+                    self.silent_run = 0
+            else:
+                self.voiced_run = 0
+                if self.noise_level is None:
+                    self.noise_level = energy
+                else:
+                    self.noise_level += (energy - self.noise_level) * self.noise_adapt
+            return None
+
+        self.frames.append(frame)
+        if voiced:
+            self.voiced_frames += 1
+            self.silent_run = 0
+        else:
+            self.silent_run += 1
+
+        if len(self.frames) >= self.max_frames and not self.silent_run:
+            # Bez chwili ciszy przez max_utterance - to raczej hałas tła niż mowa
+            self.noise_level = energy
+        if self.silent_run >= self.end_frames or len(self.frames) >= self.max_frames:
+            return self.flush()
+        return None
+
+
+# Słowa komend, na które "naginamy" transkrypcję (prompt Whispera i korekta po rozpoznaniu)
+COMMAND_VOCABULARY = [
+    "następna", "następny", "pomiń", "dalej", "pauza", "zatrzymaj", "wstrzymaj", "wznów", "kontynuuj",
+    "głośniej", "ciszej", "głośność", "procent", "ustaw", "polub", "ulubionych", "przełącz", "telewizor",
+    "komputer", "laptop", "telefon", "zagraj", "puść", "playlistę", "nastrój",
+]
+
+
+# Po tych słowach zaczyna się tytuł, wykonawca lub nazwa playlisty - ich nie poprawiamy
+FREE_TEXT_COMMAND_WORDS = frozenset(("zagraj", "puść", "playlistę"))
+
+
+def bias_transcript(text, vocabulary=COMMAND_VOCABULARY, cutoff=0.8, max_words=3):
+    """
+    Poprawia słowa bliskie słowom komend (np. "głośnej" -> "głośniej") na początku wypowiedzi.
+
+    Poprawiane są tylko początkowe słowa komendy (najwyżej max_words): pierwsze słowo spoza słownika
+    albo słowo otwierające wolny tekst ("zagraj ...") kończy korektę, więc tytuły i wykonawcy
+    ("zagraj Następnie ...") zostają bez zmian.
+    """
+    if not text:
+        return text
+    lowered = {word.lower(): word for word in vocabulary}
+    words = text.split()
+    for index, word in enumerate(words[:max_words]):
+        if len(word) < 4:
+            continue  # przyimki i liczby ("na", "o 10") między słowami komendy
+        if word.lower() not in lowered:
+            close = get_close_matches(word.lower(), lowered, n=1, cutoff=cutoff)
+            if not close:
+                break
+            words[index] = lowered[close[0]]
+        if words[index].lower() in FREE_TEXT_COMMAND_WORDS:
+            break
+    return " ".join(words)
+
+
+class GoogleASR:
+    """Rozpoznawanie mowy w chmurze (Google Web Speech) - wymaga sieci"""
+    name = "google"
+    partials = False  # każda częściowa transkrypcja to osobne wysłanie nagrania
+
+    def __init__(self, language="pl-PL"):
+        self.recognizer = sr.Recognizer()
+        self.language = language
+
+    def transcribe(self, audio):
+        """Zwraca tekst lub None, gdy nie rozpoznano mowy; błędy usługi jako wyjątek"""
+        try:
+            return self.recognizer.recognize_google(audio, language=self.language) or None
+        except sr.UnknownValueError:
+            return None
+
+
+class VoskASR:
+    """Lokalne rozpoznawanie (Vosk/Kaldi) na CPU, bez sieci"""
+    name = "vosk"
+    partials = True
+    SAMPLE_RATE = 16000
+
+    def __init__(self, model_path=VOSK_MODEL_PATH, language="pl"):
+        try:
+            import vosk
+        except ImportError:
+            raise RuntimeError("Backend 'vosk' wymaga pakietu vosk (pip install vosk)")
+        vosk.SetLogLevel(-1)
+        self.vosk = vosk
+        self.model = vosk.Model(model_path) if model_path else vosk.Model(lang=language)
+
+    def transcribe(self, audio):
+        recognizer = self.vosk.KaldiRecognizer(self.model, self.SAMPLE_RATE)
+        recognizer.AcceptWaveform(audio.get_raw_data(convert_rate=self.SAMPLE_RATE, convert_width=2))
+        return json.loads(recognizer.FinalResult()).get("text") or None
+
+
+class WhisperASR:
+    """Lokalne rozpoznawanie (faster-whisper, int8 na CPU); słowa komend podane jako prompt"""
+    name = "whisper"
+    partials = True
+    SAMPLE_RATE = 16000
+
+    def __init__(self, model_size=WHISPER_MODEL, language="pl", vocabulary=COMMAND_VOCABULARY):
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError:
+            raise RuntimeError("Backend 'whisper' wymaga pakietu faster-whisper (pip install faster-whisper)")
+        self.model = WhisperModel(model_size, device="cpu", compute_type="int8")
+        self.language = language
+        self.prompt = ", ".join(vocabulary)
+
+    def transcribe(self, audio):
+        pcm = audio.get_raw_data(convert_rate=self.SAMPLE_RATE, convert_width=2)
+        samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+        segments, _ = self.model.transcribe(samples, language=self.language, beam_size=1,
+                                            initial_prompt=self.prompt)
+        return " ".join(segment.text.strip() for segment in segments).strip() or None
+
+
+ASR_BACKENDS = {backend.name: backend for backend in (GoogleASR, VoskASR, WhisperASR)}
+
+
+def make_asr_backend(name=ASR_BACKEND):
+    """Tworzy backend ASR po nazwie; gdy lokalny jest niedostępny, wraca do Google"""
+    try:
+        return ASR_BACKENDS[name]()
+    except KeyError:
+        print(f"Nieznany backend ASR '{name}' - używam Google.")
+    except Exception as e:
+        print(f"Nie udało się uruchomić backendu ASR '{name}': {e} - używam Google.")
+    return GoogleASR()
+
+
 # Klasa do obsługi rozpoznawania mowy
 class VoiceRecognizer:
-    def __init__(self):
+    # Ustawienia syntezy mowy (OpenAI TTS)
+    TTS_MODEL = "gpt-4o-mini-tts"
+    TTS_VOICE = "shimmer"
+    TTS_SPEED = 1.3
+    TTS_INSTRUCTIONS = (
+        "Mów jak entuzjastyczny, spokojny lektor radiowy. "
+        "Brzmisz przyjaźnie i naturalnie, z lekkim uśmiechem w głosie. "
+        "Zachowuj płynność, wyraź dykcję i nadaj rytm jak prezenter w radiu muzycznym. "
+        "Nie przesadzaj z emocjami, ale brzmisz zaangażowanie. "
+        "To Ty prowadzisz muzyczną rozmowę ze słuchaczem."
+    )
+    # Format "pcm" z API: 24 kHz, 16 bit, mono
+    TTS_SAMPLE_RATE = 24000
+    TTS_LEAD_SILENCE = 0.5  # sekundy ciszy przed mową
+    TTS_CHUNK_SIZE = 4096
+    # Potwierdzenie starsze niż tyle sekund nie jest już wypowiadane
+    ACK_MAX_AGE = 3.0
+
+    def __init__(self, stream_tts=True, tts_cache=None, asr=None):
         self.recognizer = sr.Recognizer()
-        self.engine = pyttsx3.init()
+        self.asr = asr or make_asr_backend()
+        self.engine = self._init_engine()
         self.listening = False
         self.listen_thread = None
         self.voice_command = None
         self.muted = False
+        self.stream_tts = stream_tts
+        self.tts_cache = tts_cache
+        self.segmenter = UtteranceSegmenter()
+        self.capture_thread = None
+        # Wywoływane z częściową transkrypcją trwającej wypowiedzi (tryb ciągły)
+        self.partial_callback = None
+        self.partials = self.asr.partials if ASR_PARTIALS is None else ASR_PARTIALS == "1"
+        self.partial_busy = False
+        self.utterance_seq = 0
+
+        # Wątek wyjścia audio: speak() tylko dodaje tekst do kolejki
+        self.speech_queue = queue.Queue()
+        self.speech_thread = threading.Thread(target=self._speech_worker)
+        self.speech_thread.daemon = True
+        self.speech_thread.start()
 
     def start_listening(self):
         """Rozpocznij słuchanie w osobnym wątku"""
@@ -61,57 +648,325 @@ class VoiceRecognizer:
         self.listening = False
         if self.listen_thread and self.listen_thread.is_alive():
             self.listen_thread.join(timeout=1)
+        if self.capture_thread and self.capture_thread.is_alive():
+            self.capture_thread.join(timeout=1)
         print("Nasłuchiwanie zatrzymane.")
 
-    def speak(self, text):
-        """Wypowiedz tekst"""
-        # print(f"Agent: {text}")
-        instructions = (
-            "Mów jak entuzjastyczny, spokojny lektor radiowy. "
-            "Brzmisz przyjaźnie i naturalnie, z lekkim uśmiechem w głosie. "
-            "Zachowuj płynność, wyraź dykcję i nadaj rytm jak prezenter w radiu muzycznym. "
-            "Nie przesadzaj z emocjami, ale brzmisz zaangażowanie. "
-            "To Ty prowadzisz muzyczną rozmowę ze słuchaczem."
-            )
-        
+    def start_continuous(self):
+        """
+        Ciągłe nasłuchiwanie: strumień mikrofonu otwarty cały czas, wypowiedzi wycinane przez segmenter.
+
+        Rozpoznane komendy trafiają od razu do command_queue - bez otwierania mikrofonu
+        i kalibracji szumu przy każdej komendzie.
+        """
+        if self.listening:
+            return
+
+        self.listening = True
+        self.capture_thread = threading.Thread(target=self._capture_loop)
+        self.capture_thread.daemon = True
+        self.capture_thread.start()
+        print("Ciągłe nasłuchiwanie aktywne - możesz mówić w dowolnej chwili...")
+
+    def _capture_loop(self):
+        segmenter = self.segmenter
+        blocksize = segmenter.frame_bytes // 2
+        try:
+            with sd.RawInputStream(samplerate=segmenter.sample_rate, channels=1, dtype='int16',
+                                   blocksize=blocksize) as stream:
+                while self.listening:
+                    data, _ = stream.read(blocksize)
+                    if self.speech_queue.unfinished_tasks:
+                        # Agent mówi - nie nagrywamy jego głosu jako komendy
+                        segmenter.reset()
+                        continue
+                    for utterance in segmenter.feed(bytes(data)):
+                        self.utterance_seq += 1
+                        executor.submit(self._recognize, utterance, segmenter.sample_rate)
+                    self._maybe_partial()
+        except Exception as e:
+            print(f"Błąd strumienia mikrofonu: {e}")
+        self.listening = False
+
+    def transcribe(self, audio):
+        """Tekst wypowiedzi z wybranego backendu ASR (z korektą słów komend) lub None"""
+        try:
+            with tracer.span("asr", backend=self.asr.name):
+                text = self.asr.transcribe(audio)
+        except sr.RequestError as e:
+            print(f"Błąd usługi rozpoznawania mowy: {e}")
+            return None
+        except Exception as e:
+            print(f"Błąd rozpoznawania mowy ({self.asr.name}): {e}")
+            return None
+        if not text:
+            print("Nie rozpoznano mowy")
+        return bias_transcript(text)
+
+    def _maybe_partial(self):
+        """Co PARTIAL_INTERVAL sekund trwającej wypowiedzi zleca częściową transkrypcję (jedna naraz)"""
+        segmenter = self.segmenter
+        if not (self.partial_callback and self.partials) or self.partial_busy or segmenter.frames is None:
+            return
+        frame_seconds = segmenter.frame_bytes / 2 / segmenter.sample_rate
+        if len(segmenter.frames) * frame_seconds < PARTIAL_INTERVAL * (segmenter.partials_sent + 1):
+            return
+        segmenter.partials_sent += 1
+        self.partial_busy = True
+        executor.submit(self._partial, segmenter.current(), segmenter.sample_rate, self.utterance_seq)
+
+    def _partial(self, pcm, sample_rate, seq):
+        try:
+            text = bias_transcript(self.asr.transcribe(sr.AudioData(pcm, sample_rate, 2)))
+            # Wypowiedź mogła się już skończyć - spóźniona hipoteza nie jest potrzebna
+            if text and seq == self.utterance_seq:
+                print(f"Częściowo: {text}")
+                self.partial_callback(text)
+        except Exception as e:
+            print(f"Błąd częściowej transkrypcji: {e}")
+        finally:
+            self.partial_busy = False
+
+    def _recognize(self, pcm, sample_rate):
+        """Rozpoznaje jedną wypowiedź i wrzuca tekst do command_queue; zwraca tekst lub None"""
+        with tracer.for_command(tracer.new_command_id()) as command_id:
+            text = self.transcribe(sr.AudioData(pcm, sample_rate, 2))
+        if text:
+            print(f"Rozpoznano: {text}")
+            command_queue.put((text, command_id))
+        return text
+
+    def feed_wav(self, path, recognize=True, chunk_seconds=0.1):
+        """
+        Przepuszcza nagranie WAV przez ten sam segmenter co mikrofon (do testów bez mikrofonu).
+
+        Zwraca listę rozpoznanych tekstów, a przy recognize=False - listę wyciętych wypowiedzi (PCM).
+        """
+        samples, sample_rate = sf.read(path, dtype='int16', always_2d=True)
+        samples = samples.mean(axis=1)
+        target_rate = self.segmenter.sample_rate
+        if sample_rate != target_rate:
+            positions = np.arange(0, len(samples), sample_rate / target_rate)
+            samples = np.interp(positions, np.arange(len(samples)), samples)
+        pcm = samples.astype(np.int16).tobytes()
+
+        self.segmenter.reset()
+        chunk = int(target_rate * chunk_seconds) * 2
+        utterances = []
+        for offset in range(0, len(pcm), chunk):
+            utterances.extend(self.segmenter.feed(pcm[offset:offset + chunk]))
+        last = self.segmenter.flush()
+        if last:
+            utterances.append(last)
+
+        if not recognize:
+            return utterances
+        return [text for text in (self._recognize(u, target_rate) for u in utterances) if text]
+
+    def speak(self, text, wait=False, ack=False):
+        """Dodaj tekst do kolejki mowy i wróć od razu
+
+        wait - poczekaj, aż kolejka mowy zostanie wypowiedziana
+        ack - krótkie potwierdzenie, pomijane jeśli czeka już nowszy komunikat
+        """
         if self.muted:
             return
+        self.speech_queue.put((text, ack, time.monotonic(), tracer.command.get()))
+        if wait:
+            self.wait_until_done()
+
+    def wait_until_done(self):
+        """Czeka na wypowiedzenie wszystkich komunikatów z kolejki"""
+        self.speech_queue.join()
+
+    async def listen_async(self):
+        """Jedno nasłuchiwanie bez blokowania pętli zdarzeń; komenda trafia do command_queue, zwraca jej tekst lub None"""
+        # Mikrofon nie powinien nagrywać wypowiedzi agenta
+        await asyncio.to_thread(self.wait_until_done)
+        self.voice_command = None
+        self.start_listening()
+        await asyncio.to_thread(self.listen_thread.join)
+        # Sama komenda jest już w command_queue - zwracamy tylko tekst
+        return self.voice_command
+
+    def flush(self):
+        """Usuwa z kolejki komunikaty, które jeszcze nie zaczęły być wypowiadane"""
+        while True:
+            try:
+                self.speech_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.speech_queue.task_done()
+
+    def shutdown(self):
+        """Kończy wątek mowy po wypowiedzeniu bieżących komunikatów"""
+        self.speech_queue.put(None)
+        self.speech_thread.join(timeout=5)
+
+    def _speech_worker(self):
+        while True:
+            item = self.speech_queue.get()
+            try:
+                if item is None:
+                    return
+                text, ack, queued_at, command_id = item
+                # Nieaktualne potwierdzenie: jest już nowszy komunikat albo minęło za dużo czasu
+                if ack and (not self.speech_queue.empty() or time.monotonic() - queued_at > self.ACK_MAX_AGE):
+                    continue
+                if self.muted:
+                    continue
+                with tracer.for_command(command_id), tracer.span("tts", chars=len(text)):
+                    self._say(text)
+            except Exception as e:
+                print(f"Błąd syntezy mowy: {e}")
+            finally:
+                self.speech_queue.task_done()
+
+    def _say(self, text):
+        """Synteza i odtworzenie jednego komunikatu (wywoływane w wątku mowy)"""
+        # print(f"Agent: {text}")
+        cache_key = self._cache_key(text)
+        if self.tts_cache:
+            pcm = self.tts_cache.get(cache_key)
+            if pcm is not None:
+                tracer.annotate(cached=True)
+                self._play_pcm(pcm)
+                return
+
+        if self.stream_tts:
+            pcm = self._speak_streaming(text)
+        else:
+            pcm = self._speak_buffered(text)
+
+        if self.tts_cache and pcm:
+            self.tts_cache.put(cache_key, pcm)
+        # self.engine.say(text)
+        # self.engine.runAndWait()
+
+    def _cache_key(self, text):
+        return TTSCache.key(text, self.TTS_VOICE, self.TTS_MODEL, self.TTS_SPEED, self.TTS_INSTRUCTIONS)
+
+    def _init_engine(self):
+        """Lokalny silnik mowy pyttsx3 (wymaga eSpeak/SAPI/NSSpeech w systemie)"""
+        return pyttsx3.init()
+
+    def _open_output_stream(self):
+        stream = sd.RawOutputStream(samplerate=self.TTS_SAMPLE_RATE, channels=1, dtype="int16")
+        stream.start()
+        # Dodaj ciszę (2 bajty na próbkę)
+        stream.write(bytes(int(self.TTS_SAMPLE_RATE * self.TTS_LEAD_SILENCE) * 2))
+        return stream
+
+    def _play_pcm(self, pcm):
+        """Odtwarza gotowe PCM (24 kHz, 16 bit, mono)"""
+        with tracer.span("tts.playback"):
+            stream = self._open_output_stream()
+            try:
+                stream.write(pcm)
+            finally:
+                stream.stop()
+                stream.close()
+
+    def _speak_streaming(self, text):
+        """Odtwarza mowę już w trakcie pobierania odpowiedzi (surowe PCM przez sounddevice), zwraca całe PCM"""
+        received = bytearray()
+        span = tracer.span("tts.stream")
+        with span, openai.audio.speech.with_streaming_response.create(
+            model=self.TTS_MODEL,
+            voice=self.TTS_VOICE,
+            input=text,
+            speed=self.TTS_SPEED,
+            instructions=self.TTS_INSTRUCTIONS,
+            response_format="pcm"
+        ) as response:
+            stream = self._open_output_stream()
+            try:
+                pending = b""
+                for chunk in response.iter_bytes(chunk_size=self.TTS_CHUNK_SIZE):
+                    if not received and tracer.enabled:
+                        # Czas do pierwszego dźwięku - to słyszy użytkownik
+                        span.set(first_chunk_ms=round((time.perf_counter() - span.start) * 1000, 2))
+                    received += chunk
+                    pending += chunk
+                    # Fragmenty sieciowe nie muszą kończyć się na granicy próbki
+                    usable = len(pending) - len(pending) % 2
+                    if usable:
+                        stream.write(pending[:usable])
+                        pending = pending[usable:]
+            finally:
+                stream.stop()
+                stream.close()
+        return bytes(received)
+
+    def _speak_buffered(self, text):
+        """Pobiera całą odpowiedź TTS, dekoduje MP3 i dopiero wtedy odtwarza, zwraca PCM"""
         # Wygeneruj mowę z tekstu
+        with tracer.span("tts.synthesis"):
+            response = openai.audio.speech.create(
+                model=self.TTS_MODEL,
+                voice=self.TTS_VOICE,
+                input=text,
+                speed=self.TTS_SPEED,
+                instructions=self.TTS_INSTRUCTIONS
+            )
+
+        # Dodaj ciszę
+        with tracer.span("tts.decode"):
+            silence = AudioSegment.silent(duration=int(self.TTS_LEAD_SILENCE * 1000))
+            audio_bytes = io.BytesIO(response.content)
+            tts_audio = AudioSegment.from_file(audio_bytes, format="mp3")
+            full_audio = silence + tts_audio
+        with tracer.span("tts.playback"):
+            play(full_audio)
+
+        # To samo audio w formacie cache (24 kHz, 16 bit, mono)
+        return tts_audio.set_frame_rate(self.TTS_SAMPLE_RATE).set_channels(1).set_sample_width(2).raw_data
+
+    def synthesize_pcm(self, text):
+        """Syntezuje tekst do PCM bez odtwarzania"""
         response = openai.audio.speech.create(
-            model="gpt-4o-mini-tts",
-            voice="shimmer",
+            model=self.TTS_MODEL,
+            voice=self.TTS_VOICE,
             input=text,
-            speed=1.3,
-            instructions=instructions
+            speed=self.TTS_SPEED,
+            instructions=self.TTS_INSTRUCTIONS,
+            response_format="pcm"
         )
-        
-        # Dodaj ciszę
-        silence = AudioSegment.silent(duration=500)  # 0.5 sekundy
-        audio_bytes = io.BytesIO(response.content)
-        tts_audio = AudioSegment.from_file(audio_bytes, format="mp3")
-        full_audio = silence + tts_audio
-        play(full_audio)
-        # self.engine.say(text)
-        # self.engine.runAndWait()
+        return response.content
+
+    def prewarm(self, phrases):
+        """Syntezuje w tle brakujące w cache stałe komunikaty"""
+        if not self.tts_cache:
+            return None
+
+        def worker():
+            for phrase in phrases:
+                key = self._cache_key(phrase)
+                if self.tts_cache.get(key) is not None:
+                    continue
+                try:
+                    self.tts_cache.put(key, self.synthesize_pcm(phrase))
+                except Exception as e:
+                    print(f"Nie udało się przygotować komunikatu '{phrase}': {e}")
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        return thread
 
     def _listen_once(self):
         """Jednorazowe nasłuchiwanie komendy głosowej"""
         try:
-            with sr.Microphone() as source:
-                print("Słucham... (powiedz komendę)")
-                self.recognizer.adjust_for_ambient_noise(source, duration=0.5)
-                audio = self.recognizer.listen(source, timeout=10, phrase_time_limit=10)
-
-            try:
-                text = self.recognizer.recognize_google(audio, language="pl-PL")
-                if text:
-                    print(f"Rozpoznano: {text}")
-                    command_queue.put(text)
-                    self.voice_command = text
-            except sr.UnknownValueError:
-                print("Nie rozpoznano mowy")
-            except sr.RequestError as e:
-                print(f"Błąd usługi rozpoznawania mowy: {e}")
+            with tracer.for_command(tracer.new_command_id()) as command_id:
+                with sr.Microphone() as source, tracer.span("listen"):
+                    print("Słucham... (powiedz komendę)")
+                    self.recognizer.adjust_for_ambient_noise(source, duration=0.5)
+                    audio = self.recognizer.listen(source, timeout=10, phrase_time_limit=10)
+                text = self.transcribe(audio)
+            if text:
+                print(f"Rozpoznano: {text}")
+                command_queue.put((text, command_id))
+                self.voice_command = text
 
         except Exception as e:
             print(f"Błąd podczas nasłuchiwania: {e}")
@@ -150,9 +1005,21 @@ class CallbackHandler(BaseHTTPRequestHandler):
 
 
 def save_tokens(token_data):
-    """Zapisuje tokeny do pliku"""
-    with open(TOKEN_FILE, 'w') as f:
-        json.dump(token_data, f)
+    """Zapisuje tokeny do pliku (atomowo - przerwany zapis nie zostawi uszkodzonego pliku)"""
+    # Zapamiętaj moment wygaśnięcia, żeby przy starcie nie odświeżać wciąż ważnego tokena
+    if 'expires_in' in token_data and 'expires_at' not in token_data:
+        token_data['expires_at'] = time.time() + token_data['expires_in']
+
+    directory = os.path.dirname(os.path.abspath(TOKEN_FILE))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(token_data, f)
+        os.replace(tmp_path, TOKEN_FILE)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
     print(f"Tokeny zapisane do {TOKEN_FILE}")
 
 
@@ -178,7 +1045,8 @@ def refresh_access_token(refresh_token):
             "client_id": client_id,
             "client_secret": client_secret
         },
-        headers={"Content-Type": "application/x-www-form-urlencoded"}
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+        timeout=(SPOTIFY_CONNECT_TIMEOUT, SPOTIFY_READ_TIMEOUT)
     )
 
     if response.status_code != 200:
@@ -198,6 +1066,93 @@ def refresh_access_token(refresh_token):
     return token_data.get("access_token")
 
 
+class TokenManager:
+    """Token dostępu Spotify z odświeżaniem w tle przed wygaśnięciem"""
+
+    def __init__(self, margin=TOKEN_REFRESH_MARGIN):
+        self.margin = margin
+        self.token_data = None
+        self.lock = threading.Lock()
+        self.auth_lock = threading.Lock()  # jedna autoryzacja w przeglądarce naraz (port 8888)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    @property
+    def access_token(self):
+        return self.token_data.get("access_token") if self.token_data else None
+
+    def seconds_left(self):
+        """Czas do wygaśnięcia tokena (0, gdy nieznany)"""
+        if not self.token_data:
+            return 0
+        return self.token_data.get("expires_at", 0) - time.time()
+
+    def start(self):
+        """Wczytuje ważny token z pliku lub uzyskuje nowy, a potem uruchamia odświeżanie w tle"""
+        token_data = load_tokens()
+        if token_data and token_data.get("access_token") and \
+                token_data.get("expires_at", 0) - time.time() > self.margin:
+            print("Zapisany token dostępu jest nadal ważny.")
+            self.token_data = token_data
+        else:
+            if not get_token():
+                return None
+            self.token_data = load_tokens()
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.access_token
+
+    def refresh(self, stale_token=None):
+        """
+        Odświeża token i zwraca aktualny.
+
+        stale_token - token, który został odrzucony (401); jeśli ktoś już go w międzyczasie
+        odświeżył, nie wysyłamy kolejnego zapytania.
+        """
+        with self.lock:
+            if stale_token and self.access_token != stale_token:
+                return self.access_token
+            if self.token_data.get("refresh_token") and refresh_access_token(self.token_data["refresh_token"]):
+                self.token_data = load_tokens()
+            return self.access_token
+
+    def reauthorize(self):
+        """Nowa autoryzacja w przeglądarce (np. gdy tokenowi brakuje zakresów); zwraca aktualny token"""
+        # Czekanie na użytkownika (do 2 minut) poza self.lock - odświeżanie tokena działa w tym czasie dalej
+        with self.auth_lock:
+            code = get_auth_code()
+        if not code:
+            return self.access_token
+        with self.lock:
+            if exchange_auth_code(code):
+                self.token_data = load_tokens()
+            return self.access_token
+
+    def _run(self, min_backoff=5, max_backoff=300):
+        backoff = min_backoff
+        while not self.stop_event.is_set():
+            wait = self.seconds_left() - self.margin
+            if wait > 0:
+                backoff = min_backoff
+                self.stop_event.wait(wait)
+                continue
+            print("Token dostępu wkrótce wygaśnie - odświeżam w tle...")
+            try:
+                self.refresh()
+            except Exception as e:
+                # Brak sieci, timeout - wątek musi przeżyć, żeby spróbować ponownie
+                print(f"Błąd odświeżania tokena: {e}")
+            if self.seconds_left() <= self.margin:
+                # Nie udało się - ponów z rosnącym odstępem
+                self.stop_event.wait(backoff)
+                backoff = min(backoff * 2, max_backoff)
+
+    def stop(self):
+        self.stop_event.set()
+
+
 def get_auth_code():
     """Uruchamia lokalny serwer i otwiera stronę autoryzacji Spotify, aby automatycznie uzyskać kod"""
     global auth_code
@@ -218,6 +1173,7 @@ def get_auth_code():
         f"&response_type=code"
         f"&redirect_uri={urllib.parse.quote(redirect_uri)}"
         f"&scope=user-read-playback-state%20user-modify-playback-state%20user-library-modify%20user-library-read"
+        f"%20playlist-read-private%20playlist-read-collaborative%20user-read-recently-played"
     )
 
     # Otwórz przeglądarkę dla użytkownika w celu autoryzacji
@@ -261,8 +1217,11 @@ def get_token():
 
     if not code:
         raise Exception("Nie udało się uzyskać kodu autoryzacji")
+    return exchange_auth_code(code)
 
-    # Wymień kod na token dostępu
+
+def exchange_auth_code(code):
+    """Wymienia kod autoryzacji na token dostępu i zapisuje tokeny"""
     response = requests.post(
         "https://accounts.spotify.com/api/token",
         data={
@@ -272,7 +1231,8 @@ def get_token():
             "client_id": client_id,
             "client_secret": client_secret
         },
-        headers={"Content-Type": "application/x-www-form-urlencoded"}
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+        timeout=(SPOTIFY_CONNECT_TIMEOUT, SPOTIFY_READ_TIMEOUT)
     )
 
     if response.status_code != 200:
@@ -289,7 +1249,850 @@ def get_token():
     return token_data.get("access_token")
 
 
+# Priorytety zapytań do Spotify
+PRIORITY_INTERACTIVE = 0  # bezpośrednia reakcja na komendę (pauza, głośność...)
+PRIORITY_BACKGROUND = 1  # dopełnianie kolejki, metadane
+
+
+class RequestScheduler:
+    """
+    Token bucket dla wszystkich zapytań do Spotify.
+
+    Szanuje Retry-After z odpowiedzi 429 (wstrzymuje wszystkie zapytania), a zapytania w tle
+    mogą zużyć tylko część wiadra - reszta jest zarezerwowana dla komend interaktywnych.
+    Liczniki per endpoint pokazują, na co idzie limit zapytań.
+    """
+
+    def __init__(self, rate=SPOTIFY_RATE_LIMIT, burst=SPOTIFY_BURST, background_share=0.5):
+        self.rate = rate
+        self.capacity = burst
+        self.background_reserve = burst * (1 - background_share)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.interactive_waiting = 0
+        self.condition = threading.Condition()
+        self.counters = defaultdict(lambda: {"requests": 0, "throttled": 0, "errors": 0, "wait_ms": 0.0})
+
+    @staticmethod
+    def endpoint_key(method, path):
+        """Klucz licznika: metoda + ścieżka bez zapytania i z ID zastąpionymi przez {id}"""
+        path = urllib.parse.urlparse(path).path
+        path = re.sub(r"/(tracks|artists|albums|playlists|devices)/[^/]+", r"/\1/{id}", path)
+        return f"{method} {path}"
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _try_take(self, interactive):
+        """Pobiera token (zwraca 0) albo zwraca, ile sekund poczekać; wywoływane pod self.condition"""
+        now = time.monotonic()
+        self._refill(now)
+        wait = self.blocked_until - now
+        if wait > 0:
+            return wait
+        # Zapytania w tle nie ruszają rezerwy i ustępują czekającym interaktywnym
+        needed = 1 if interactive else 1 + self.background_reserve
+        if self.tokens >= needed and (interactive or not self.interactive_waiting):
+            self.tokens -= 1
+            return 0
+        return max((needed - self.tokens) / self.rate, 0.01)
+
+    def acquire(self, endpoint, priority=PRIORITY_INTERACTIVE):
+        """Blokuje, aż zapytanie może zostać wysłane"""
+        interactive = priority == PRIORITY_INTERACTIVE
+        start = time.monotonic()
+        with self.condition:
+            if interactive:
+                self.interactive_waiting += 1
+            try:
+                while True:
+                    wait = self._try_take(interactive)
+                    if not wait:
+                        break
+                    self.condition.wait(wait)
+            finally:
+                if interactive:
+                    self.interactive_waiting -= 1
+                self.condition.notify_all()
+            self.counters[endpoint]["wait_ms"] += (time.monotonic() - start) * 1000
+
+    async def acquire_async(self, endpoint, priority=PRIORITY_INTERACTIVE):
+        """Jak acquire(), ale czeka przez asyncio.sleep zamiast blokować wątek pętli zdarzeń"""
+        interactive = priority == PRIORITY_INTERACTIVE
+        start = time.monotonic()
+        with self.condition:
+            if interactive:
+                self.interactive_waiting += 1
+        try:
+            while True:
+                with self.condition:
+                    wait = self._try_take(interactive)
+                if not wait:
+                    break
+                await asyncio.sleep(wait)
+        finally:
+            with self.condition:
+                if interactive:
+                    self.interactive_waiting -= 1
+                self.condition.notify_all()
+                self.counters[endpoint]["wait_ms"] += (time.monotonic() - start) * 1000
+
+    def throttle(self, endpoint, retry_after, max_delay=SPOTIFY_MAX_RETRY_AFTER):
+        """
+        Odpowiedź 429: wstrzymaj wszystkie zapytania na czas z Retry-After (najwyżej max_delay).
+
+        Zwraca True, gdy zapytanie warto ponowić; przy dłuższym Retry-After komenda ma się zakończyć
+        błędem zamiast blokować wszystkie kolejne na minuty.
+        """
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = 1.0
+        retry = delay <= max_delay
+        if retry:
+            print(f"Limit zapytań Spotify (429) na {endpoint} - czekam {delay:.0f} s")
+        else:
+            print(f"Limit zapytań Spotify (429) na {endpoint} - Retry-After {delay:.0f} s, rezygnuję")
+        with self.condition:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + min(delay, max_delay))
+            self.counters[endpoint]["throttled"] += 1
+            self.condition.notify_all()
+        return retry
+
+    def record(self, endpoint, status_code):
+        with self.condition:
+            self.counters[endpoint]["requests"] += 1
+            if status_code >= 400:
+                self.counters[endpoint]["errors"] += 1
+
+    def stats(self):
+        """Liczniki per endpoint, od najczęściej używanego"""
+        with self.condition:
+            items = sorted(self.counters.items(), key=lambda item: -item[1]["requests"])
+            return {endpoint: dict(counter, wait_ms=round(counter["wait_ms"], 1)) for endpoint, counter in items}
+
+
+# Wspólny klient HTTP dla Spotify Web API
+class SpotifyClient:
+    """Jedna sesja HTTP z pulą połączeń keep-alive, domyślnymi nagłówkami i timeoutami"""
+
+    def __init__(self, access_token, base_url=SPOTIFY_API_URL,
+                 timeout=(SPOTIFY_CONNECT_TIMEOUT, SPOTIFY_READ_TIMEOUT), pool_size=10, token_manager=None,
+                 scheduler=None):
+        self.base_url = base_url.rstrip("/")
+        self.token_manager = token_manager
+        self.scheduler = scheduler or RequestScheduler()
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.set_token(access_token)
+        self.playback = PlaybackState(self)
+        self.devices = DeviceRegistry(self)
+
+    def set_token(self, access_token):
+        """Podmienia token w domyślnych nagłówkach sesji"""
+        self.access_token = access_token
+        self.session.headers["Authorization"] = f"Bearer {access_token}"
+
+    def url(self, path):
+        """Buduje pełny adres endpointu (ścieżka względna lub pełny URL)"""
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def request(self, method, path, priority=PRIORITY_INTERACTIVE, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        endpoint = self.scheduler.endpoint_key(method, path)
+        token_refreshed = False
+
+        with tracer.span(f"spotify {endpoint}") as span:
+            for attempt in range(SPOTIFY_MAX_RETRIES + 1):
+                if self.token_manager and self.token_manager.access_token != self.access_token:
+                    # Token odświeżony w tle
+                    self.set_token(self.token_manager.access_token)
+
+                self.scheduler.acquire(endpoint, priority)
+                response = self.session.request(method, self.url(path), **kwargs)
+                self.scheduler.record(endpoint, response.status_code)
+                span.set(status=response.status_code, attempts=attempt + 1)
+
+                if response.status_code == 429 and attempt < SPOTIFY_MAX_RETRIES:
+                    if self.scheduler.throttle(endpoint, response.headers.get("Retry-After")):
+                        continue
+                    return response
+
+                if response.status_code == 401 and self.token_manager and not token_refreshed:
+                    # Token wygasł lub został unieważniony - odśwież i ponów raz
+                    print("Token dostępu odrzucony (401) - odświeżam i ponawiam zapytanie...")
+                    self.set_token(self.token_manager.refresh(stale_token=self.access_token))
+                    token_refreshed = True
+                    continue
+
+                return response
+            return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncSpotifyClient:
+    """
+    Asynchroniczny odpowiednik SpotifyClient (httpx.AsyncClient z pulą połączeń).
+
+    Dzieli ze SpotifyClient token, harmonogram zapytań, snapshot odtwarzacza i rejestr urządzeń,
+    więc obie ścieżki widzą ten sam stan i wspólny limit zapytań.
+    """
+
+    def __init__(self, spotify, pool_size=10):
+        self.spotify = spotify
+        self.scheduler = spotify.scheduler
+        self.playback = spotify.playback
+        self.devices = spotify.devices
+        connect_timeout, read_timeout = spotify.timeout
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+
+    async def request(self, method, path, priority=PRIORITY_INTERACTIVE, **kwargs):
+        spotify = self.spotify
+        endpoint = self.scheduler.endpoint_key(method, path)
+        token_refreshed = False
+
+        with tracer.span(f"spotify {endpoint}") as span:
+            for attempt in range(SPOTIFY_MAX_RETRIES + 1):
+                if spotify.token_manager and spotify.token_manager.access_token != spotify.access_token:
+                    # Token odświeżony w tle
+                    spotify.set_token(spotify.token_manager.access_token)
+
+                await self.scheduler.acquire_async(endpoint, priority)
+                response = await self.client.request(
+                    method, spotify.url(path), headers={"Authorization": f"Bearer {spotify.access_token}"},
+                    **kwargs
+                )
+                self.scheduler.record(endpoint, response.status_code)
+                span.set(status=response.status_code, attempts=attempt + 1)
+
+                if response.status_code == 429 and attempt < SPOTIFY_MAX_RETRIES:
+                    if self.scheduler.throttle(endpoint, response.headers.get("Retry-After")):
+                        continue
+                    return response
+
+                if response.status_code == 401 and spotify.token_manager and not token_refreshed:
+                    print("Token dostępu odrzucony (401) - odświeżam i ponawiam zapytanie...")
+                    spotify.set_token(await asyncio.to_thread(spotify.token_manager.refresh, spotify.access_token))
+                    token_refreshed = True
+                    continue
+
+                return response
+            return response
+
+    async def get(self, path, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def put(self, path, **kwargs):
+        return await self.request("PUT", path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request("POST", path, **kwargs)
+
+    async def delete(self, path, **kwargs):
+        return await self.request("DELETE", path, **kwargs)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+# Wspólny snapshot stanu odtwarzacza
+class PlaybackState:
+    """Krótko żyjący (TTL) snapshot /me/player współdzielony przez wszystkie akcje
+
+    Po własnych zapisach (pauza, głośność, shuffle...) snapshot jest aktualizowany lokalnie,
+    więc kolejne akcje nie muszą ponownie pytać API.
+    """
+
+    def __init__(self, spotify, ttl=PLAYER_STATE_TTL):
+        self.spotify = spotify
+        self.ttl = ttl
+        self.data = None  # {} = brak aktywnego odtwarzacza
+        self.fetched_at = 0.0
+        self.lock = threading.Lock()
+
+    async def get_async(self, aspotify):
+        """Zwraca stan odtwarzacza (dict) lub None, gdy nic nie jest aktywne; pobiera przez AsyncSpotifyClient"""
+        fresh, data = self._cached()
+        if fresh:
+            return data
+        return self._store(await aspotify.get("/me/player"))
+
+    def _cached(self):
+        with self.lock:
+            if self.data is not None and time.monotonic() - self.fetched_at < self.ttl:
+                return True, self.data or None
+        return False, None
+
+    def _store(self, response):
+        if response.status_code == 200 and response.content:
+            self.set(response.json())
+        elif response.status_code == 204:
+            self.set({})
+        else:
+            return None
+        return self.data or None
+
+    def set(self, data):
+        """Zapisuje świeży stan (np. z odpowiedzi pollingu)"""
+        with self.lock:
+            self.data = data
+            self.fetched_at = time.monotonic()
+
+    def update(self, **fields):
+        """Nanosi skutki własnego zapisu na snapshot"""
+        with self.lock:
+            if self.data:
+                self.data.update(fields)
+
+    def update_device(self, **fields):
+        with self.lock:
+            if self.data and self.data.get('device'):
+                self.data['device'].update(fields)
+
+    def invalidate(self):
+        with self.lock:
+            self.data = None
+
+
+# Rejestr urządzeń Spotify
+class DeviceRegistry:
+    """Lista urządzeń z /me/player/devices trzymana przez TTL, z ostatnio używanym urządzeniem każdego typu"""
+
+    def __init__(self, spotify, ttl=DEVICE_CACHE_TTL):
+        self.spotify = spotify
+        self.ttl = ttl
+        self.devices = None
+        self.fetched_at = 0.0
+        self.last_used = {}  # typ urządzenia (małe litery) -> urządzenie
+        self.lock = threading.Lock()
+
+    def list(self):
+        """Zwraca listę urządzeń (z cache, jeśli aktualna) lub None przy błędzie API"""
+        with self.lock:
+            if self.devices is not None and time.monotonic() - self.fetched_at < self.ttl:
+                return self.devices
+        return self._store(self.spotify.get("/me/player/devices"))
+
+    async def list_async(self, aspotify):
+        """Jak list(), ale pobiera przez AsyncSpotifyClient"""
+        with self.lock:
+            if self.devices is not None and time.monotonic() - self.fetched_at < self.ttl:
+                return self.devices
+        return self._store(await aspotify.get("/me/player/devices"))
+
+    def _store(self, response):
+        if response.status_code != 200:
+            print(f"Błąd pobierania urządzeń: {response.status_code}")
+            print(response.text)
+            return None
+
+        devices = response.json().get('devices', [])
+        names = ", ".join(f"{d['name']} ({d['type']})" for d in devices)
+        print(f"Znalezione urządzenia: {names or 'brak'}")
+        with self.lock:
+            self.devices = devices
+            self.fetched_at = time.monotonic()
+        return devices
+
+    def invalidate(self):
+        with self.lock:
+            self.devices = None
+
+    def check_response(self, response):
+        """Unieważnia cache, gdy API zgłasza nieznane urządzenie lub brak aktywnego urządzenia"""
+        if response.status_code == 404 or "NO_ACTIVE_DEVICE" in response.text:
+            print("Lista urządzeń jest nieaktualna - odświeżę ją przy następnym zapytaniu.")
+            self.invalidate()
+            return False
+        return True
+
+    # Wybór urządzenia z listy już pobranej przez list_async() - bez blokującego zapytania na pętli zdarzeń
+    @staticmethod
+    def active(devices):
+        return next((d for d in devices if d.get('is_active')), None)
+
+    def find_by_type(self, devices, device_type):
+        """Urządzenie danego typu - ostatnio używane, jeśli nadal jest na liście"""
+        matching = [d for d in devices if d['type'].lower() == device_type.lower()]
+        last = self.last_used.get(device_type.lower())
+        if last:
+            for device in matching:
+                if device['id'] == last['id']:
+                    return device
+        return matching[0] if matching else None
+
+    def preferred(self, devices):
+        """Urządzenie do aktywacji, gdy żadne nie jest aktywne: ostatnio używane lub pierwsze z listy"""
+        ids = {d['id'] for d in devices}
+        for device in reversed(list(self.last_used.values())):
+            if device['id'] in ids:
+                return next(d for d in devices if d['id'] == device['id'])
+        return devices[0] if devices else None
+
+    def mark_used(self, device):
+        """Zapamiętuje urządzenie po udanym przełączeniu i oznacza je lokalnie jako aktywne"""
+        with self.lock:
+            self.last_used.pop(device['type'].lower(), None)
+            self.last_used[device['type'].lower()] = device
+            for cached in self.devices or []:
+                cached['is_active'] = cached['id'] == device['id']
+
+
+# Lokalne rozpoznawanie prostych komend (bez zapytania do GPT)
+def normalize_utterance(text):
+    """Normalizuje wypowiedź: małe litery, bez polskich znaków i interpunkcji"""
+    text = text.lower().replace("ł", "l")
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+# Słowa, które mogą otaczać słowo kluczowe bez zmiany znaczenia komendy
+LOCAL_FILLER_WORDS = frozenset("""
+    prosze please teraz now juz to ta te ten tej ja mi moze mozesz czy could can you would i a the it this that
+    song track piosenka piosenke piosenki utwor utworu kawalek muzyke muzyka muzyki music odtwarzanie playback
+    granie troche odrobine bit little bardziej more jeszcze hej hey ok okej dobra no tam spotify agent
+""".split())
+
+LOCAL_DEVICE_PATTERNS = [
+    ("TV", re.compile(r"\b(?:telewizor\w*|tv|tiwi|televis\w*)\b")),
+    ("Computer", re.compile(r"\b(?:komputer\w*|laptop\w*|pc|computer)\b")),
+    ("Smartphone", re.compile(r"\b(?:telefon\w*|smartfon\w*|smartphone|phone|komork\w*|komorce)\b")),
+]
+
+# "ten album", "ostatnie 5 piosenek" po polub/odlub
+LOCAL_SAVED_TARGET = (
+    r"(?:\s+(?:ten|ta|te|tego|tej|this|the|caly|cala|calego|whole))?\s+(?:(?P<album>album\w*|plyt\w*)"
+    r"|(?:ostatni\w*|last)\s+(?P<count>\d{1,2}|dwa|dwie|trzy|cztery|piec|szesc|siedem|osiem|dziewiec|dziesiec"
+    r"|two|three|four|five|six|seven|eight|nine|ten)(?:\s+(?:piosen\w*|utwor\w*|kawalk\w*|songs|tracks))?)"
+)
+
+LOCAL_NUMBER_WORDS = {
+    "dwa": 2, "dwie": 2, "trzy": 3, "cztery": 4, "piec": 5, "szesc": 6, "siedem": 7, "osiem": 8, "dziewiec": 9,
+    "dziesiec": 10, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8, "nine": 9,
+    "ten": 10,
+}
+
+LOCAL_INTENT_PATTERNS = [
+    ("set_volume", re.compile(
+        r"\b(?:ustaw\w*\s+|set\s+)?(?:glosnosc\w*|volume)\s+(?:na\s+|to\s+|at\s+)?(?P<volume>\d{1,3})"
+        r"(?:\s+(?:procent\w*|percent))?\b")),
+    ("volume_up", re.compile(
+        r"\b(?:glosniej|podglos\w*|zglosn\w*|zwieksz\w*\s+glosnosc|volume\s+up|louder|turn\s+(?:it\s+)?up)"
+        r"(?:\s+(?:o|by)\s+(?P<volume>\d{1,3})(?:\s+(?:procent\w*|percent))?)?\b")),
+    ("volume_down", re.compile(
+        r"\b(?:ciszej|przycisz\w*|scisz\w*|zmniejsz\w*\s+glosnosc|volume\s+down|quieter|turn\s+(?:it\s+)?down)"
+        r"(?:\s+(?:o|by)\s+(?P<volume>\d{1,3})(?:\s+(?:procent\w*|percent))?)?\b")),
+    ("switch_device", re.compile(
+        r"\b(?:(?:przelacz\w*|przerzuc\w*|wlacz|graj|odpal|puszczaj|switch(?:\s+device)?|play|turn\s+on|move)"
+        r"(?:\s+(?:na|do|to|on))?\s+)?(?:na\s+)?(?P<device>\w+)$")),
+    ("unlike", re.compile(
+        r"\b(?:odlub\w*|unlike|usun\w*\s+z\s+(?:ulubionych|polubionych)|remove\s+from\s+(?:favou?rites|liked(?:\s+songs)?))"
+        r"(?:" + LOCAL_SAVED_TARGET + r")?\b")),
+    ("like", re.compile(r"\b(?:polub\w*|like|save|dodaj\s+do\s+ulubionych)" + LOCAL_SAVED_TARGET + r"\b")),
+    ("like", re.compile(
+        r"\b(?:lubie\s+to|podoba\s+mi\s+sie|mi\s+sie\s+podoba|fajna\s+piosenka|dodaj\s+do\s+ulubionych|polub\w*"
+        r"|(?:i\s+)?(?:like|love)|save|add\s+to\s+(?:favou?rites|liked\s+songs)|favou?rite)\b")),
+    ("pause_playback", re.compile(
+        r"\b(?:stop(?:\s+playing)?|pause|zatrzymaj|pauza|pauzuj|wstrzymaj|przestan(?:\s+grac)?)\b")),
+    ("resume_playback", re.compile(
+        r"\b(?:graj\s+dalej|wznow\w*|kontynuuj|resume|continue|play\s+again|graj|play|start)\b")),
+    ("next_song", re.compile(
+        r"\b(?:next(?:\s+one)?|skip|another(?:\s+one)?|nastepn\w*|kolejn\w*|pomin\w*|dalej)\b")),
+]
+
+
+def match_local_intent(user_input):
+    """Rozpoznaje proste komendy lokalnie; zwraca słownik akcji lub None, gdy wypowiedź jest niejednoznaczna"""
+    text = normalize_utterance(user_input)
+    if not text:
+        return None
+
+    for action, pattern in LOCAL_INTENT_PATTERNS:
+        match = pattern.search(text)
+        if not match:
+            continue
+
+        # Pewność tylko wtedy, gdy poza dopasowaniem zostały wyłącznie słowa-wypełniacze
+        rest = (text[:match.start()] + " " + text[match.end():]).split()
+        if any(word not in LOCAL_FILLER_WORDS for word in rest):
+            continue
+
+        if action == "switch_device":
+            device = next((name for name, device_pattern in LOCAL_DEVICE_PATTERNS
+                           if device_pattern.fullmatch(match.group("device"))), None)
+            if not device:
+                continue
+            return {"action": action, "device": device}
+
+        if action in ("like", "unlike"):
+            groups = match.groupdict()
+            if groups.get("album"):
+                return {"action": action, "scope": "album"}
+            if groups.get("count"):
+                count = LOCAL_NUMBER_WORDS.get(groups["count"]) or int(groups["count"])
+                return {"action": action, "scope": "recent", "count": str(count)}
+            return {"action": action}
+
+        if action in ("set_volume", "volume_up", "volume_down"):
+            volume = match.group("volume")
+            if volume is None:
+                if action == "set_volume":
+                    continue
+                volume = "10"
+            if int(volume) > 100:
+                continue
+            return {"action": action, "volume": volume}
+
+        return {"action": action}
+
+    return None
+
+
+# Kanoniczne klucze nastroju/gatunku - różne sformułowania tego samego nastroju trafiają w jeden wpis cache playlist
+MOOD_PATTERNS = [
+    ("hip hop", re.compile(r"\b(?:hip\s*hop\w*|rap\w*)\b")),
+    ("lofi", re.compile(r"\b(?:lo\s*fi)\b")),
+    ("rock", re.compile(r"\b(?:rock\w*|rokow\w*)\b")),
+    ("metal", re.compile(r"\b(?:metal\w*)\b")),
+    ("techno", re.compile(r"\b(?:techno|tekno|house|edm|elektronik\w*|electronic)\b")),
+    ("jazz", re.compile(r"\b(?:jazz\w*|dzez\w*)\b")),
+    ("classical", re.compile(r"\b(?:klasyk\w*|klasyczn\w*|classical|powazn\w*)\b")),
+    ("pop", re.compile(r"\b(?:pop|popow\w*)\b")),
+    ("sleep", re.compile(r"\b(?:spac|spania|sen|snu|zasn\w*|zasyp\w*|usyp\w*|sleep\w*|kolysank\w*)\b")),
+    ("focus", re.compile(r"\b(?:skupi\w*|koncentr\w*|nauk\w*|uczeni\w*|pracy|focus\w*|study\w*|concentrat\w*)\b")),
+    ("party", re.compile(r"\b(?:impre\w*|party|tanc\w*|taniec|potanczyc|dance|dancing|parapet\w*)\b")),
+    ("energetic", re.compile(r"\b(?:energ\w*|pobudz\w*|motywac\w*|trening\w*|silowni\w*|workout|gym|pump\w*)\b")),
+    ("romantic", re.compile(r"\b(?:romant\w*|milos\w*|zakochan\w*|randk\w*|romance)\b")),
+    ("angry", re.compile(r"\b(?:zlos\w*|zly|zla|wsciek\w*|wkurz\w*|nienawidz\w*|angry|mad|rage)\b")),
+    ("sad", re.compile(r"\b(?:smut\w*|dol|dola|dolek|dolka|przygnebi\w*|depres\w*|melanchol\w*|placz\w*|sad|feel\w*\s+down)\b")),
+    ("happy", re.compile(r"\b(?:wesol\w*|radosn\w*|radosc\w*|szczesliw\w*|dobry\s+humor|happy|cheerful)\b")),
+    ("chill", re.compile(r"\b(?:chill\w*|relaks\w*|relax\w*|spokoj\w*|spokojn\w*|wyluz\w*|odpocz\w*|calm)\b")),
+]
+
+
+def mood_key(user_input):
+    """Kanoniczny klucz nastroju lub gatunku (np. "chill", "rock") dla wypowiedzi albo None"""
+    text = normalize_utterance(user_input or "")
+    return next((key for key, pattern in MOOD_PATTERNS if pattern.search(text)), None)
+
+
+# Cache wyników parsowania (ta sama lub prawie ta sama wypowiedź = bez zapytania do GPT)
+class ParseCache:
+    """Ograniczony cache LRU z TTL dla wyników parse_user_input, opcjonalnie zapisywany na dysk"""
+
+    # Akcje, których wynik zależy od pojedynczego słowa (tytuł, nastrój, liczba utworów) - tylko dokładne
+    # trafienia: "puść muzykę popową" jest prawie takie samo jak "puść muzykę rockową"
+    EXACT_ONLY_ACTIONS = ("play_song", "recommendation", "like", "unlike")
+
+    def __init__(self, max_size=PARSE_CACHE_SIZE, ttl=PARSE_CACHE_TTL, similarity=PARSE_CACHE_SIMILARITY, path=None,
+                 save_delay=2.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity = similarity
+        self.path = path
+        self.save_delay = save_delay  # seria put() w tym czasie = jeden zapis pliku
+        self.save_timer = None
+        self.entries = OrderedDict()  # klucz -> (czas zapisu, wynik)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.fuzzy_hits = 0
+        self.misses = 0
+        self.load()
+
+    @staticmethod
+    def token_set_similarity(a, b):
+        tokens_a, tokens_b = set(a.split()), set(b.split())
+        if not tokens_a or not tokens_b:
+            return 0.0
+        return len(tokens_a & tokens_b) / len(tokens_a | tokens_b)
+
+    def _similar(self, a, b):
+        # Różne liczby (np. głośność 30 vs 40) nigdy nie są "prawie takie same"
+        if re.findall(r"\d+", a) != re.findall(r"\d+", b):
+            return 0.0
+        # Różnić mogą się tylko słowa wypełniające: "głośniej" vs "ciszej", "telewizor" vs "telefon"
+        # to inne komendy, choć napisy są prawie identyczne
+        if any(word not in LOCAL_FILLER_WORDS for word in set(a.split()) ^ set(b.split())):
+            return 0.0
+        matcher = SequenceMatcher(None, a, b)
+        if matcher.quick_ratio() < self.similarity and self.token_set_similarity(a, b) < self.similarity:
+            return 0.0
+        return max(matcher.ratio(), self.token_set_similarity(a, b))
+
+    def get(self, user_input):
+        """Zwraca kopię zapamiętanego wyniku lub None"""
+        key = normalize_utterance(user_input)
+        now = time.time()
+        with self.lock:
+            # Usuń przeterminowane wpisy
+            for stale_key in [k for k, (stamp, _) in self.entries.items() if now - stamp > self.ttl]:
+                del self.entries[stale_key]
+
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return dict(self.entries[key][1])
+
+            best_key, best_score = None, self.similarity
+            for candidate, (_, result) in self.entries.items():
+                if result.get("action") in self.EXACT_ONLY_ACTIONS:
+                    continue
+                score = self._similar(key, candidate)
+                if score >= best_score:
+                    best_key, best_score = candidate, score
+
+            if best_key is not None:
+                self.entries.move_to_end(best_key)
+                self.fuzzy_hits += 1
+                return dict(self.entries[best_key][1])
+
+            self.misses += 1
+            return None
+
+    def put(self, user_input, result):
+        key = normalize_utterance(user_input)
+        if not key or not result.get("action"):
+            return
+        with self.lock:
+            self.entries[key] = (time.time(), dict(result))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            if self.path and self.save_timer is None:
+                self.save_timer = threading.Timer(self.save_delay, self.save)
+                self.save_timer.daemon = True
+                self.save_timer.start()
+
+    def stats(self):
+        lookups = self.hits + self.fuzzy_hits + self.misses
+        hit_rate = (self.hits + self.fuzzy_hits) / lookups if lookups else 0.0
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "fuzzy_hits": self.fuzzy_hits,
+            "misses": self.misses,
+            "hit_rate": round(hit_rate, 3),
+        }
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            for key, stamp, result in data[-self.max_size:]:
+                self.entries[key] = (stamp, result)
+        except Exception as e:
+            print(f"Nie udało się wczytać cache parsowania: {e}")
+
+    def save(self):
+        """Zapisuje plik atomowo (plik tymczasowy + os.replace), jak save_tokens"""
+        if not self.path:
+            return
+        with self.lock:
+            if self.save_timer is not None:
+                self.save_timer.cancel()
+                self.save_timer = None
+            data = [[key, stamp, result] for key, (stamp, result) in self.entries.items()]
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        except OSError as e:
+            print(f"Nie udało się zapisać cache parsowania: {e}")
+
+    def flush(self):
+        """Zapisuje od razu, jeśli czeka odłożony zapis (przy zamykaniu programu)"""
+        if self.save_timer is not None:
+            self.save()
+
+
+parse_cache = ParseCache()
+
+
+@traced
 def parse_user_input(user_input):
+    # Szybka ścieżka: proste komendy rozpoznajemy lokalnie, bez zapytania do GPT
+    local_result = match_local_intent(user_input)
+    if local_result:
+        print(f"Komenda rozpoznana lokalnie: {local_result}")
+        tracer.annotate(source="local")
+        return local_result
+
+    cached = parse_cache.get(user_input)
+    if cached is not None:
+        print(f"Komenda z cache parsowania: {cached}")
+        tracer.annotate(source="cache")
+        return cached
+
+    tracer.annotate(source="llm")
+
+    result = parse_structured(user_input) if PARSER_MODE == "structured" else parse_with_llm(user_input)
+    if result is None:
+        # Odpowiedź modelu nie nadaje się do użycia - zgadujemy, ale nie zapamiętujemy zgadywania:
+        # przy następnej próbie model może odpowiedzieć poprawnie
+        tracer.annotate(source="fallback")
+        return fallback_parse(user_input)
+    parse_cache.put(user_input, result)
+    return result
+
+
+class LLMUsage:
+    """Zużycie tokenów i czas odpowiedzi zapytań parsera (do śledzenia kosztu i szybkości)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.latencies = []
+
+    def record(self, response, latency):
+        usage = response.usage
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", 0) or 0
+        with self.lock:
+            self.calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.cached_tokens += cached_tokens
+            self.completion_tokens += completion_tokens
+            self.latencies.append(latency)
+        print(f"LLM {response.model}: {prompt_tokens} tokenów wejścia ({cached_tokens} z cache), "
+              f"{completion_tokens} wyjścia, {latency * 1000:.0f} ms")
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            return {
+                "calls": self.calls,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_tokens,
+                "completion_tokens": self.completion_tokens,
+                "p50_ms": round(latencies[len(latencies) // 2] * 1000) if latencies else None,
+            }
+
+
+llm_usage = LLMUsage()
+
+# Stała część promptu jako pierwsza wiadomość - identyczny prefiks przy każdym zapytaniu (prompt caching)
+PARSER_SYSTEM_PROMPT = """You are the command parser of a Spotify voice assistant. Users speak Polish or English.
+Call spotify_command exactly once with the user's intent:
+- play_song: user wants a specific song; fill song and artist (empty string if not given).
+- next_song: "next", "skip", "another", "następna", "kolejna", "pomiń".
+- pause_playback: "stop", "pause", "zatrzymaj", "pauza", "wstrzymaj". "mute" is NOT a pause command.
+- resume_playback: "resume", "play", "continue", "wznów", "kontynuuj", "graj", "start".
+- recommendation: user describes a mood or emotion, or asks for a genre or kind of music
+  ("play techno", "włącz rock", "mam dziś doła", "chcę coś energicznego", "need calm music").
+  Set mood to one short lowercase English mood or genre key, e.g. chill, energetic, party, sad, happy,
+  focus, sleep, romantic, angry, rock, pop, techno, jazz, hip hop, metal, classical, lofi.
+- switch_device: play on another device; device is TV, Computer or Smartphone
+  ("przełącz na telewizor", "graj na TV", "komputer", "włącz na telefonie").
+- like: save the current song ("lubię to", "podoba mi się", "dodaj do ulubionych", "love this track").
+- unlike: remove from liked songs ("usuń z ulubionych", "odlub", "unlike this").
+  For like/unlike set scope: "track" (current song), "album" (current album) or "recent"
+  (the last count played songs, e.g. "polub ostatnie pięć piosenek" -> count "5").
+- volume_up / volume_down: louder or quieter ("podgłoś trochę", "przycisz", "ciszej"); volume is the change, "10" if not given.
+- set_volume: a specific level ("ustaw głośność na 30"); volume is the level.
+Set fields that do not apply to null."""
+
+PARSER_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "spotify_command",
+        "description": "Structured Spotify command extracted from the user's utterance.",
+        "strict": True,
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "action": {"type": "string", "enum": [
+                    "play_song", "next_song", "pause_playback", "resume_playback", "recommendation",
+                    "switch_device", "like", "unlike", "volume_up", "volume_down", "set_volume",
+                ]},
+                "song": {"type": ["string", "null"]},
+                "artist": {"type": ["string", "null"]},
+                "device": {"type": ["string", "null"], "enum": ["TV", "Computer", "Smartphone", None]},
+                "volume": {"type": ["string", "null"]},
+                "scope": {"type": ["string", "null"], "enum": ["track", "album", "recent", None]},
+                "count": {"type": ["string", "null"]},
+                "mood": {"type": ["string", "null"]},
+            },
+            "required": ["action", "song", "artist", "device", "volume", "scope", "count", "mood"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+@traced
+def parse_structured(user_input, model=PARSER_MODEL):
+    """Parsowanie przez wywołanie funkcji ze schematem JSON (wspólny klient, stały prompt); None przy złej odpowiedzi"""
+    start = time.perf_counter()
+    response = openai.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": PARSER_SYSTEM_PROMPT},
+            {"role": "user", "content": user_input},
+        ],
+        tools=[PARSER_TOOL],
+        tool_choice={"type": "function", "function": {"name": "spotify_command"}},
+        temperature=0,
+    )
+    llm_usage.record(response, time.perf_counter() - start)
+
+    tool_calls = response.choices[0].message.tool_calls
+    try:
+        arguments = json.loads(tool_calls[0].function.arguments)
+    except (TypeError, IndexError, json.JSONDecodeError):
+        print("Model nie zwrócił poprawnego wywołania funkcji - rozpoznaję po słowach kluczowych")
+        return None
+
+    # Ten sam kształt co z parse_with_llm: bez pól, które nie dotyczą akcji
+    result = {key: value for key, value in arguments.items() if value is not None}
+    if result.get("action") == "play_song":
+        result.setdefault("song", "")
+        result.setdefault("artist", "")
+    return result
+
+
+@traced
+def parse_with_llm(user_input):
+    """Parsowanie komendy przez GPT; None, gdy odpowiedź nie jest JSON-em"""
     prompt = f"""
     <rules>
     You are an AI music assistant.
@@ -368,13 +2171,12 @@ def parse_user_input(user_input):
     </examples>
     """
 
-    client = OpenAI(
-        api_key=openai.api_key)
-
-    response = client.chat.completions.create(
+    start = time.perf_counter()
+    response = openai.chat.completions.create(
         model="gpt-4",
         messages=[{"role": "user", "content": prompt}]
     )
+    llm_usage.record(response, time.perf_counter() - start)
 
     try:
         # Bezpieczniejsza metoda niż eval()
@@ -393,914 +2195,1495 @@ def parse_user_input(user_input):
             except:
                 pass
 
-        # Sprawdź czy komenda dotyczy następnej piosenki
-        if any(keyword in user_input.lower() for keyword in ["następny", "następna", "next", "skip", "pomiń", "dalej"]):
-            return {"action": "next_song"}
+        return None
 
-        elif any(keyword in user_input.lower() for keyword in
-                 ["stop", "pause", "zatrzymaj", "pauza", "wstrzymaj", "przestań"]):
-            return {"action": "pause_playback"}
 
-        # A w sekcji obsługi błędów JSONDecodeError, po warunkach dla next i pause:
-        elif any(keyword in user_input.lower() for keyword in
-                 ["resume", "play", "wznów", "kontynuuj", "graj", "start", "continue"]):
-            return {"action": "resume_playback"}
+def fallback_parse(user_input):
+    """Awaryjne rozpoznanie po słowach kluczowych, gdy odpowiedź modelu nie nadaje się do użycia"""
+    # Sprawdź czy komenda dotyczy następnej piosenki
+    if any(keyword in user_input.lower() for keyword in ["następny", "następna", "next", "skip", "pomiń", "dalej"]):
+        return {"action": "next_song"}
 
-        elif any(keyword in user_input.lower() for keyword in
-                 ["podoba mi się", "like", "lubię to", "fajna piosenka", "dodaj do ulubionych", "polub"]):
-            return {"action": "like"}
+    elif any(keyword in user_input.lower() for keyword in
+             ["stop", "pause", "zatrzymaj", "pauza", "wstrzymaj", "przestań"]):
+        return {"action": "pause_playback"}
 
-        # Domyślna odpowiedź jeśli nie udało się sparsować
-        return {"action": "play_song", "song": user_input, "artist": ""}
+    elif any(keyword in user_input.lower() for keyword in
+             ["resume", "play", "wznów", "kontynuuj", "graj", "start", "continue"]):
+        return {"action": "resume_playback"}
 
+    elif any(keyword in user_input.lower() for keyword in
+             ["podoba mi się", "like", "lubię to", "fajna piosenka", "dodaj do ulubionych", "polub"]):
+        return {"action": "like"}
 
-def search_and_play_playlist(mood_input, access_token, voice_agent=None):
-    try:
-        headers = {
-            "Authorization": f"Bearer {access_token}"
-        }
+    # Domyślna odpowiedź jeśli nie udało się sparsować
+    return {"action": "play_song", "song": user_input, "artist": ""}
 
-        # 1. Search playlist by mood_input
-        search_url = "https://api.spotify.com/v1/search"
-        params = {
-            "q": mood_input,
-            "type": "playlist",
-            "limit": 5
-        }
 
-        response = requests.get(search_url, headers=headers, params=params)
+# Zadania w tle na pętli zdarzeń (odświeżanie cache) - trzymamy referencje, aż się zakończą
+background_tasks = set()
 
-        if response.status_code != 200:
-            print(f"Błąd wyszukiwania playlisty: {response.status_code}")
-            print(response.text)
-            if voice_agent:
-                voice_agent.speak("Nie udało się wyszukać playlisty.")
-            return False
 
-        playlists_data = response.json()
-        playlists = playlists_data.get("playlists", {}).get("items", [])
-
-        # 2. Filter playlists owned by Spotify
-        selected_playlist = None
-        # for playlist in playlists:
-        #     owner = playlist.get("owner", {}).get("display_name", "").lower()
-        #     name = playlist.get("name", "").lower()
-        #     if "spotify" in owner:
-        #         selected_playlist = playlist
-        #         break
-
-        # 3. If no playlist from Spotify, pick any available
-        if not selected_playlist and playlists:
-            selected_playlist = playlists[0]
-
-        if not selected_playlist:
-            print("Nie znaleziono pasującej playlisty.")
-            if voice_agent:
-                voice_agent.speak("Nie znalazłem żadnej playlisty pasującej do Twojego nastroju.")
-            return False
+def run_in_background(coro):
+    """Uruchamia korutynę bez czekania na wynik; błąd jest tylko wypisywany"""
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_background_done)
+    return task
 
-        playlist_id = selected_playlist["id"]
-        playlist_name = selected_playlist["name"]
-        context_uri = selected_playlist["uri"]
 
-        response_text = f"Dodaję playlistę {playlist_name}."
-        print(response_text)
-        if voice_agent:
-            voice_agent.speak(response_text)
+def _background_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        print(f"Błąd zadania w tle: {task.exception()}")
 
-        # # 4. Play playlsit
-        play_url = "https://api.spotify.com/v1/me/player/play"
-        payload = {
-            "context_uri": context_uri
-        }
-
-        play_response = requests.put(play_url, headers=headers, json=payload)
-
-        if play_response.status_code not in [200, 204]:
-            print(f"Błąd odtwarzania playlisty: {play_response.status_code}")
-            print(play_response.text)
-            if voice_agent:
-                voice_agent.speak("Nie udało się odtworzyć playlisty.")
-            return False
-
-        print(f"✅ Playlistę '{playlist_name}' rozpoczęto pomyślnie!")
-        return True
-
-        # # 4. Get tracks from playlist
-        # tracks_url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
-        # tracks_response = requests.get(tracks_url, headers=headers)
-        #
-        # if tracks_response.status_code != 200:
-        #     print(f"Błąd pobierania utworów z playlisty: {tracks_response.status_code}")
-        #     print(tracks_response.text)
-        #     if voice_agent:
-        #         voice_agent.speak("Nie udało się pobrać utworów z playlisty.")
-        #     return False
-        #
-        # tracks_data = tracks_response.json()
-        # tracks = tracks_data.get("items", [])
-        #
-        # if not tracks:
-        #     print("Brak utworów w playliście.")
-        #     if voice_agent:
-        #         voice_agent.speak("Nie znalazłem utworów w tej playliście.")
-        #     return False
-        #
-        # # 5. Add all tracks to queue
-        # for track_info in tracks:
-        #     track = track_info.get("track")
-        #     if not track:
-        #         continue
-        #     track_uri = track.get("uri")
-        #     if not track_uri:
-        #         continue
-        #
-        #     queue_url = "https://api.spotify.com/v1/me/player/queue"
-        #     queue_params = {"uri": track_uri}
-        #     queue_response = requests.post(queue_url, headers=headers, params=queue_params)
-        #     if queue_response.status_code not in [200, 204]:
-        #         print(f"Błąd dodawania do kolejki: {queue_response.status_code}")
-        #         print(queue_response.text)
-        #
-        # # 6. Play the first track
-        # first_track = tracks[0].get("track")
-        # if first_track:
-        #     first_track_uri = first_track.get("uri")
-        #     if first_track_uri:
-        #         play_url = "https://api.spotify.com/v1/me/player/play"
-        #         play_response = requests.put(play_url, headers=headers, json={"uris": [first_track_uri]})
-        #         if play_response.status_code in [200, 204]:
-        #             if voice_agent:
-        #                 voice_agent.speak(f"Rozpoczynam odtwarzanie playlisty {playlist_name}.")
-        #             return True
-        #         else:
-        #             print(f"Błąd odtwarzania utworu: {play_response.status_code}")
-        #             print(play_response.text)
-        #             if voice_agent:
-        #                 voice_agent.speak("Nie udało się rozpocząć odtwarzania playlisty.")
-        #             return False
 
+async def async_fetch_playlists(query, aspotify, priority=PRIORITY_INTERACTIVE, cache=True):
+    """Wyszukanie playlist w API (z zapisem do cache nastrojów); None przy błędzie"""
+    response = await aspotify.get("/search", params={"q": query, "type": "playlist", "limit": 5},
+                                  priority=priority)
+    if response.status_code != 200:
+        print(f"Błąd wyszukiwania playlisty: {response.status_code}")
+        return None
+    return store_playlists(query, response.json(), cache)
 
 
-    except Exception as e:
-        print(f"Wystąpił błąd: {e}")
-        import traceback
-        traceback.print_exc()
-        if voice_agent:
-            voice_agent.speak("Wystąpił błąd podczas odtwarzania playlisty.")
-        return False
+def store_playlists(query, data, cache=True):
+    """ID, nazwa i URI znalezionych playlist; niepusta lista trafia do cache nastrojów"""
+    playlists = [
+        {"id": p["id"], "name": p["name"], "uri": p["uri"]}
+        for p in data.get("playlists", {}).get("items", []) if p
+    ]
+    if cache and playlists:
+        mood_cache.put(mood_cache.key(query), playlists)
+    return playlists
 
 
-def pause_playback(access_token):
-    """Zatrzymanie odtwarzania"""
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
+def playing_track_id(state):
+    """ID utworu ze stanu odtwarzacza (lub None)"""
+    item = (state or {}).get('item')
+    return item['id'] if item else None
 
-    # Pobierz aktualnie odtwarzany utwór (do wyświetlenia informacji)
-    current_playing_url = "https://api.spotify.com/v1/me/player/currently-playing"
-    current_response = requests.get(current_playing_url, headers=headers)
 
-    if current_response.status_code == 200 and current_response.content:
-        current_data = current_response.json()
-        if current_data.get('item'):
-            current_track_name = current_data['item']['name']
-            current_artist_name = current_data['item']['artists'][0]['name']
+class SearchCache:
+    """
+    Trwały (SQLite) cache wyników wyszukiwania: znormalizowany klucz zapytania -> wynik (JSON).
 
-            # Wywołaj endpoint pause
-            pause_url = "https://api.spotify.com/v1/me/player/pause"
-            response = requests.put(pause_url, headers=headers)
+    Wpis starszy niż TTL jest nadal zwracany, ale oznaczony do odświeżenia w tle.
+    Rozmiar ograniczony - usuwane są najdawniej używane wpisy. Czas użycia przy trafieniu trafia
+    do bazy hurtem (przy put() lub flush()), żeby odczyt nie kosztował zapisu na dysk.
+    """
 
-            print(f"Status zatrzymania odtwarzania: {response.status_code}")
+    def __init__(self, path=SEARCH_CACHE_FILE, max_size=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL, table="search_cache"):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.table = table
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.used = {}  # klucz -> czas trafienia, jeszcze niezapisany
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "query TEXT PRIMARY KEY, track TEXT NOT NULL, fetched_at REAL NOT NULL, used_at REAL NOT NULL)"
+        )
+        self.db.execute(f"CREATE INDEX IF NOT EXISTS {table}_used_at ON {table} (used_at)")
+        self.db.commit()
+
+    @staticmethod
+    def key(*parts):
+        return "|".join(normalize_utterance(part or '') for part in parts)
+
+    def get(self, key):
+        """Zwraca (wynik, aktualny) albo None"""
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(f"SELECT track, fetched_at FROM {self.table} WHERE query = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.used[key] = now
+            fresh = now - row[1] < self.ttl
+            if fresh:
+                self.hits += 1
+            else:
+                self.stale_hits += 1
+        return json.loads(row[0]), fresh
+
+    def put(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                f"INSERT OR REPLACE INTO {self.table} (query, track, fetched_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now, now)
+            )
+            self.used.pop(key, None)
+            self._write_used()
+            excess = self.db.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0] - self.max_size
+            if excess > 0:
+                self.db.execute(
+                    f"DELETE FROM {self.table} WHERE query IN "
+                    f"(SELECT query FROM {self.table} ORDER BY used_at LIMIT ?)", (excess,)
+                )
+            self.db.commit()
+
+    def _write_used(self):
+        """Zapisuje odłożone czasy trafień (przed usuwaniem najdawniej używanych); wywoływane pod self.lock"""
+        if self.used:
+            self.db.executemany(f"UPDATE {self.table} SET used_at = ? WHERE query = ?",
+                                [(used_at, key) for key, used_at in self.used.items()])
+            self.used.clear()
+
+    def flush(self):
+        with self.lock:
+            self._write_used()
+            self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            size = self.db.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        return {"size": size, "hits": self.hits, "stale_hits": self.stale_hits, "misses": self.misses}
+
+
+# Przy imporcie tylko w pamięci (bez plików w bieżącym katalogu); main() otwiera pliki przez open_caches()
+search_cache = SearchCache(path=":memory:")
+# Nastrój/gatunek -> lista playlist; ten sam plik bazy, osobna tabela
+mood_cache = SearchCache(path=":memory:", max_size=MOOD_CACHE_SIZE, ttl=MOOD_CACHE_TTL, table="mood_playlists")
+
+
+class LibraryIndex:
+    """
+    Lokalny indeks (SQLite FTS5) polubionych utworów oraz obserwowanych playlist i ich utworów.
 
-            return {
-                "success": response.status_code in [200, 204],
-                "paused_track": f"{current_track_name} - {current_artist_name}"
-            }
+    sync() pobiera dane stronami i przyrostowo: polubione tylko do ostatnio znanego, playlisty tylko
+    przy zmienionym snapshot_id. find_track() i find_playlist() rozwiązują nazwy bez wyszukiwarki Spotify.
+    """
 
-    return {
-        "success": False,
-        "paused_track": "Brak odtwarzanego utworu"
-    }
+    # Słowa, które nie opisują utworu ("ten utwór Weeknda, który polubiłem")
+    # Słowa funkcyjne: w nazwach playlist są wszędzie ("Coś na lato"), więc nie mogą decydować o dopasowaniu
+    # zapytania do playlisty; w tytułach utworów bywają całym tytułem ("Something"), więc find_track je zostawia
+    FUNCTION_WORDS = frozenset("""
+        cos czegos czyms jakis jakas jakies jakiegos jakiejs na do dla mnie mojej moj moja moje w we z ze o po
+        przy pod nad za u bez lub albo oraz sie jak co taki takie takiej something some any anything for of in
+        on at with my me an and or from
+    """.split())
+    STOP_WORDS = LOCAL_FILLER_WORDS | FUNCTION_WORDS | frozenset("""
+        zagraj pusc wlacz odpal graj play by od przez that which ktory ktora polubilem polubilam polubiony
+        polubiona ulubiony ulubiona liked saved playlista playliste playlisty playlist
+    """.split())
+    TRACK_STOP_WORDS = STOP_WORDS - FUNCTION_WORDS
+    PLAYLIST_MATCH = 0.5  # część słów treści zapytania, które muszą wystąpić w nazwie playlisty
+
+    def __init__(self, path=LIBRARY_INDEX_FILE):
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reauthorized = False  # ponowna autoryzacja po 403 najwyżej raz na sesję
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS tracks (
+                id TEXT PRIMARY KEY, name TEXT NOT NULL, artist_name TEXT NOT NULL, artist_id TEXT,
+                saved_at TEXT
+            );
+            CREATE TABLE IF NOT EXISTS playlists (
+                id TEXT PRIMARY KEY, name TEXT NOT NULL, uri TEXT NOT NULL, snapshot_id TEXT
+            );
+            CREATE TABLE IF NOT EXISTS playlist_tracks (
+                playlist_id TEXT NOT NULL, track_id TEXT NOT NULL, position INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS playlist_tracks_playlist ON playlist_tracks (playlist_id);
+            CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(text);
+            CREATE VIRTUAL TABLE IF NOT EXISTS playlists_fts USING fts5(text);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+        self.db.commit()
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'synced_at'").fetchone()
+        # Bez udanej synchronizacji nie wiemy, czego NIE ma w polubionych
+        self.synced = row is not None
+
+    def _tokens(self, text, stop_words=None):
+        stop_words = self.STOP_WORDS if stop_words is None else stop_words
+        return [word for word in normalize_utterance(text or "").split() if word not in stop_words]
+
+    # --- synchronizacja ---
+
+    @staticmethod
+    def _pages(spotify, path, params):
+        """Kolejne strony odpowiedzi (pole "next" z pełnym adresem następnej strony)"""
+        url = path
+        while url:
+            response = spotify.get(url, params=params, priority=PRIORITY_BACKGROUND)
+            if response.status_code == 403 and path.startswith("/me/"):
+                raise PermissionError(f"Brak uprawnień do {path} - token bez zakresów biblioteki/playlist")
+            if response.status_code != 200:
+                raise Exception(f"Błąd API Spotify ({path}): {response.status_code}")
+            page = response.json()
+            yield page
+            url, params = page.get('next'), None
+
+    def _store_track(self, track, saved_at=None):
+        if not track or not track.get('id'):
+            return  # pliki lokalne i usunięte utwory nie mają ID
+        cursor = self.db.execute(
+            "INSERT OR IGNORE INTO tracks (id, name, artist_name, artist_id, saved_at) VALUES (?, ?, ?, ?, ?)",
+            (track['id'], track['name'], track['artists'][0]['name'], track['artists'][0]['id'], saved_at)
+        )
+        if cursor.rowcount:
+            text = normalize_utterance(f"{track['name']} {track['artists'][0]['name']}")
+            self.db.execute("INSERT INTO tracks_fts (rowid, text) VALUES (?, ?)", (cursor.lastrowid, text))
+        elif saved_at:
+            self.db.execute("UPDATE tracks SET saved_at = ? WHERE id = ?", (saved_at, track['id']))
+
+    def _sync_saved_tracks(self, spotify, since=None):
+        """Pobiera polubione od najnowszych aż do daty since; zwraca (liczba stron, total z API)"""
+        pages, total = 0, None
+        for page in self._pages(spotify, "/me/tracks", {"limit": 50}):
+            pages += 1
+            total = page.get('total')
+            reached = False
+            with self.lock:
+                for item in page.get('items', []):
+                    if since and item['added_at'] <= since:
+                        reached = True
+                        break
+                    self._store_track(item.get('track'), item['added_at'])
+                self.db.commit()
+            if reached:
+                break
+        return pages, total
+
+    def _sync_playlists(self, spotify):
+        """Pobiera listę playlist i utwory tylko tych, których snapshot_id się zmienił; zwraca liczbę stron"""
+        pages = 0
+        remote = {}
+        for page in self._pages(spotify, "/me/playlists", {"limit": 50}):
+            pages += 1
+            remote.update((p['id'], p) for p in page.get('items', []) if p)
+
+        with self.lock:
+            local = dict(self.db.execute("SELECT id, snapshot_id FROM playlists"))
+            for playlist_id in set(local) - set(remote):
+                self._delete_playlist(playlist_id)
+            self.db.commit()
+
+        for playlist_id, playlist in remote.items():
+            if playlist.get('snapshot_id') and local.get(playlist_id) == playlist['snapshot_id']:
+                continue
+            tracks = []
+            for page in self._pages(spotify, f"/playlists/{playlist_id}/tracks",
+                                    {"limit": 100, "fields": "items(track(id,name,artists(id,name))),next"}):
+                pages += 1
+                tracks.extend(item.get('track') for item in page.get('items', []))
+
+            with self.lock:
+                self._delete_playlist(playlist_id)
+                cursor = self.db.execute(
+                    "INSERT INTO playlists (id, name, uri, snapshot_id) VALUES (?, ?, ?, ?)",
+                    (playlist_id, playlist['name'], playlist['uri'], playlist.get('snapshot_id'))
+                )
+                self.db.execute("INSERT INTO playlists_fts (rowid, text) VALUES (?, ?)",
+                                (cursor.lastrowid, normalize_utterance(playlist['name'])))
+                for position, track in enumerate(tracks):
+                    self._store_track(track)
+                    if track and track.get('id'):
+                        self.db.execute(
+                            "INSERT INTO playlist_tracks (playlist_id, track_id, position) VALUES (?, ?, ?)",
+                            (playlist_id, track['id'], position)
+                        )
+                self.db.commit()
+        return pages
+
+    def _delete_playlist(self, playlist_id):
+        row = self.db.execute("SELECT rowid FROM playlists WHERE id = ?", (playlist_id,)).fetchone()
+        if row:
+            self.db.execute("DELETE FROM playlists_fts WHERE rowid = ?", row)
+        self.db.execute("DELETE FROM playlists WHERE id = ?", (playlist_id,))
+        self.db.execute("DELETE FROM playlist_tracks WHERE playlist_id = ?", (playlist_id,))
+
+    def sync(self, spotify):
+        """
+        Przyrostowa synchronizacja z API (w tle); równoległe wywołania są pomijane.
+
+        403 oznacza token sprzed dodania zakresów user-library-read/playlist-read-* - wtedy
+        raz prosimy o ponowną autoryzację i próbujemy jeszcze raz.
+        """
+        if not self.sync_lock.acquire(blocking=False):
+            return
+        try:
+            try:
+                self._sync(spotify)
+            except PermissionError as e:
+                print(f"{e}. Potrzebna ponowna autoryzacja Spotify.")
+                if not spotify.token_manager or self.reauthorized:
+                    print(f"Usuń {TOKEN_FILE} i uruchom asystenta ponownie, aby nadać brakujące uprawnienia.")
+                    return
+                self.reauthorized = True
+                if spotify.token_manager.reauthorize():
+                    self._sync(spotify)
+        except Exception as e:
+            print(f"Błąd synchronizacji biblioteki: {e}")
+        finally:
+            self.sync_lock.release()
+
+    def _sync(self, spotify):
+        """Polubione (przyrostowo) i zmienione playlisty; PermissionError przy braku zakresów"""
+        start = time.perf_counter()
+        with self.lock:
+            since = self.db.execute("SELECT MAX(saved_at) FROM tracks").fetchone()[0]
+        pages, total = self._sync_saved_tracks(spotify, since)
+
+        with self.lock:
+            saved = self.db.execute("SELECT COUNT(saved_at) FROM tracks").fetchone()[0]
+        if total is not None and saved != total:
+            # Usunięte polubienia nie zmieniają najnowszej daty - liczba się nie zgadza, pobieramy całość
+            with self.lock:
+                self.db.execute("UPDATE tracks SET saved_at = NULL")
+                self.db.commit()
+            pages += self._sync_saved_tracks(spotify)[0]
+
+        pages += self._sync_playlists(spotify)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('synced_at', ?)", (str(time.time()),))
+            self.db.commit()
+        self.synced = True
+        print(f"Indeks biblioteki zsynchronizowany ({pages} zapytań, "
+              f"{time.perf_counter() - start:.1f} s): {self.stats()}")
+
+    # --- polubione ---
+
+    def saved_ids(self, track_ids):
+        """Które z podanych utworów są polubione (zbiór ID) albo None, gdy indeks nie był synchronizowany"""
+        if not self.synced:
+            return None
+        track_ids = list(track_ids)
+        with self.lock:
+            saved = set()
+            for start in range(0, len(track_ids), 500):
+                chunk = track_ids[start:start + 500]
+                rows = self.db.execute(
+                    f"SELECT id FROM tracks WHERE saved_at IS NOT NULL AND id IN ({','.join('?' * len(chunk))})",
+                    chunk
+                )
+                saved.update(row[0] for row in rows)
+        return saved
+
+    def mark_saved(self, tracks, saved=True):
+        """Zapisuje lokalnie wynik polubienia/odlubienia (obiekty utworów z API)"""
+        added_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        with self.lock:
+            for track in tracks:
+                if saved:
+                    self._store_track(track, added_at)
+                else:
+                    self.db.execute("UPDATE tracks SET saved_at = NULL WHERE id = ?", (track['id'],))
+            self.db.commit()
+
+    # --- wyszukiwanie ---
+
+    def find_track(self, song, artist):
+        """Utwór z biblioteki pasujący do tytułu i wykonawcy (słownik jak search_track) albo None"""
+        song_tokens = self._tokens(song, self.TRACK_STOP_WORDS)
+        artist_tokens = self._tokens(artist, self.TRACK_STOP_WORDS)
+        tokens = song_tokens + artist_tokens
+        if not tokens:
+            return None
+
+        query = " ".join(f'"{token}"*' for token in tokens)
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT t.id, t.name, t.artist_name, t.artist_id, t.saved_at FROM tracks_fts "
+                "JOIN tracks t ON t.rowid = tracks_fts.rowid WHERE tracks_fts MATCH ? "
+                "ORDER BY bm25(tracks_fts) LIMIT 20", (query,)
+            ).fetchall()
+        candidates = [dict(id=row[0], name=row[1], artist_name=row[2], artist_id=row[3]) for row in rows]
+
+        if song_tokens:
+            track = match_speculative_track({"song": song, "artist": artist}, candidates)
+        else:
+            # Sam wykonawca ("ten utwór Weeknda, który polubiłem") - ostatnio polubiony
+            saved = sorted((row for row in rows if row[4]), key=lambda row: row[4], reverse=True)
+            track = next((c for c in candidates if saved and c['id'] == saved[0][0]), None)
 
+        if track:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return track
+
+    def find_playlist(self, text):
+        """Playlista z biblioteki, której nazwa zawiera większość słów treści zapytania, albo None"""
+        tokens = self._tokens(text)
+        if not tokens:
+            return None
+
+        query = " OR ".join(f'"{token}"*' for token in tokens)
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT p.id, p.name, p.uri FROM playlists_fts JOIN playlists p ON p.rowid = playlists_fts.rowid "
+                "WHERE playlists_fts MATCH ? ORDER BY bm25(playlists_fts) LIMIT 5", (query,)
+            ).fetchall()
+
+        for playlist_id, name, uri in rows:
+            name_tokens = normalize_utterance(name).split()
+            matched = sum(any(word.startswith(token) for word in name_tokens) for token in tokens)
+            if matched and matched / len(tokens) >= self.PLAYLIST_MATCH:
+                self.hits += 1
+                return {"id": playlist_id, "name": name, "uri": uri}
+        self.misses += 1
+        return None
 
-def resume_playback(access_token):
-    """Wznowienie odtwarzania"""
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
+    def stats(self):
+        with self.lock:
+            tracks, saved = self.db.execute("SELECT COUNT(*), COUNT(saved_at) FROM tracks").fetchone()
+            playlists = self.db.execute("SELECT COUNT(*) FROM playlists").fetchone()[0]
+        return {"tracks": tracks, "saved": saved, "playlists": playlists, "hits": self.hits, "misses": self.misses}
 
-    # Pobierz aktualnie zapauzowany utwór (do wyświetlenia informacji)
-    current_playing_url = "https://api.spotify.com/v1/me/player/currently-playing"
-    current_response = requests.get(current_playing_url, headers=headers)
 
-    current_track_name = "nieznany utwór"
-    current_artist_name = "nieznany artysta"
+library = LibraryIndex(path=":memory:")
 
-    if current_response.status_code == 200 and current_response.content:
-        current_data = current_response.json()
-        if current_data.get('item'):
-            current_track_name = current_data['item']['name']
-            current_artist_name = current_data['item']['artists'][0]['name']
 
-    # Wywołaj endpoint play
-    resume_url = "https://api.spotify.com/v1/me/player/play"
-    response = requests.put(resume_url, headers=headers)
+def open_caches():
+    """Zastępuje caches i indeks biblioteki z importu wersjami w plikach (puste nazwy plików = w pamięci)"""
+    global parse_cache, search_cache, mood_cache, library
+    parse_cache = ParseCache(path=PARSE_CACHE_FILE or None)
+    search_cache = SearchCache(path=SEARCH_CACHE_FILE or ":memory:")
+    mood_cache = SearchCache(path=SEARCH_CACHE_FILE or ":memory:", max_size=MOOD_CACHE_SIZE, ttl=MOOD_CACHE_TTL,
+                             table="mood_playlists")
+    library = LibraryIndex(path=LIBRARY_INDEX_FILE or ":memory:")
 
-    print(f"Status wznowienia odtwarzania: {response.status_code}")
 
-    return {
-        "success": response.status_code in [200, 204],
-        "resumed_track": f"{current_track_name} - {current_artist_name}"
-    }
+# Operacje na Spotify (AsyncSpotifyClient): niezależne zapytania jednej komendy wysyłane razem
+async def async_wait_for_player_state(aspotify, predicate, timeout=PLAYER_POLL_TIMEOUT, interval=0.1,
+                                      max_interval=0.5, backoff=1.5):
+    """
+    Czeka, aż stan odtwarzacza spełni warunek, zamiast stałego odczekiwania.
 
+    Odpytuje /me/player co coraz dłuższy odstęp (od interval do max_interval) aż do upływu timeout.
+    Każdy pobrany stan trafia do wspólnego snapshotu aspotify.playback.
+    Zwraca stan spełniający predicate albo None, jeśli w tym czasie się nie pojawił.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        response = await aspotify.get("/me/player")
+        if response.status_code == 200 and response.content:
+            state = response.json()
+            aspotify.playback.set(state)
+            if predicate(state):
+                return state
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        await asyncio.sleep(min(interval, remaining))
+        interval = min(interval * backoff, max_interval)
+
+
+def track_label(state):
+    """"Tytuł - wykonawca" ze stanu odtwarzacza (lub None)"""
+    item = (state or {}).get('item')
+    return f"{item['name']} - {item['artists'][0]['name']}" if item else None
+
+
+@traced
+async def async_pause_playback(aspotify):
+    current_data = await aspotify.playback.get_async(aspotify)
+    if not track_label(current_data):
+        return {"success": False, "paused_track": "Brak odtwarzanego utworu"}
+
+    success = True
+    if current_data.get('is_playing'):
+        response = await aspotify.put("/me/player/pause")
+        print(f"Status zatrzymania odtwarzania: {response.status_code}")
+        success = response.status_code in [200, 204]
+        if success:
+            aspotify.playback.update(is_playing=False)
+    else:
+        print("Odtwarzanie jest już zatrzymane - pomijam zapytanie.")
+    return {"success": success, "paused_track": track_label(current_data)}
 
-def next_song(access_token):
-    """Przejście do następnego utworu"""
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
 
-    # Pobierz aktualnie odtwarzany utwór (do wyświetlenia informacji)
-    current_playing_url = "https://api.spotify.com/v1/me/player/currently-playing"
-    current_response = requests.get(current_playing_url, headers=headers)
+@traced
+async def async_resume_playback(aspotify):
+    current_data = await aspotify.playback.get_async(aspotify)
 
-    current_track_name = "nieznany utwór"
-    current_artist_name = "nieznany artysta"
+    success = True
+    if current_data and current_data.get('is_playing'):
+        print("Odtwarzanie już trwa - pomijam zapytanie.")
+    else:
+        response = await aspotify.put("/me/player/play")
+        print(f"Status wznowienia odtwarzania: {response.status_code}")
+        success = response.status_code in [200, 204]
+        if success:
+            aspotify.playback.update(is_playing=True)
+    return {"success": success, "resumed_track": track_label(current_data) or "nieznany utwór - nieznany artysta"}
 
-    if current_response.status_code == 200 and current_response.content:
-        current_data = current_response.json()
-        if current_data.get('item'):
-            current_track_name = current_data['item']['name']
-            current_artist_name = current_data['item']['artists'][0]['name']
 
-    # Wywołaj endpoint next
-    next_url = "https://api.spotify.com/v1/me/player/next"
-    response = requests.post(next_url, headers=headers)
+@traced
+async def async_next_song(aspotify):
+    current_data = await aspotify.playback.get_async(aspotify)
+    current_track_id = playing_track_id(current_data)
 
+    response = await aspotify.post("/me/player/next")
+    aspotify.playback.invalidate()
     print(f"Status przejścia do następnego utworu: {response.status_code}")
+    previous_track = track_label(current_data) or "nieznany utwór - nieznany artysta"
+    if response.status_code not in [200, 204]:
+        # Nieudane przełączenie - nie ma na co czekać
+        return {"success": False, "previous_track": previous_track, "current_track": previous_track}
+
+    new_data = await async_wait_for_player_state(
+        aspotify,
+        lambda state: playing_track_id(state) not in (None, current_track_id)
+    )
+    return {
+        "success": True,
+        "previous_track": previous_track,
+        "current_track": track_label(new_data) or "nieznany utwór - nieznany artysta"
+    }
 
-    # Poczekaj chwilę, aby Spotify zaktualizował informacje o odtwarzaniu
-    time.sleep(1)
-
-    # Pobierz informacje o nowym utworze
-    new_response = requests.get(current_playing_url, headers=headers)
-
-    new_track_name = "nieznany utwór"
-    new_artist_name = "nieznany artysta"
 
-    if new_response.status_code == 200 and new_response.content:
-        new_data = new_response.json()
-        if new_data.get('item'):
-            new_track_name = new_data['item']['name']
-            new_artist_name = new_data['item']['artists'][0]['name']
+@traced
+async def async_search_track(song, artist, aspotify):
+    """Utwór (słownik z ID, nazwą i wykonawcą): indeks biblioteki, cache wyszukiwania, a na końcu API"""
+    local = library.find_track(song, artist)
+    if local:
+        print(f"Utwór z biblioteki: {local['name']} - {local['artist_name']} (ID: {local['id']})")
+        return local
 
-    return {
-        "success": response.status_code in [200, 204],
-        "previous_track": f"{current_track_name} - {current_artist_name}",
-        "current_track": f"{new_track_name} - {new_artist_name}"
-    }
+    cached = search_cache.get(search_cache.key(song, artist))
+    if cached:
+        track, fresh = cached
+        print(f"Utwór z cache wyszukiwania: {track['name']} - {track['artist_name']} (ID: {track['id']})")
+        if not fresh:
+            run_in_background(async_fetch_track(song, artist, aspotify, PRIORITY_BACKGROUND))
+        return track
+    return await async_fetch_track(song, artist, aspotify)
 
 
-def search_song(song, artist, access_token):
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
+async def async_fetch_track(song, artist, aspotify, priority=PRIORITY_INTERACTIVE):
+    """Wyszukanie utworu w API (z zapisem do cache wyszukiwania)"""
     query = f"{song} {artist}"
     print(f"Wyszukiwanie: {query}")
-
-    response = requests.get(
-        f"https://api.spotify.com/v1/search",
-        headers=headers,
-        params={"q": query, "type": "track", "limit": 1}
-    )
-
+    response = await aspotify.get("/search", params={"q": query, "type": "track", "limit": 1}, priority=priority)
     if response.status_code != 200:
         print(f"Błąd wyszukiwania: {response.status_code}")
-        print(response.text)
         raise Exception(f"Błąd API Spotify: {response.status_code}")
 
-    data = response.json()
-
-    if not data['tracks']['items']:
+    items = response.json()['tracks']['items']
+    if not items:
         raise Exception(f"Nie znaleziono utworu: {song} {artist}")
 
-    track_id = data['tracks']['items'][0]['id']
-    track_name = data['tracks']['items'][0]['name']
-    artist_name = data['tracks']['items'][0]['artists'][0]['name']
-    print(f"Znaleziono utwór: {track_name} - {artist_name} (ID: {track_id})")
+    track = track_summary(items[0])
+    print(f"Znaleziono utwór: {track['name']} - {track['artist_name']} (ID: {track['id']})")
+    search_cache.put(search_cache.key(song, artist), track)
+    return track
 
-    return track_id
 
-
-def play_song(track_id, access_token):
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
+def track_summary(track):
+    """ID, nazwa i pierwszy wykonawca utworu z odpowiedzi API"""
+    return {
+        "id": track['id'],
+        "name": track['name'],
+        "artist_name": track['artists'][0]['name'],
+        "artist_id": track['artists'][0]['id']
     }
 
-    # Pobierz dostępne urządzenia
-    devices_response = requests.get(
-        "https://api.spotify.com/v1/me/player/devices",
-        headers=headers
-    )
 
-    if devices_response.status_code != 200:
-        print(f"Błąd pobierania urządzeń: {devices_response.status_code}")
-        print(devices_response.text)
-        return False
+# Słowa, które w "zagraj X od Y" nie są częścią tytułu ani wykonawcy
+SPECULATIVE_STOP_WORDS = LOCAL_FILLER_WORDS | frozenset("""
+    zagraj pusc puscic wlacz odpal graj zaspiewaj play put on by od przez artysty wykonawcy zespolu feat
+""".split())
 
-    devices_data = devices_response.json()
-    print(f"Znalezione urządzenia: {json.dumps(devices_data, indent=2)}")
+# Wyszukiwanie spekulatywne tylko dla wypowiedzi zaczynających się od polecenia odtworzenia - inne komendy
+# (nastrój, urządzenie, głośność) nie potrzebują utworu, a zapytanie zajmowałoby interaktywny limit API
+SPECULATIVE_PLAY_VERBS = frozenset("zagraj zagrac pusc puscic wlacz wlaczyc odpal odpalic graj zaspiewaj play".split())
 
-    if devices_data.get('devices') and len(devices_data['devices']) > 0:
-        active_devices = [d for d in devices_data['devices'] if d.get('is_active')]
+# Trafienia i pudła wyszukiwania spekulatywnego
+search_speculation_stats = defaultdict(int)
 
-        if active_devices:
-            device_id = active_devices[0]['id']
-            print(f"Używam aktywnego urządzenia: {active_devices[0]['name']} ({device_id})")
-        else:
-            device_id = devices_data['devices'][0]['id']
-            print(f"Aktywuję urządzenie: {devices_data['devices'][0]['name']} ({device_id})")
-
-            # Aktywuj urządzenie
-            transfer_response = requests.put(
-                "https://api.spotify.com/v1/me/player",
-                headers=headers,
-                json={"device_ids": [device_id], "play": True}
-            )
-            print(f"Status aktywacji urządzenia: {transfer_response.status_code}")
-            if transfer_response.status_code not in [200, 204]:
-                print(f"Odpowiedź: {transfer_response.text}")
 
-            # Zaczekaj chwilę
-            time.sleep(2)
+def starts_with_play_verb(utterance):
+    """Czy pierwsze słowo poza wypełniaczami ("hej", "możesz") to polecenie odtworzenia"""
+    words = [word for word in normalize_utterance(utterance).split() if word not in LOCAL_FILLER_WORDS]
+    return bool(words) and words[0] in SPECULATIVE_PLAY_VERBS
 
-        # Zamiast używać API rekomendacji, użyjemy kontekstu radia utworu
-        # Ta metoda uruchamia automatyczne odtwarzanie podobnych utworów (tzw. Spotify Radio)
-        print(f"Uruchamiam odtwarzanie utworu {track_id} z kontynuacją")
 
-        # Sposób 1: Użyj normalnego odtwarzania, ale z ustawionym flag kontekstu
-        play_url = f"https://api.spotify.com/v1/me/player/play"
-        if device_id:
-            play_url += f"?device_id={device_id}"
+def speculative_query(utterance):
+    """Surowa wypowiedź bez słów-wypełniaczy jako zapytanie do wyszukiwarki (lub "")"""
+    return " ".join(word for word in utterance.split() if normalize_utterance(word) not in SPECULATIVE_STOP_WORDS)
 
-        # Najpierw odtwórz konkretny utwór
-        payload = {
-            "uris": [f"spotify:track:{track_id}"]
-        }
 
-        response = requests.put(
-            play_url,
-            headers=headers,
-            json=payload
-        )
-
-        time.sleep(1)
-        playing_response = requests.get(
-            "https://api.spotify.com/v1/me/player/currently-playing",
-            headers=headers
-        )
+async def async_speculative_search(utterance, aspotify, limit=5):
+    """Kandydaci z wyszukiwania po surowej wypowiedzi, równolegle z parsowaniem przez LLM"""
+    query = speculative_query(utterance)
+    if not query:
+        return []
+    print(f"Wyszukiwanie spekulatywne: {query}")
+    response = await aspotify.get("/search", params={"q": query, "type": "track", "limit": limit})
+    if response.status_code != 200:
+        return []
+    return [track_summary(track) for track in response.json().get('tracks', {}).get('items', []) if track]
 
-        if response.status_code not in [200, 204]:
-            print(f"Odpowiedź: {response.text}")
-            return False
 
-        # Następnie dodaj podobne utwory do kolejki
-        # Pobierz ID artysty dla tego utworu
-        track_info_url = f"https://api.spotify.com/v1/tracks/{track_id}"
-        track_response = requests.get(track_info_url, headers=headers)
-
-        if track_response.status_code == 200:
-            track_data = track_response.json()
-            artist_id = track_data['artists'][0]['id']
-
-            # Pobierz najpopularniejsze utwory artysty
-            artist_top_tracks_url = f"https://api.spotify.com/v1/artists/{artist_id}/top-tracks?market=US"
-            top_tracks_response = requests.get(artist_top_tracks_url, headers=headers)
-
-            if top_tracks_response.status_code == 200:
-                top_tracks_data = top_tracks_response.json()
-
-                # Dodaj 10 najpopularniejszych utworów do kolejki
-                for track in top_tracks_data.get('tracks', [])[:10]:
-                    if track['id'] != track_id:  # Nie dodawaj ponownie aktualnego utworu
-                        queue_url = "https://api.spotify.com/v1/me/player/queue"
-                        queue_params = {"uri": track['uri']}
-                        queue_response = requests.post(
-                            queue_url,
-                            headers=headers,
-                            params=queue_params
-                        )
+def match_speculative_track(parsed, candidates, threshold=0.85, partial_threshold=0.6):
+    """
+    Kandydat zgodny z tytułem i wykonawcą z parsera albo None (zgadywanie chybione).
 
-                        if queue_response.status_code in [200, 204]:
-                            print(f"Dodano do kolejki: {track['name']} - {track['artists'][0]['name']}")
-                        else:
-                            print(f"Błąd dodawania do kolejki: {queue_response.status_code}")
-                            print(queue_response.text)
-            else:
-                print(f"Błąd pobierania popularnych utworów: {top_tracks_response.status_code}")
-        else:
-            print(f"Błąd pobierania informacji o utworze: {track_response.status_code}")
-
-        # Sposób 2 (alternatywny): Włącz tryb shuffle
-        shuffle_url = "https://api.spotify.com/v1/me/player/shuffle"
-        shuffle_params = {"state": "true"}
-        if device_id:
-            shuffle_params["device_id"] = device_id
-
-        shuffle_response = requests.put(
-            shuffle_url,
-            headers=headers,
-            params=shuffle_params
-        )
+    Nazwa pasuje, gdy jest prawie identyczna (threshold) albo zawiera wszystkie słowa zapytania
+    jako całe słowa i nie jest dużo dłuższa (partial_threshold) - "love" nie pasuje do "lovely",
+    a "hello" do "hello goodbye". Bez wykonawcy tytuł musi być identyczny po normalizacji.
+    """
+    song = normalize_utterance(parsed.get('song') or "")
+    artist = normalize_utterance(parsed.get('artist') or "")
+    if not song:
+        return None
 
-        print(f"Status włączania shuffle: {shuffle_response.status_code}")
+    def similar(expected, actual):
+        ratio = SequenceMatcher(None, expected, actual).ratio()
+        if ratio >= threshold:
+            return True
+        return set(expected.split()) <= set(actual.split()) and ratio >= partial_threshold
+
+    for track in candidates:
+        name = normalize_utterance(track['name'])
+        if artist:
+            if not similar(song, name) or not similar(artist, normalize_utterance(track['artist_name'])):
+                continue
+        elif song != name:
+            continue
+        return track
+    return None
+
+
+async def async_get_artist_top_tracks(artist_id, aspotify):
+    """Najpopularniejsze utwory artysty (lista słowników z API, pusta przy błędzie)"""
+    response = await aspotify.get(f"/artists/{artist_id}/top-tracks", params={"market": "US"})
+    if response.status_code != 200:
+        print(f"Błąd pobierania popularnych utworów: {response.status_code}")
+        return []
+    return response.json().get('tracks', [])
 
-        return True
-    else:
-        print("Nie znaleziono urządzeń. Proszę otworzyć aplikację Spotify.")
-        return False
 
+async def async_find_artist_top_tracks(artist, aspotify):
+    """Wyszukuje artystę po nazwie i zwraca (ID artysty, jego najpopularniejsze utwory)"""
+    if not artist:
+        return None, []
+    response = await aspotify.get("/search", params={"q": artist, "type": "artist", "limit": 1})
+    if response.status_code != 200:
+        print(f"Błąd wyszukiwania artysty: {response.status_code}")
+        return None, []
 
-def switch_device(access_token, device_type_target, voice_agent=None):
-    """Przełącza odtwarzanie na urządzenie o wskazanym typie (TV, Computer, Smartphone)"""
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
+    artists = response.json().get('artists', {}).get('items', [])
+    if not artists:
+        return None, []
+    return artists[0]['id'], await async_get_artist_top_tracks(artists[0]['id'], aspotify)
 
-    devices_url = "https://api.spotify.com/v1/me/player/devices"
-    devices_response = requests.get(devices_url, headers=headers)
 
-    if devices_response.status_code != 200:
-        print(f"Błąd pobierania urządzeń: {devices_response.status_code}")
-        if voice_agent:
-            voice_agent.speak("Nie udało się pobrać listy urządzeń.")
-        return False
+@traced
+async def async_search_song_with_radio(song, artist, aspotify, track=None):
+    """
+    Wyszukuje utwór i listę URI do radia (top utwory artysty) przy stałej liczbie zapytań.
 
-    devices_data = devices_response.json()
+    Wyszukiwanie artysty i jego top utworów biegnie równolegle z wyszukiwaniem utworu.
+    track - utwór już znaleziony (wyszukiwanie spekulatywne); dociągane są tylko top utwory wykonawcy.
+    Zwraca (track_id, radio_uris).
+    """
+    if track:
+        top_tracks = await async_get_artist_top_tracks(track['artist_id'], aspotify)
+    else:
+        track, (artist_id, top_tracks) = await asyncio.gather(
+            async_search_track(song, artist, aspotify),
+            async_find_artist_top_tracks(artist, aspotify),
+        )
+        if artist_id != track['artist_id']:
+            # Artysta z wyszukiwania nie zgadza się z wykonawcą utworu - bierzemy top utwory wykonawcy
+            top_tracks = await async_get_artist_top_tracks(track['artist_id'], aspotify)
+    return track['id'], [t['uri'] for t in top_tracks if t['id'] != track['id']][:RADIO_SIZE]
 
-    # Dopasuj urządzenie po typie (ignorując wielkość liter)
-    target_device = None
-    for device in devices_data.get('devices', []):
-        if device['type'].lower() == device_type_target.lower():
-            target_device = device
-            break
 
-    if not target_device:
-        print(f"Nie znaleziono urządzenia typu {device_type_target}.")
-        if voice_agent:
-            voice_agent.speak(f"Nie znalazłem urządzenia typu {device_type_target}.")
-        return False
+@traced
+async def async_play_song(song, artist, aspotify, radio=None, track=None, retry=True):
+    """
+    Wyszukuje i odtwarza utwór z radiem (top utwory artysty).
 
-    device_id = target_device['id']
+    Wyszukiwanie utworu, top utwory artysty, lista urządzeń i stan odtwarzacza są pobierane
+    równocześnie; odtwarzanie startuje jednym PUT /me/player/play. Zwraca ID utworu lub None.
+    radio - gotowe (track_id, radio_uris), np. z częściowej transkrypcji; wtedy bez wyszukiwania.
+    track - utwór już znaleziony (wyszukiwanie spekulatywne); dociągane są tylko top utwory wykonawcy.
+    """
+    async def search():
+        return radio or await async_search_song_with_radio(song, artist, aspotify, track)
 
-    # Przełącz urządzenie
-    transfer_url = "https://api.spotify.com/v1/me/player"
-    transfer_payload = {
-        "device_ids": [device_id],
-        "play": True
-    }
+    (track_id, radio_uris), devices, player_state = await asyncio.gather(
+        search(),
+        aspotify.devices.list_async(aspotify),
+        aspotify.playback.get_async(aspotify),
+    )
 
-    transfer_response = requests.put(transfer_url, headers=headers, json=transfer_payload)
+    if not devices:
+        if devices is not None:
+            print("Nie znaleziono urządzeń. Proszę otworzyć aplikację Spotify.")
+        return None
 
-    if transfer_response.status_code in [200, 204]:
-        print(f"Przełączono na urządzenie: {target_device['name']} ({device_type_target})")
-        if voice_agent:
-            voice_agent.speak(f"Przełączono na {target_device['name']}")
-        return True
+    active_device = aspotify.devices.active(devices)
+    if active_device:
+        device_id = active_device['id']
+        print(f"Używam aktywnego urządzenia: {active_device['name']} ({device_id})")
     else:
-        print(f"Błąd przełączania urządzenia: {transfer_response.status_code}")
-        if voice_agent:
-            voice_agent.speak("Nie udało się przełączyć urządzenia.")
-        return False
-
+        target_device = aspotify.devices.preferred(devices)
+        device_id = target_device['id']
+        print(f"Aktywuję urządzenie: {target_device['name']} ({device_id})")
+        transfer_response = await aspotify.put("/me/player", json={"device_ids": [device_id], "play": True})
+        print(f"Status aktywacji urządzenia: {transfer_response.status_code}")
+        if transfer_response.status_code not in [200, 204]:
+            aspotify.devices.check_response(transfer_response)
+        else:
+            aspotify.devices.mark_used(target_device)
+            player_state = await async_wait_for_player_state(
+                aspotify,
+                lambda state: state.get('device', {}).get('id') == device_id
+            )
 
-def get_current_song(access_token):
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
-    time.sleep(1)
-    playing_response = requests.get(
-        "https://api.spotify.com/v1/me/player/currently-playing",
-        headers=headers
+    response = await aspotify.put(
+        "/me/player/play",
+        params={"device_id": device_id},
+        json={"uris": [f"spotify:track:{track_id}"] + radio_uris}
     )
-    if playing_response.status_code == 200:
-        playing_data = playing_response.json()
-        name = playing_data['item']['name']
-        artists = ", ".join([artist['name'] for artist in playing_data['item']['artists']])
-        # print(f"✅ Teraz odtwarzane: {name} – {artists}")
-        return f"Teraz odtwarzane: {name} – {artists}"
-    else:
-        print("🔍 Nie udało się pobrać informacji o odtwarzanym utworze.")
-
-
-def like_current_song(access_token, voice_agent=None):
-    """Polubienie aktualnie odtwarzanej piosenki"""
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
+    if response.status_code not in [200, 204]:
+        print(f"Odpowiedź: {response.text}")
+        if not aspotify.devices.check_response(response) and retry:
+            return await async_play_song(song, artist, aspotify, (track_id, radio_uris), retry=False)
+        return None
+    # Nowy utwór: poprzedni "item" w snapshocie jest nieaktualny - następny odczyt pyta API
+    aspotify.playback.invalidate()
+    print(f"Radio uruchomione jednym zapytaniem ({len(radio_uris)} utworów po wybranym)")
 
-    # 1. Pobierz aktualnie odtwarzany utwór
-    current_playing_url = "https://api.spotify.com/v1/me/player/currently-playing"
-    current_response = requests.get(current_playing_url, headers=headers)
+    if player_state and player_state.get('shuffle_state'):
+        print("Shuffle jest już włączony - pomijam zapytanie.")
+    else:
+        shuffle_response = await aspotify.put("/me/player/shuffle",
+                                              params={"state": "true", "device_id": device_id})
+        print(f"Status włączania shuffle: {shuffle_response.status_code}")
+        if shuffle_response.status_code in [200, 204]:
+            aspotify.playback.update(shuffle_state=True)
+    return track_id
 
-    if current_response.status_code != 200 or not current_response.content:
-        print("Brak aktualnie odtwarzanego utworu lub błąd odpowiedzi.")
-        if voice_agent:
-            voice_agent.speak("Nie mogę znaleźć aktualnie odtwarzanego utworu.")
-        return {
-            "success": False,
-            "track_info": None,
-            "already_liked": False
-        }
 
-    current_data = current_response.json()
-    if not current_data.get('item'):
-        print("Brak informacji o odtwarzanym utworze.")
-        if voice_agent:
-            voice_agent.speak("Nie mogę znaleźć informacji o odtwarzanym utworze.")
-        return {
-            "success": False,
-            "track_info": None,
-            "already_liked": False
-        }
+@traced
+async def async_get_current_song(aspotify, expected_track_id=None):
+    def is_expected(state):
+        return playing_track_id(state) is not None and expected_track_id in (None, playing_track_id(state))
 
-    track_id = current_data['item']['id']
-    track_name = current_data['item']['name']
-    artist_name = current_data['item']['artists'][0]['name']
-    track_info = f"{track_name} - {artist_name}"
+    playing_data = await aspotify.playback.get_async(aspotify)
+    if not is_expected(playing_data):
+        playing_data = await async_wait_for_player_state(aspotify, is_expected)
+    if playing_data:
+        name = playing_data['item']['name']
+        artists = ", ".join([artist['name'] for artist in playing_data['item']['artists']])
+        return f"Teraz odtwarzane: {name} – {artists}"
+    print("🔍 Nie udało się pobrać informacji o odtwarzanym utworze.")
 
-    # 2. Sprawdź, czy utwór jest już polubiony
-    check_url = f"https://api.spotify.com/v1/me/tracks/contains"
-    check_params = {"ids": track_id}
-    check_response = requests.get(check_url, headers=headers, params=check_params)
 
-    if check_response.status_code == 200:
-        is_saved = check_response.json()
-        if is_saved and is_saved[0]:
-            print(f"ℹ️ Utwór {track_info} jest już polubiony.")
-            return {
-                "success": True,
-                "track_info": track_info,
-                "already_liked": True
-            }
+@traced
+async def async_switch_device(aspotify, device_type_target, retry=True):
+    """Zwraca tekst odpowiedzi (sukces lub błąd) do wypowiedzenia"""
+    devices, player_state = await asyncio.gather(
+        aspotify.devices.list_async(aspotify),
+        aspotify.playback.get_async(aspotify),
+    )
+    if devices is None:
+        return "Nie udało się pobrać listy urządzeń."
 
-    # 3. Dodaj utwór do polubionych, jeśli nie jest już polubiony
-    save_url = f"https://api.spotify.com/v1/me/tracks"
-    save_params = {"ids": track_id}
-    save_response = requests.put(save_url, headers=headers, params=save_params)
+    target_device = aspotify.devices.find_by_type(devices, device_type_target)
+    if not target_device:
+        return f"Nie znalazłem urządzenia typu {device_type_target}."
 
-    success = save_response.status_code in [200, 201, 204]
+    device_id = target_device['id']
+    if player_state and player_state.get('device', {}).get('id') == device_id:
+        return f"Już grasz na {target_device['name']}"
 
-    if success:
-        print(f"✅ Polubiono utwór: {track_info}")
-    else:
-        print(f"❌ Błąd polubienia utworu: {save_response.status_code}")
-        print(save_response.text)
+    response = await aspotify.put("/me/player", json={"device_ids": [device_id], "play": True})
+    if response.status_code in [200, 204]:
+        aspotify.devices.mark_used(target_device)
+        aspotify.playback.update(device=dict(target_device, is_active=True), is_playing=True)
+        return f"Przełączono na {target_device['name']}"
 
-    return {
-        "success": success,
-        "track_info": track_info,
-        "already_liked": False
-    }
+    print(f"Błąd przełączania urządzenia: {response.status_code}")
+    if not aspotify.devices.check_response(response) and retry:
+        return await async_switch_device(aspotify, device_type_target, retry=False)
+    return "Nie udało się przełączyć urządzenia."
 
 
-def set_volume(access_token, volume_level=None, adjust_by=None, voice_agent=None):
+async def async_saved_ids(track_ids, aspotify, saved=True):
     """
-    Ustawia głośność odtwarzania Spotify.
+    Zbiór polubionych spośród podanych ID przed polubieniem (saved=True) lub odlubieniem.
 
-    Parametry:
-    - volume_level: konkretny poziom głośności (0-100)
-    - adjust_by: wartość do zwiększenia/zmniejszenia głośności
-    - voice_agent: opcjonalny agent głosowy
+    Indeks biblioteki nie widzi zmian z innych urządzeń, więc ID, które na jego podstawie zostałyby
+    pominięte (już polubione przy polubieniu, niepolubione przy odlubieniu), potwierdzamy w API.
+    """
+    known = library.saved_ids(track_ids)
+    if known is None:
+        return await async_contains_saved(track_ids, aspotify)
+    unsure = [track_id for track_id in track_ids if (track_id in known) == saved]
+    if not unsure:
+        return known
+    return (known - set(unsure)) | await async_contains_saved(unsure, aspotify)
+
+
+async def async_contains_saved(track_ids, aspotify):
+    """Polubione spośród podanych ID według /me/tracks/contains (zapytania równolegle)"""
+    chunks = [track_ids[i:i + SPOTIFY_SAVED_BATCH] for i in range(0, len(track_ids), SPOTIFY_SAVED_BATCH)]
+    responses = await asyncio.gather(*(
+        aspotify.get("/me/tracks/contains", params={"ids": ",".join(chunk)}) for chunk in chunks
+    ))
+    known = set()
+    for chunk, response in zip(chunks, responses):
+        if response.status_code == 200:
+            known.update(track_id for track_id, saved in zip(chunk, response.json()) if saved)
+    return known
+
+
+async def async_collect_tracks(aspotify, scope="track", count=1):
+    """Utwory (obiekty z API) dla polubienia: bieżący, jego album albo ostatnio odtwarzane; oraz opis"""
+    current_data = await aspotify.playback.get_async(aspotify)
+    item = (current_data or {}).get('item')
+
+    if scope == "album":
+        album = (item or {}).get('album')
+        if not album:
+            return [], None
+        tracks = []
+        url, params = f"/albums/{album['id']}/tracks", {"limit": 50}
+        while url:
+            response = await aspotify.get(url, params=params)
+            if response.status_code != 200:
+                print(f"Błąd pobierania utworów albumu: {response.status_code}")
+                return [], None
+            page = response.json()
+            tracks.extend(page.get('items', []))
+            url, params = page.get('next'), None
+        return tracks, f"album {album['name']}"
+
+    if scope == "recent":
+        count = max(1, min(count, 50))
+        tracks = [item] if item else []
+        if count > len(tracks):
+            response = await aspotify.get("/me/player/recently-played", params={"limit": count})
+            if response.status_code == 200:
+                tracks += [entry['track'] for entry in response.json().get('items', [])]
+        unique, seen = [], set()
+        for track in tracks:
+            if track and track.get('id') and track['id'] not in seen:
+                seen.add(track['id'])
+                unique.append(track)
+        tracks = unique[:count]
+        return tracks, f"{len(tracks)} ostatnich utworów"
+
+    return ([item], track_label(current_data)) if item else ([], None)
+
+
+@traced
+async def async_change_saved(aspotify, saved=True, scope="track", count=1):
+    """
+    Polubienie (saved=True) lub odlubienie utworów wskazanych przez scope.
 
-    Zwraca słownik z informacją o sukcesie i poziomie głośności.
+    Stan polubień sprawdzany lokalnie (pominięcia potwierdzane w API); do API trafiają tylko zmiany,
+    po SPOTIFY_SAVED_BATCH ID na zapytanie (równolegle).
     """
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
+    tracks, label = await async_collect_tracks(aspotify, scope, count)
+    if not tracks:
+        return {"success": False, "label": None, "changed": 0, "unchanged": 0}
+
+    track_ids = list(dict.fromkeys(track['id'] for track in tracks if track.get('id')))
+    known = await async_saved_ids(track_ids, aspotify, saved)
+    pending = [track for track in tracks if (track['id'] in known) != saved]
+
+    method = "PUT" if saved else "DELETE"
+    chunks = [pending[i:i + SPOTIFY_SAVED_BATCH] for i in range(0, len(pending), SPOTIFY_SAVED_BATCH)]
+    responses = await asyncio.gather(*(
+        aspotify.request(method, "/me/tracks", params={"ids": ",".join(track['id'] for track in chunk)})
+        for chunk in chunks
+    ))
+
+    success = True
+    for chunk, response in zip(chunks, responses):
+        if response.status_code in [200, 201, 204]:
+            library.mark_saved(chunk, saved)
+        else:
+            print(f"❌ Błąd zmiany polubionych: {response.status_code}")
+            success = False
+    return {"success": success, "label": label, "changed": len(pending), "unchanged": len(track_ids) - len(pending)}
 
-    # 1. Pobierz aktualny poziom głośności
-    player_url = "https://api.spotify.com/v1/me/player"
-    player_response = requests.get(player_url, headers=headers)
 
-    if player_response.status_code != 200 or not player_response.content:
-        print("Błąd pobierania stanu odtwarzacza.")
-        if voice_agent:
-            voice_agent.speak("Nie mogę pobrać informacji o odtwarzaczu.")
-        return {
-            "success": False,
-            "volume": None
-        }
+@traced
+async def async_set_volume(aspotify, volume_level=None, adjust_by=None):
+    player_data = await aspotify.playback.get_async(aspotify)
+    if not player_data:
+        return {"success": False, "volume": None}
 
-    player_data = player_response.json()
     current_volume = player_data.get('device', {}).get('volume_percent', 50)
-
-    # 2. Oblicz nowy poziom głośności
     if volume_level is not None:
-        # Ustaw konkretny poziom głośności
         new_volume = volume_level
     elif adjust_by is not None:
-        # Zwiększ/zmniejsz głośność o podaną wartość
         new_volume = current_volume + adjust_by
     else:
-        return {
-            "success": False,
-            "volume": current_volume
-        }
-
-    # 3. Upewnij się, że wartość jest w zakresie 0-100
+        return {"success": False, "volume": current_volume}
     new_volume = max(0, min(100, new_volume))
 
-    # 4. Ustaw nowy poziom głośności
-    volume_url = "https://api.spotify.com/v1/me/player/volume"
-    volume_params = {"volume_percent": new_volume}
-    volume_response = requests.put(volume_url, headers=headers, params=volume_params)
-
-    success = volume_response.status_code in [200, 204]
-
-    if success:
-        print(f"✅ Ustawiono głośność na {new_volume}%")
-        if voice_agent:
-            if adjust_by is not None and adjust_by > 0:
-                voice_agent.speak(f"Zwiększono głośność do {new_volume} procent")
-            elif adjust_by is not None and adjust_by < 0:
-                voice_agent.speak(f"Zmniejszono głośność do {new_volume} procent")
-            else:
-                voice_agent.speak(f"Ustawiono głośność na {new_volume} procent")
+    success = True
+    if new_volume == current_volume:
+        print(f"Głośność jest już na poziomie {new_volume}% - pomijam zapytanie.")
     else:
-        print(f"❌ Błąd ustawiania głośności: {volume_response.status_code}")
-        print(volume_response.text)
-        if voice_agent:
-            voice_agent.speak("Nie udało się zmienić głośności")
+        response = await aspotify.put("/me/player/volume", params={"volume_percent": new_volume})
+        success = response.status_code in [200, 204]
+        if success:
+            aspotify.playback.update_device(volume_percent=new_volume)
+        else:
+            print(f"❌ Błąd ustawiania głośności: {response.status_code}")
+    return {"success": success, "volume": new_volume if success else current_volume}
+
+
+@traced
+async def async_search_and_play_playlist(mood_input, aspotify, mood=None):
+    """Zwraca tekst odpowiedzi do wypowiedzenia"""
+    # Najpierw kanoniczny klucz nastroju: surowa wypowiedź ("puść coś na imprezę") dopasowana do nazw playlist
+    # trafia w przypadkowe słowa, a klucz ("party") - w cache nastrojów i w nazwę playlisty o tym nastroju
+    mood = mood_key(mood) or mood_key(mood_input) or mood
+    cached = mood_cache.get(mood_cache.key(mood)) if mood else None
+    playlist = None if cached else library.find_playlist(mood or mood_input)
+    if cached:
+        playlists, fresh = cached
+        playlist = playlists[0]
+        print(f"Playlista z cache nastrojów ({mood}): {playlist['name']}")
+        if not fresh:
+            run_in_background(async_fetch_playlists(mood, aspotify, PRIORITY_BACKGROUND))
+    elif playlist:
+        print(f"Playlista z biblioteki: {playlist['name']}")
+    else:
+        playlists = await async_fetch_playlists(mood or mood_input, aspotify, cache=bool(mood))
+        if playlists is None:
+            return "Nie udało się wyszukać playlisty."
+        if not playlists:
+            return "Nie znalazłem żadnej playlisty pasującej do Twojego nastroju."
+        playlist = playlists[0]
+
+    play_response = await aspotify.put("/me/player/play", json={"context_uri": playlist["uri"]})
+    if play_response.status_code not in [200, 204]:
+        print(f"Błąd odtwarzania playlisty: {play_response.status_code}")
+        return "Nie udało się odtworzyć playlisty."
+    aspotify.playback.invalidate()
+    return f"Dodaję playlistę {playlist['name']}."
+
+
+@traced
+async def async_parse_with_speculative_search(command, aspotify):
+    """
+    Parsuje komendę; jeśli parsowanie trafia do LLM, równolegle szuka utworu po surowej wypowiedzi.
 
-    return {
-        "success": success,
-        "volume": new_volume if success else current_volume
-    }
+    Zwraca (parsed, track): track to kandydat zgodny z wynikiem parsera albo None.
+    """
+    parse_task = asyncio.ensure_future(asyncio.to_thread(parse_user_input, command))
+    done, _ = await asyncio.wait({parse_task}, timeout=SPECULATIVE_SEARCH_DELAY)
+    if done or not SPECULATIVE_SEARCH or not starts_with_play_verb(command):
+        # Lokalne dopasowanie lub cache - nie ma czego wyprzedzać; bez "zagraj/puść/play" - nie ma czego szukać
+        return await parse_task, None
 
-def process_command(command, access_token, voice_agent):
-    """Przetwarzanie komendy (tekstowej lub głosowej)"""
+    search_task = asyncio.create_task(async_speculative_search(command, aspotify))
     try:
-        # Dodaj debug
-        print(f"Rozpoczynam przetwarzanie komendy: {command}")
-
-        # Parsowanie komendy
-        parsed = parse_user_input(command)
-        print(f"Sparsowana komenda: {parsed}")
-
-        # Obsługa różnych typów komend
-        if parsed.get('action') == 'next_song':
-            print("Przechodzę do następnego utworu...")
-            if voice_agent:
-                voice_agent.speak("Przechodzę do następnego utworu")
-
-            result = next_song(access_token)
-
-            if result['success']:
-                response_text = f"Pominięto utwór {result['previous_track']}. Teraz odtwarzam {result['current_track']}"
-            else:
-                response_text = "Nie udało się przejść do następnego utworu. Sprawdź czy aplikacja Spotify jest aktywna."
-
-            print(response_text)
-            if voice_agent:
-                voice_agent.speak(response_text)
-
-            return result['success']
-
-        elif parsed.get('action') == 'play_song':  # domyślnie 'play_song'
-            # Informacja dla użytkownika
-            response_text = f"Szukam utworu '{parsed['song']}' artysty {parsed['artist']}..."
-            print(response_text)
-            if voice_agent:
-                voice_agent.speak(response_text)
-
-            # Wyszukaj i odtwórz
-            print("Rozpoczynam wyszukiwanie utworu...")
-            track_id = search_song(parsed['song'], parsed['artist'], access_token)
-            print(f"Znaleziono ID utworu: {track_id}")
-
-            print("Próbuję odtworzyć utwór...")
-            success = play_song(track_id, access_token)
-
-            # Odpowiedź
-            if success:
-                # response_text = f"Odtwarzam '{parsed['song']}' przez {parsed['artist']}"
-                response_text = get_current_song(access_token)
-            else:
-                response_text = "Nie mogę odtworzyć - sprawdź czy aplikacja Spotify jest otwarta."
-
-            print(response_text)
-            if voice_agent:
-                voice_agent.speak(response_text)
-
-            return success
-
-        elif parsed.get('action') == 'pause_playback':
-            print("Zatrzymuję odtwarzanie...")
-            if voice_agent:
-                voice_agent.speak("Zatrzymuję odtwarzanie")
+        parsed = await parse_task
+        if parsed.get('action') != 'play_song':
+            return parsed, None
+        try:
+            candidates = await search_task
+        except Exception as e:
+            print(f"Wyszukiwanie spekulatywne nie powiodło się: {e}")
+            candidates = []
+    finally:
+        # Błąd parsowania lub anulowanie komendy nie może zostawić wyszukiwania w tle
+        search_task.cancel()
+    track = match_speculative_track(parsed, candidates)
+    search_speculation_stats["hits" if track else "misses"] += 1
+    if track:
+        print(f"Wyszukiwanie spekulatywne trafione: {track['name']} - {track['artist_name']}")
+    return parsed, track
 
-            result = pause_playback(access_token)
 
-            if result['success']:
-                response_text = f"Zatrzymano odtwarzanie utworu {result['paused_track']}"
-            else:
-                response_text = "Nie udało się zatrzymać odtwarzania. Sprawdź czy aplikacja Spotify jest aktywna."
+async def async_parse_command(command, aspotify, speculator=None):
+    """
+    Parsowanie komendy (bez skutków ubocznych): wynik przygotowany z częściowej transkrypcji
+    albo parse_user_input z równoległym wyszukiwaniem. Zwraca (parsed, prefetched, speculative_track).
+    """
+    parsed, prefetched = None, None
+    speculation = speculator.confirm(command) if speculator else None
+    if speculation:
+        try:
+            parsed, prefetched = await asyncio.wrap_future(speculation)
+            print("Wykorzystuję wynik przygotowany z częściowej transkrypcji.")
+        except Exception as e:
+            print(f"Spekulatywne przygotowanie nie powiodło się: {e}")
+    speculative_track = None
+    if parsed is None:
+        parsed, speculative_track = await async_parse_with_speculative_search(command, aspotify)
+    print(f"Sparsowana komenda: {parsed}")
+    return parsed, prefetched, speculative_track
+
+
+@traced
+async def async_execute_command(command, parsed, aspotify, say, prefetched=None, speculative_track=None):
+    """Wykonuje sparsowaną komendę; say(tekst, ack) przekazuje odpowiedzi użytkownikowi"""
+    action = parsed.get('action')
+    tracer.annotate(action=action)
+
+    if action == 'next_song':
+        say("Przechodzę do następnego utworu", ack=True)
+        result = await async_next_song(aspotify)
+        if result['success']:
+            say(f"Pominięto utwór {result['previous_track']}. Teraz odtwarzam {result['current_track']}")
+        else:
+            say("Nie udało się przejść do następnego utworu. Sprawdź czy aplikacja Spotify jest aktywna.")
+        return result['success']
+
+    if action == 'play_song':
+        say(f"Szukam utworu '{parsed['song']}' artysty {parsed['artist']}...", ack=True)
+        track_id = await async_play_song(parsed['song'], parsed['artist'], aspotify, prefetched,
+                                         speculative_track)
+        if track_id:
+            say(await async_get_current_song(aspotify, track_id) or "Odtwarzam.")
+        else:
+            say("Nie mogę odtworzyć - sprawdź czy aplikacja Spotify jest otwarta.")
+        return bool(track_id)
+
+    if action == 'pause_playback':
+        say("Zatrzymuję odtwarzanie", ack=True)
+        result = await async_pause_playback(aspotify)
+        if result['success']:
+            say(f"Zatrzymano odtwarzanie utworu {result['paused_track']}")
+        else:
+            say("Nie udało się zatrzymać odtwarzania. Sprawdź czy aplikacja Spotify jest aktywna.")
+        return result['success']
+
+    if action == 'resume_playback':
+        say("Wznawiam odtwarzanie", ack=True)
+        result = await async_resume_playback(aspotify)
+        if result['success']:
+            say(f"Wznowiono odtwarzanie utworu {result['resumed_track']}")
+        else:
+            say("Nie udało się wznowić odtwarzania. Sprawdź czy aplikacja Spotify jest aktywna.")
+        return result['success']
 
-            print(response_text)
-            if voice_agent:
-                voice_agent.speak(response_text)
+    if action == 'switch_device' and parsed.get('device'):
+        say(await async_switch_device(aspotify, parsed['device']))
+        return True
 
-            return result['success']
+    if action == 'recommendation':
+        say("Szukam odpowiedniej playlisty do Twojego nastroju.", ack=True)
+        say(await async_search_and_play_playlist(command, aspotify, parsed.get('mood')))
+        return True
 
-        # Dodaj nowy warunek elif w funkcji process_command po warunku dla 'pause_playback':
-        elif parsed.get('action') == 'resume_playback':
-            print("Wznawiam odtwarzanie...")
-            if voice_agent:
-                voice_agent.speak("Wznawiam odtwarzanie")
+    if action in ('like', 'unlike'):
+        saved = action == 'like'
+        scope = parsed.get('scope') or 'track'
+        result = await async_change_saved(aspotify, saved, scope, int(parsed.get('count') or 1))
+        label = result['label']
+        if not result['success'] or not label:
+            say("Nie udało się polubić aktualnego utworu." if saved else "Nie udało się usunąć z polubionych.")
+        elif scope == 'track' and not result['changed']:
+            say(f"Utwór {label} jest już w Twoich ulubionych." if saved
+                else f"Utworu {label} nie ma w Twoich ulubionych.")
+        elif scope == 'track':
+            say(f"Dodano {label} do polubionych utworów." if saved else f"Usunięto {label} z polubionych utworów.")
+        else:
+            verb = "dodane do polubionych" if saved else "usunięte z polubionych"
+            say(f"{label[0].upper()}{label[1:]}: {verb}: {result['changed']}"
+                + (f", bez zmian: {result['unchanged']}." if result['unchanged'] else "."))
+        return result['success']
 
-            result = resume_playback(access_token)
+    if action in ('volume_up', 'volume_down', 'set_volume'):
+        if action == 'set_volume':
+            volume_level = int(parsed.get('volume', 50))
+            say(f"Ustawiam głośność na {volume_level} procent", ack=True)
+            result = await async_set_volume(aspotify, volume_level=volume_level)
+        else:
+            change = int(parsed.get('volume', 10)) * (1 if action == 'volume_up' else -1)
+            say("Zwiększam głośność" if change > 0 else "Zmniejszam głośność", ack=True)
+            result = await async_set_volume(aspotify, adjust_by=change)
+        if result['success']:
+            say(f"Ustawiono głośność na {result['volume']} procent")
+        else:
+            say("Nie udało się zmienić głośności")
+        return result['success']
+    return False
 
-            if result['success']:
-                response_text = f"Wznowiono odtwarzanie utworu {result['resumed_track']}"
-            else:
-                response_text = "Nie udało się wznowić odtwarzania. Sprawdź czy aplikacja Spotify jest aktywna."
 
-            print(response_text)
-            if voice_agent:
-                voice_agent.speak(response_text)
+class SpeculativeParser:
+    """
+    Przygotowuje komendę na podstawie częściowej transkrypcji, zanim użytkownik skończy mówić.
 
-            return result['success']
+    Gdy ta sama hipoteza przyjdzie dwa razy z rzędu (stabilna), w tle startuje parse_user_input,
+    a dla play_song także wyszukanie utworu i radia. Tylko operacje bez skutków ubocznych -
+    nic nie jest odtwarzane, dopóki finalna transkrypcja nie potwierdzi hipotezy.
+    """
 
-        elif parsed.get('action') == 'switch_device':
-            device_type = parsed.get('device')
-            if device_type:
-                success = switch_device(access_token, device_type, voice_agent)
+    def __init__(self, aspotify, loop):
+        self.aspotify = aspotify
+        self.loop = loop  # pętla zdarzeń, na której działa aspotify
+        self.lock = threading.Lock()
+        # Osobny wątek: parsowanie blokuje, wyszukiwanie idzie na pętlę zdarzeń
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.last_partial = None
+        self.key = None
+        self.future = None
+        self.hits = 0
+        self.misses = 0
+
+    def on_partial(self, text):
+        key = normalize_utterance(text)
+        with self.lock:
+            stable = bool(key) and key == self.last_partial
+            self.last_partial = key
+            if not stable or key == self.key:
+                return
+            self.key = key
+            self.future = self.pool.submit(self._prepare, text)
+        print(f"Przygotowuję spekulatywnie: {text}")
+
+    def _prepare(self, text):
+        parsed = parse_user_input(text)
+        prefetched = None
+        if parsed.get('action') == 'play_song' and parsed.get('song'):
+            prefetched = asyncio.run_coroutine_threadsafe(
+                async_search_song_with_radio(parsed['song'], parsed.get('artist'), self.aspotify), self.loop
+            ).result()
+        return parsed, prefetched
+
+    def confirm(self, final_text):
+        """Future z (parsed, prefetched), gdy finalna transkrypcja zgadza się z hipotezą; inaczej None"""
+        key = normalize_utterance(final_text)
+        with self.lock:
+            future = self.future if self.key is not None and key == self.key else None
+            if future:
+                self.hits += 1
+            elif self.key is not None:
+                self.misses += 1
+            self.last_partial = self.key = self.future = None
+        return future
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+
+# Komendy, z których liczy się tylko najnowsza: ten sam klucz = nowsza zastępuje starszą.
+# Zmiany względne (głośniej/ciszej) i polubienia się sumują, więc nie są zastępowane.
+SUPERSEDE_KEYS = {
+    "next_song": "skip",
+    "play_song": "play",
+    "recommendation": "play",
+    "pause_playback": "playback",
+    "resume_playback": "playback",
+    "switch_device": "device",
+    "set_volume": "volume",
+}
+
+
+class PipelineCommand:
+    """Komenda w potoku: numer kolejny, tekst, ID w śladach, zadanie parsowania i klucz zastępowania"""
+    __slots__ = ("seq", "text", "command_id", "parse_task", "key")
+
+    def __init__(self, seq, text, command_id):
+        self.seq = seq
+        self.text = text
+        self.command_id = command_id
+        self.parse_task = None
+        self.key = None
+
+
+class CommandPipeline:
+    """
+    Potok komend: źródła wejścia (klawiatura, mikrofon) wrzucają (tekst, ID komendy) do command_queue,
+    komendy są parsowane równolegle (do PARSE_WORKERS naraz), a wykonywane pojedynczo w kolejności wydania.
+
+    Nowsza komenda tego samego rodzaju (SUPERSEDE_KEYS) zastępuje starszą, która jeszcze się nie zaczęła
+    wykonywać: gdy przychodzi kolej komendy, czekamy na sparsowanie komend wydanych po niej i pomijamy ją,
+    jeśli wśród nich jest komenda tego samego rodzaju. Rozpoczęte komendy nigdy nie są przerywane,
+    więc wynik nie zależy od tego, która komenda szybciej się sparsuje. Odpowiedzi idą przez
+    response_queue do osobnego wątku.
+    """
 
-        elif parsed.get('action') == 'recommendation':
-            print("Wyszukuję playlistę na podstawie nastroju...")
-            if voice_agent:
-                voice_agent.speak("Szukam odpowiedniej playlisty do Twojego nastroju.")
+    def __init__(self, aspotify, voice_agent, speculator=None, parse_workers=PARSE_WORKERS):
+        self.aspotify = aspotify
+        self.voice_agent = voice_agent
+        self.speculator = speculator
+        self.parse_slots = asyncio.Semaphore(parse_workers)
+        self.pending = deque()
+        self.seq = 0
+        self.wakeup = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.counters = defaultdict(int)
+        self.responder = threading.Thread(target=self._respond)
+        self.responder.daemon = True
+        self.responder.start()
+
+    def submit(self, text, command_id=None):
+        """Przyjmuje komendę: parsowanie startuje od razu, wykonanie czeka na swoją kolej"""
+        self.seq += 1
+        item = PipelineCommand(self.seq, text, command_id or tracer.new_command_id())
+        item.parse_task = asyncio.create_task(self._parse(item))
+        self.pending.append(item)
+        self.idle.clear()
+        self.wakeup.set()
+        return item
+
+    async def pump(self):
+        """Przenosi komendy z command_queue do potoku (krótki timeout - wątek nie blokuje zamknięcia pętli)"""
+        while True:
+            try:
+                text, command_id = await asyncio.to_thread(command_queue.get, True, 0.5)
+            except queue.Empty:
+                continue
+            self.submit(text, command_id)
+            command_queue.task_done()
+
+    async def _parse(self, item):
+        async with self.parse_slots:
+            print(f"Rozpoczynam przetwarzanie komendy: {item.text}")
+            with tracer.for_command(item.command_id):
+                result = await async_parse_command(item.text, self.aspotify, self.speculator)
+        item.key = SUPERSEDE_KEYS.get(result[0].get('action'))
+        return result
+
+    async def _superseded(self, item):
+        """Czy komendę zastępuje nowsza, wydana zanim przyszła jej kolej (czeka na parsowanie nowszych)"""
+        if item.key is None or not self.pending:
+            return False
+        later = list(self.pending)
+        await asyncio.gather(*(other.parse_task for other in later), return_exceptions=True)
+        return any(other.key == item.key for other in later)
 
-            # teraz uruchamiamy search_and_play_playlist
-            mood_input = command  # jako mood_input dajemy cały oryginalny tekst użytkownika
-            success = search_and_play_playlist(mood_input, access_token, voice_agent)
+    async def run(self):
+        """Wykonuje komendy po kolei (jedna naraz) w kolejności wydania"""
+        while True:
+            if not self.pending:
+                self.idle.set()
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
 
-            return success
+            item = self.pending.popleft()
+            with tracer.for_command(item.command_id):
+                await self._execute(item)
 
+    async def _execute(self, item):
+        try:
+            parsed, prefetched, speculative_track = await item.parse_task
+        except Exception as e:
+            print(f"Błąd parsowania komendy '{item.text}': {e}")
+            self.respond("Przepraszam, wystąpił błąd podczas wykonywania komendy.")
+            self.counters["failed"] += 1
+            return
 
-        elif parsed.get('action') == 'like':
+        if await self._superseded(item):
+            print(f"Pomijam '{item.text}' - jest nowsza komenda tego samego rodzaju")
+            self.counters["superseded"] += 1
+            return
 
-            print("Polubianie aktualnego utworu...")
+        try:
+            await async_execute_command(item.text, parsed, self.aspotify, self.respond, prefetched,
+                                        speculative_track)
+        except Exception as e:
+            print(f"Wystąpił błąd: {e}")
+            self.respond("Przepraszam, wystąpił błąd podczas wykonywania komendy.")
+            self.counters["failed"] += 1
+        else:
+            self.counters["executed"] += 1
 
-            result = like_current_song(access_token, voice_agent)
+    def respond(self, text, ack=False):
+        # ID komendy jedzie z odpowiedzią do wątku TTS - etap "tts" w śladach wskazuje swoją komendę
+        response_queue.put((text, ack, tracer.command.get()))
 
-            if result['success']:
+    def _respond(self):
+        while True:
+            entry = response_queue.get()
+            try:
+                if entry is None:
+                    return
+                text, ack, command_id = entry
+                print(text)
+                if self.voice_agent:
+                    with tracer.for_command(command_id):
+                        self.voice_agent.speak(text, ack=ack)
+            finally:
+                response_queue.task_done()
+
+    async def join(self):
+        """Czeka, aż wszystkie wydane komendy zostaną wykonane lub pominięte, a odpowiedzi przekazane"""
+        await asyncio.to_thread(command_queue.join)
+        await self.idle.wait()
+        await asyncio.to_thread(response_queue.join)
+
+    def stats(self):
+        return dict(self.counters, pending=len(self.pending))
+
+    def close(self):
+        response_queue.put(None)
+        self.responder.join(timeout=1)
+
+
+async def async_main(spotify, voice_agent, start_in_voice_mode=False, continuous=False):
+    """
+    Główna pętla na pętli zdarzeń.
 
-                if result['already_liked']:
+    Wczytywanie komend (klawiatura lub mikrofon) i ich wykonywanie są rozdzielone przez CommandPipeline:
+    kolejne komendy można wydawać, gdy poprzednie jeszcze są parsowane lub czekają na Spotify.
+    Komendy wykonywane są w kolejności wydania, a mowa działa we własnym wątku.
+    continuous - mikrofon otwarty cały czas, komendy głosowe przychodzą przez command_queue.
+    """
+    aspotify = AsyncSpotifyClient(spotify)
+    speculator = SpeculativeParser(aspotify, asyncio.get_running_loop())
+    pipeline = CommandPipeline(aspotify, voice_agent, speculator)
+
+    async def listen():
+        # Rozpoznana komenda trafia do command_queue, a stamtąd do potoku
+        voice_command = await voice_agent.listen_async()
+        if voice_command:
+            print(f"Wykonuję komendę głosową: {voice_command}")
+        else:
+            print("Nie rozpoznano komendy głosowej")
+            voice_agent.speak("Nie rozpoznano komendy głosowej. Wracam do trybu tekstowego.")
 
-                    response_text = f"Utwór {result['track_info']} jest już w Twoich ulubionych."
+    executor_task = asyncio.create_task(pipeline.run())
+    pump_task = asyncio.create_task(pipeline.pump())
+    try:
+        if continuous:
+            voice_agent.partial_callback = speculator.on_partial
+            voice_agent.start_continuous()
+        elif start_in_voice_mode:
+            await listen()
 
+        while True:
+            print("\nWprowadź komendę (lub 'Q' aby przełączyć na tryb głosowy, 'exit' aby wyjść):")
+            user_input = (await asyncio.to_thread(input, "> ")).strip()
+
+            if user_input.lower() == 'mute':
+                voice_agent.muted = True
+                voice_agent.flush()
+                print("Agent został wyciszony")
+
+            elif user_input.lower() == 'unmute':
+                voice_agent.muted = False
+                print("Agent został odciszony")
+
+            elif user_input.lower() == 'stats':
+                print(f"Cache parsowania: {parse_cache.stats()}")
+                print(f"Parser LLM: {llm_usage.stats()}")
+                print(f"Cache wyszukiwania: {search_cache.stats()}")
+                print(f"Cache nastrojów: {mood_cache.stats()}")
+                print(f"Indeks biblioteki: {library.stats()}")
+                print(f"Wyszukiwanie spekulatywne: {dict(search_speculation_stats)}")
+                print(f"Spekulacja z częściowych transkrypcji: {speculator.stats()}")
+                print(f"Potok komend: {pipeline.stats()}")
+                print("Zapytania do Spotify:")
+                for endpoint, counter in spotify.scheduler.stats().items():
+                    print(f"  {endpoint}: {counter}")
+
+            elif user_input.lower() == 'trace':
+                if tracer.enabled:
+                    trace_summary(tracer.path)
                 else:
+                    print("Śledzenie wyłączone - ustaw TRACE_FILE, aby zapisywać czasy etapów")
 
-                    response_text = f"Dodano {result['track_info']} do polubionych utworów."
-
-            else:
-
-                response_text = "Nie udało się polubić aktualnego utworu."
-
-            print(response_text)
-
-            if voice_agent:
-                voice_agent.speak(response_text)
+            elif user_input.lower() == 'sync':
+                print("Synchronizuję indeks biblioteki w tle...")
+                executor.submit(library.sync, spotify)
 
-            return result['success']
+            elif user_input.lower() == 'exit':
+                print("Kończenie programu...")
+                break
 
-        elif parsed.get('action') == 'volume_up':
-            print("Zwiększam głośność...")
-            volume_change = int(parsed.get('volume', 10))
-            if voice_agent:
-                voice_agent.speak("Zwiększam głośność")
+            elif user_input.lower() == 'q' and continuous:
+                print("Ciągłe nasłuchiwanie jest już aktywne - po prostu powiedz komendę.")
 
-            result = set_volume(access_token, adjust_by=volume_change, voice_agent=voice_agent)
-            return result['success']
+            elif user_input.lower() == 'q':
+                print("Przełączam na tryb głosowy...")
+                voice_agent.speak("Tryb głosowy aktywny. Proszę wydać komendę.")
+                # Nie nasłuchuj w trakcie wykonywania poprzedniej komendy (jej odpowiedź trafiłaby do mikrofonu)
+                await pipeline.join()
+                await listen()
+                print("Wracam do trybu tekstowego")
 
-        elif parsed.get('action') == 'volume_down':
-            print("Zmniejszam głośność...")
-            volume_change = int(parsed.get('volume', 10))
-            if voice_agent:
-                voice_agent.speak("Zmniejszam głośność")
-
-            result = set_volume(access_token, adjust_by=-volume_change, voice_agent=voice_agent)
-            return result['success']
-
-        elif parsed.get('action') == 'set_volume':
-            print("Ustawiam głośność...")
-            volume_level = int(parsed.get('volume', 50))
-            if voice_agent:
-                voice_agent.speak(f"Ustawiam głośność na {volume_level} procent")
+            elif user_input:
+                command_queue.put((user_input, None))
 
-            result = set_volume(access_token, volume_level=volume_level, voice_agent=voice_agent)
-            return result['success']
+        await pipeline.join()
+    finally:
+        executor_task.cancel()
+        pump_task.cancel()
+        voice_agent.partial_callback = None
+        pipeline.close()
+        speculator.close()
+        await aspotify.aclose()
 
-    except Exception as e:
-        error_message = f"Wystąpił błąd: {str(e)}"
-        print(error_message)
-        import traceback
-        traceback.print_exc()  # Dodaj pełny stack trace
-        if voice_agent:
-            voice_agent.speak("Przepraszam, wystąpił błąd podczas wykonywania komendy.")
-        return False
 
+def main(start_in_voice_mode=False, continuous_listening=CONTINUOUS_LISTENING):
+    open_caches()
 
-def main(start_in_voice_mode=False):
     # Inicjalizacja rozpoznawania głosu
-    voice_agent = VoiceRecognizer()
+    voice_agent = VoiceRecognizer(
+        stream_tts=os.getenv("TTS_STREAMING", "1") != "0",
+        tts_cache=TTSCache() if TTS_CACHE_DIR else None
+    )
+    voice_agent.prewarm(STATIC_PHRASES)
 
-    # Pobierz token dostępu z automatycznym odświeżaniem
-    access_token = get_token()
+    # Pobierz token dostępu z automatycznym odświeżaniem (w tle, przed wygaśnięciem)
+    token_manager = TokenManager()
+    access_token = token_manager.start()
 
     if not access_token:
         print("Nie udało się uzyskać tokena dostępu. Kończenie.")
         return
 
-    voice_agent.speak("Agent Spotify gotowy. Wpisz komendę lub naciśnij 'Q' aby użyć komendy głosowej.")
+    # Jeden klient HTTP (pula połączeń) dla wszystkich operacji Spotify
+    spotify = SpotifyClient(access_token, token_manager=token_manager)
 
-    # Główna pętla
-    try:
-        while True:
-            if start_in_voice_mode:
-                voice_agent.start_listening()
-                # Czekaj na zakończenie nasłuchiwania
-                while voice_agent.listening:
-                    time.sleep(0.1)
+    # Polubione i playlisty do lokalnego indeksu - w tle, przyrostowo
+    if LIBRARY_SYNC:
+        executor.submit(library.sync, spotify)
 
-                # Sprawdź czy jest komenda głosowa
-                try:
-                    voice_command = command_queue.get_nowait()
-                    print(f"Wykonuję komendę głosową: {voice_command}")
-                    process_command(voice_command, access_token, voice_agent)
-                    start_in_voice_mode = False
-                except queue.Empty:
-                    print("Nie rozpoznano komendy głosowej")
-                    voice_agent.speak("Nie rozpoznano komendy głosowej. Wracam do trybu tekstowego.")
-                    start_in_voice_mode = False
-            else:
-                # Wyświetl instrukcję
-                print("\nWprowadź komendę (lub 'Q' aby przełączyć na tryb głosowy, 'exit' aby wyjść):")
-                user_input = input("> ")
-
-                if user_input.lower() == 'mute':
-                    voice_agent.muted = True
-                    print("Agent został wyciszony")
-
-                elif user_input.lower() == 'unmute':
-                    voice_agent.muted = False
-                    print("Agent został odciszony")
-
-                elif user_input.lower() == 'exit':
-                    print("Kończenie programu...")
-                    break
-
-                elif user_input.lower() == 'q':
-                    print("Przełączam na tryb głosowy...")
-                    voice_agent.speak("Tryb głosowy aktywny. Proszę wydać komendę.")
-                    voice_agent.start_listening()
-
-                    # Czekaj na zakończenie nasłuchiwania
-                    while voice_agent.listening:
-                        time.sleep(0.1)
-
-                    # Sprawdź czy jest komenda głosowa
-                    try:
-                        voice_command = command_queue.get_nowait()
-                        print(f"Wykonuję komendę głosową: {voice_command}")
-                        process_command(voice_command, access_token, voice_agent)
-                    except queue.Empty:
-                        print("Nie rozpoznano komendy głosowej")
-                        voice_agent.speak("Nie rozpoznano komendy głosowej. Wracam do trybu tekstowego.")
-
-                    # Wróć do trybu tekstowego
-                    print("Wracam do trybu tekstowego")
-
-                elif user_input:
-                    # Wykonaj komendę tekstową
-                    process_command(user_input, access_token, voice_agent)
+    voice_agent.speak("Agent Spotify gotowy. Wpisz komendę lub naciśnij 'Q' aby użyć komendy głosowej.")
 
+    # Główna pętla na asyncio: wczytywanie komend, zapytania do Spotify i mowa działają równocześnie
+    try:
+        asyncio.run(async_main(spotify, voice_agent, start_in_voice_mode, continuous_listening))
+    except KeyboardInterrupt:
+        print("Kończenie programu...")
     finally:
         # Zatrzymaj rozpoznawanie głosu przy zamykaniu
         voice_agent.stop_listening()
+        voice_agent.shutdown()
+        token_manager.stop()
+        spotify.close()
+        parse_cache.flush()
+        search_cache.flush()
+        mood_cache.flush()
 
 
 if __name__ == "__main__":
-    start_in_voice_mode = False
+    if "--trace-summary" in sys.argv[1:]:
+        # python main.py --trace-summary [plik.jsonl]
+        args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+        trace_summary(args[0] if args else TRACE_FILE or "traces.jsonl")
+        sys.exit()
 
-    if len(sys.argv) > 1:
-        if sys.argv[1] == "--voice":
-            start_in_voice_mode = True
+    start_in_voice_mode = "--voice" in sys.argv[1:]
+    continuous_listening = CONTINUOUS_LISTENING or "--listen" in sys.argv[1:]
 
-    main(start_in_voice_mode=start_in_voice_mode)
+    main(start_in_voice_mode=start_in_voice_mode, continuous_listening=continuous_listening)
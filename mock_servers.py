@@ -0,0 +1,447 @@
+"""Lokalne serwery zastępcze (mock) Spotify Web API i OpenAI (chat, TTS) do benchmarków"""
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# Przykładowe dane zwracane przez mock Spotify
+ARTISTS = {
+    "a1": {"id": "a1", "name": "The Weeknd"},
+    "a2": {"id": "a2", "name": "Dawid Podsiadło"},
+}
+
+ALBUMS = {
+    "al1": {"id": "al1", "name": "After Hours"},
+    "al2": {"id": "al2", "name": "Starboy"},
+    "al3": {"id": "al3", "name": "Małomiasteczkowy"},
+}
+
+TRACKS = {
+    "t1": {"id": "t1", "name": "Blinding Lights", "artist": "a1", "album": "al1"},
+    "t2": {"id": "t2", "name": "Save Your Tears", "artist": "a1", "album": "al1"},
+    "t3": {"id": "t3", "name": "Starboy", "artist": "a1", "album": "al2"},
+    "t4": {"id": "t4", "name": "Małomiasteczkowy", "artist": "a2", "album": "al3"},
+    "t5": {"id": "t5", "name": "Nie ma fal", "artist": "a2", "album": "al3"},
+    "t6": {"id": "t6", "name": "Trójkąty i kwadraty", "artist": "a2", "album": "al3"},
+}
+
+PLAYLISTS = [
+    {"id": "p1", "name": "Chill Vibes", "uri": "spotify:playlist:p1", "snapshot_id": "s1"},
+    {"id": "p2", "name": "Energetyczne poranki", "uri": "spotify:playlist:p2", "snapshot_id": "s1"},
+]
+
+PLAYLIST_TRACKS = {
+    "p1": ["t3", "t5", "t6"],
+    "p2": ["t1", "t2", "t4"],
+}
+
+
+def track_json(track_id):
+    track = TRACKS[track_id]
+    artist = ARTISTS[track["artist"]]
+    return {
+        "id": track["id"],
+        "name": track["name"],
+        "uri": f"spotify:track:{track['id']}",
+        "artists": [{"id": artist["id"], "name": artist["name"], "uri": f"spotify:artist:{artist['id']}"}],
+        "album": ALBUMS[track["album"]],
+    }
+
+
+class MockSpotifyState:
+    """Stan odtwarzacza emulowanego przez mock"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.track_id = "t1"
+        self.is_playing = True
+        self.volume = 50
+        self.shuffle = False
+        self.active_device = "d1"
+        self.queue = []
+        self.history = []  # ostatnio odtwarzane, najnowsze na końcu
+        self.saved = {}  # ID utworu -> added_at
+        self.visible = None  # nieaktualny stan /me/player widoczny do visible_until (opóźnienie propagacji)
+        self.visible_until = 0.0
+        self.devices = [
+            {"id": "d1", "name": "Laptop", "type": "Computer"},
+            {"id": "d2", "name": "Salon TV", "type": "TV"},
+            {"id": "d3", "name": "Telefon", "type": "Smartphone"},
+        ]
+
+    def save(self, track_ids):
+        for track_id in track_ids:
+            if track_id not in self.saved:
+                self.saved[track_id] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + len(self.saved)))
+
+    def next(self):
+        self.history.append(self.track_id)
+        ids = list(TRACKS)
+        if self.queue:
+            self.track_id = self.queue.pop(0)
+        else:
+            self.track_id = ids[(ids.index(self.track_id) + 1) % len(ids)]
+        self.is_playing = True
+
+    def hold(self, delay):
+        """Zmiana odtwarzacza: przez delay sekund GET /me/player zwraca jeszcze poprzedni stan"""
+        if self.visible is None:
+            self.visible = self.player_json()
+        self.visible_until = time.monotonic() + delay
+
+    def visible_player_json(self):
+        if self.visible is not None and time.monotonic() < self.visible_until:
+            return self.visible
+        self.visible = None
+        return self.player_json()
+
+    def device_json(self, device):
+        return dict(device, is_active=device["id"] == self.active_device, volume_percent=self.volume)
+
+    def player_json(self):
+        device = next(d for d in self.devices if d["id"] == self.active_device)
+        return {
+            "device": self.device_json(device),
+            "shuffle_state": self.shuffle,
+            "is_playing": self.is_playing,
+            "item": track_json(self.track_id),
+        }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Wspólna część mocków: keep-alive, koszt nowego połączenia, odpowiedzi JSON"""
+    protocol_version = "HTTP/1.1"
+    # Nagłówki i treść w jednym zapisie - bez opóźnień Nagle/delayed ACK na keep-alive
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # Nowe połączenie: emulacja kosztu TCP + TLS handshake
+        if self.server.connect_delay:
+            time.sleep(self.server.connect_delay)
+        self.server.connections += 1
+        super().setup()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=None, headers=None):
+        data = b"" if body is None else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw_body = self.rfile.read(length) if length else b""
+        return json.loads(raw_body) if raw_body else {}
+
+
+class MockSpotifyHandler(MockHandler):
+    """Obsługa endpointów Spotify używanych w main.py"""
+
+    def _handle(self, method):
+        body = self._body()
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        parsed = urllib.parse.urlparse(self.path)
+        path = parsed.path
+        if path.startswith("/v1"):
+            path = path[3:]
+        params = {k: v[0] for k, v in urllib.parse.parse_qs(parsed.query).items()}
+
+        self.server.requests += 1
+        if self.server.throttle_hit():
+            self._send(429, {"error": {"status": 429, "message": "API rate limit exceeded"}},
+                       {"Retry-After": str(self.server.retry_after)})
+            return
+
+        state = self.server.state
+        with state.lock:
+            if method != "GET" and path.startswith("/me/player") and self.server.propagation_delay:
+                state.hold(self.server.propagation_delay)
+            status, payload = self.route(method, path, params, body, state)
+        self._send(status, payload)
+
+    def page(self, path, params, items):
+        """Stronicowanie jak w Spotify API: offset/limit, total i pełny adres następnej strony"""
+        offset, limit = int(params.get("offset", 0)), int(params.get("limit", 20))
+        following = None
+        if offset + limit < len(items):
+            following = f"http://{self.headers['Host']}/v1{path}?offset={offset + limit}&limit={limit}"
+        return {"items": items[offset:offset + limit], "total": len(items), "next": following}
+
+    def route(self, method, path, params, body, state):
+        if method == "GET" and path in ("/me/player", "/me/player/currently-playing"):
+            return 200, state.visible_player_json()
+
+        if method == "GET" and path == "/me/player/devices":
+            return 200, {"devices": [state.device_json(d) for d in state.devices]}
+
+        if method == "GET" and path == "/search":
+            query = params.get("q", "").lower()
+            if params.get("type") == "playlist":
+                return 200, {"playlists": {"items": PLAYLISTS}}
+            if params.get("type") == "artist":
+                items = [a for a in ARTISTS.values() if a["name"].lower() in query or query in a["name"].lower()]
+                return 200, {"artists": {"items": items[:int(params.get("limit", 1))]}}
+            items = [track_json(t) for t, track in TRACKS.items() if track["name"].lower() in query]
+            if not items:
+                items = [track_json("t1")]
+            return 200, {"tracks": {"items": items[:int(params.get("limit", 1))]}}
+
+        match = re.fullmatch(r"/tracks/(\w+)", path)
+        if method == "GET" and match:
+            if match.group(1) not in TRACKS:
+                return 404, {"error": {"status": 404, "message": "Not found"}}
+            return 200, track_json(match.group(1))
+
+        match = re.fullmatch(r"/artists/(\w+)/top-tracks", path)
+        if method == "GET" and match:
+            tracks = [track_json(t) for t, track in TRACKS.items() if track["artist"] == match.group(1)]
+            return 200, {"tracks": tracks}
+
+        if method == "GET" and path == "/me/tracks/contains":
+            ids = params.get("ids", "").split(",")
+            return 200, [track_id in state.saved for track_id in ids]
+
+        if method == "PUT" and path == "/me/tracks":
+            state.save(filter(None, params.get("ids", "").split(",")))
+            return 200, None
+
+        if method == "DELETE" and path == "/me/tracks":
+            for track_id in params.get("ids", "").split(","):
+                state.saved.pop(track_id, None)
+            return 200, None
+
+        if method == "GET" and path == "/me/player/recently-played":
+            recent = list(reversed(state.history))[:int(params.get("limit", 20))]
+            return 200, {"items": [{"track": track_json(t)} for t in recent]}
+
+        match = re.fullmatch(r"/albums/(\w+)/tracks", path)
+        if method == "GET" and match:
+            items = [track_json(t) for t, track in TRACKS.items() if track["album"] == match.group(1)]
+            return 200, self.page(path, params, items)
+
+        if method == "GET" and path == "/me/tracks":
+            newest = sorted(state.saved.items(), key=lambda item: item[1], reverse=True)
+            items = [{"added_at": added_at, "track": track_json(t)} for t, added_at in newest]
+            return 200, self.page(path, params, items)
+
+        if method == "GET" and path == "/me/playlists":
+            return 200, self.page(path, params, PLAYLISTS)
+
+        match = re.fullmatch(r"/playlists/(\w+)/tracks", path)
+        if method == "GET" and match:
+            items = [{"track": track_json(t)} for t in PLAYLIST_TRACKS.get(match.group(1), [])]
+            return 200, self.page(path, params, items)
+
+        if method == "PUT" and path == "/me/player":
+            state.active_device = body.get("device_ids", [state.active_device])[0]
+            state.is_playing = body.get("play", state.is_playing)
+            return 204, None
+
+        if method == "PUT" and path == "/me/player/play":
+            uris = body.get("uris")
+            if uris:
+                ids = [uri.rsplit(":", 1)[-1] for uri in uris]
+                state.history.append(state.track_id)
+                state.track_id = ids[0]
+                state.queue = ids[1:]
+            state.is_playing = True
+            return 204, None
+
+        if method == "PUT" and path == "/me/player/pause":
+            state.is_playing = False
+            return 204, None
+
+        if method == "PUT" and path == "/me/player/volume":
+            state.volume = int(params.get("volume_percent", state.volume))
+            return 204, None
+
+        if method == "PUT" and path == "/me/player/shuffle":
+            state.shuffle = params.get("state") == "true"
+            return 204, None
+
+        if method == "POST" and path == "/me/player/next":
+            state.next()
+            return 204, None
+
+        if method == "POST" and path == "/me/player/queue":
+            state.queue.append(params.get("uri", "").rsplit(":", 1)[-1])
+            return 204, None
+
+        return 404, {"error": {"status": 404, "message": f"Unknown endpoint {method} {path}"}}
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+class MockServer(ThreadingHTTPServer):
+    """Wspólna część mocków: serwer w osobnym wątku"""
+    daemon_threads = True
+
+    def __init__(self, handler, port=0, latency=0.0, connect_delay=0.0):
+        super().__init__(("127.0.0.1", port), handler)
+        self.latency = latency
+        self.connect_delay = connect_delay
+        self.requests = 0
+        self.connections = 0
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread:
+            self.thread.join(1)
+
+
+class MockSpotifyServer(MockServer):
+    """Mock Spotify Web API w osobnym wątku
+
+    latency - opóźnienie każdej odpowiedzi (s)
+    connect_delay - dodatkowy koszt każdego nowego połączenia (s), emuluje TLS handshake
+    throttle - część zapytań odrzucanych z 429 i nagłówkiem Retry-After (retry_after s)
+    propagation_delay - przez tyle sekund po zmianie odtwarzacza GET /me/player zwraca poprzedni stan
+    """
+
+    def __init__(self, port=0, latency=0.0, connect_delay=0.0, throttle=0.0, retry_after=1,
+                 propagation_delay=0.0, seed=0):
+        super().__init__(MockSpotifyHandler, port, latency, connect_delay)
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.propagation_delay = propagation_delay
+        self.random = random.Random(seed)
+        self.throttled = 0
+        self.state = MockSpotifyState()
+
+    def throttle_hit(self):
+        if not self.throttle or self.random.random() >= self.throttle:
+            return False
+        self.throttled += 1
+        return True
+
+
+def chat_completion(model, arguments=None, content=None, prompt_tokens=0):
+    """Odpowiedź /chat/completions w formacie OpenAI: wywołanie funkcji albo sam tekst"""
+    message = {"role": "assistant", "content": content}
+    if arguments is not None:
+        message["tool_calls"] = [{
+            "id": "call_mock",
+            "type": "function",
+            "function": {"name": "spotify_command", "arguments": json.dumps(arguments, ensure_ascii=False)},
+        }]
+    completion_tokens = len(json.dumps(arguments if arguments is not None else content)) // 4
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if arguments else "stop"}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": 0},
+        },
+    }
+
+
+class MockOpenAIHandler(MockHandler):
+    """Obsługa /chat/completions (parser komend) i /audio/speech (TTS, tylko format pcm)"""
+
+    def do_POST(self):
+        body = self._body()
+        path = urllib.parse.urlparse(self.path).path
+        if path.startswith("/v1"):
+            path = path[3:]
+        self.server.requests += 1
+
+        if path == "/chat/completions":
+            time.sleep(self.server.latency)
+            self.server.chat_requests += 1
+            self._send(200, self.server.complete(body))
+            return
+
+        if path == "/audio/speech":
+            if body.get("response_format") != "pcm":
+                self._send(400, {"error": {"message": "Mock TTS obsługuje tylko response_format=pcm"}})
+                return
+            time.sleep(self.server.tts_latency)
+            self.server.tts_requests += 1
+            # Cisza 24 kHz, 16 bit, mono o długości zależnej od tekstu
+            data = bytes(int(len(body.get("input", "")) * self.server.tts_seconds_per_char * 24000) * 2)
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/pcm")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        self._send(404, {"error": {"message": f"Unknown endpoint POST {path}"}})
+
+
+class MockOpenAIServer(MockServer):
+    """Mock OpenAI API (parser komend i TTS) w osobnym wątku
+
+    latency - czas odpowiedzi /chat/completions (s)
+    tts_latency - czas do pierwszego bajtu /audio/speech (s)
+    responses - wypowiedź -> argumenty spotify_command, które zwraca "model";
+    nieznana wypowiedź jest traktowana jak tytuł utworu
+    """
+
+    def __init__(self, port=0, latency=0.3, tts_latency=0.2, tts_seconds_per_char=0.06, responses=None):
+        super().__init__(MockOpenAIHandler, port, latency)
+        self.tts_latency = tts_latency
+        self.tts_seconds_per_char = tts_seconds_per_char
+        self.responses = responses or {}
+        self.chat_requests = 0
+        self.tts_requests = 0
+
+    def utterance(self, messages):
+        """Wypowiedź użytkownika: ostatnia wiadomość albo tekst w cudzysłowie po "User input:" (stary prompt)"""
+        content = messages[-1].get("content", "") if messages else ""
+        match = re.search(r'User input:\s*"(.*?)"', content, re.S)
+        return (match.group(1) if match else content).strip()
+
+    def complete(self, body):
+        messages = body.get("messages", [])
+        text = self.utterance(messages)
+        arguments = dict(self.responses.get(text) or {"action": "play_song", "song": text, "artist": ""})
+        prompt_tokens = sum(len(m.get("content", "")) for m in messages) // 4
+        tools = body.get("tools")
+        if not tools:
+            return chat_completion(body.get("model"), content=json.dumps(arguments), prompt_tokens=prompt_tokens)
+        # Tryb strict: wszystkie pola schematu obecne, niedotyczące akcji jako null
+        for field in tools[0]["function"]["parameters"]["required"]:
+            arguments.setdefault(field, None)
+        return chat_completion(body.get("model"), arguments=arguments, prompt_tokens=prompt_tokens)